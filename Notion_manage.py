@@ -1,26 +1,54 @@
-import requests
+import argparse
+import atexit
+import sys
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
-from typing import List
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 from dotenv import load_dotenv
+from notion_cache import RelationIds, SchemaCache, SummaryEntry, WorkloadSummaryIndex
+from notion_concurrency import KeyedLocks
+from notion_failures import FailureLedger
+from notion_graph import TaskGraph
+from notion_journal import Journal
+from notion_leases import LeaseStore, partition_of
+from notion_metrics import Metrics, MetricsHook, MetricsServer
+from notion_reconcile import ReconcileCheckpoint, ReconcileReport, build_plan
+from notion_scheduler import AdaptivePollScheduler
+from notion_state import PollState
+from notion_tenants import MultiTenantRunner, TenantConfig, load_tenants
+from notion_transport import NotionTransport, RateLimiter, notion_headers, parse_json
+from notion_webhook import WebhookReceiver
 import os
 
 load_dotenv()
 
 
+@dataclass(slots=True)
 class ScheduleEntity:
-    def __init__(self, id: str, title: str, client_id: str = "", flag: str = "",
-                 start_date: str = "", end_date: str = "", workload: float = 0,
-                 parent_task_id: str = "", child_task_ids: List[str] = None):
-        self.id = id
-        self.title = title
-        self.client_id = client_id
-        self.flag = flag
-        self.start_date = start_date
-        self.end_date = end_date
-        self.workload = workload
-        self.parent_task_id = parent_task_id
-        self.child_task_ids = child_task_ids or []
+    id: str
+    title: str = ""
+    client_id: str = ""
+    flag: str = ""
+    start_date: str = ""
+    end_date: str = ""
+    workload: float = 0
+    parent_task_id: str = ""
+    child_task_ids: Tuple[str, ...] = ()
+    last_edited_time: str = ""
+
+
+# プロパティが無い場合に使う空の辞書（変更しないこと）
+_EMPTY: dict = {}
+
+
+def _journal_data(schedule: ScheduleEntity) -> dict:
+    """ジャーナルに記録する、書き込み手順の再実行に必要な値"""
+    return {"client_id": schedule.client_id, "parent_task_id": schedule.parent_task_id}
 
 
 class Response:
@@ -30,17 +58,66 @@ class Response:
         self.error_message = error_message
 
 
+class CycleStats:
+    """1サイクル分の処理結果"""
+
+    def __init__(self, entries: int = 0, succeeded: int = 0, duration: float = 0.0,
+                 has_more: bool = False, skipped: int = 0):
+        self.entries = entries
+        self.succeeded = succeeded
+        # 過去に失敗して再試行時刻前のため処理を見送った件数
+        self.skipped = skipped
+        self.duration = duration
+        # 取得件数がページ上限に達した（まだ未処理が残っている可能性が高い）
+        self.has_more = has_more
+
+    @property
+    def failed(self) -> int:
+        return self.entries - self.succeeded - self.skipped
+
+    @property
+    def throughput(self) -> float:
+        """1秒あたりの処理エントリー数"""
+        return self.entries / self.duration if self.duration > 0 else 0.0
+
+
 class NotionWorkloadManagement:
-    def __init__(self, NOTION_API_KEY: str, TASK_DB_ID: str, WORKLOAD_SUMMARY_DB_ID: str):
+    # 自分が書き込んだページの通知を無視する時間（秒）
+    RECENT_WRITE_TTL = 60.0
+    # Notion APIの1回のリクエストで設定できるリレーション先の件数の上限
+    RELATION_LIMIT = 100
+    # 他のワーカーとの分担のため書き込まなかったエラー（失敗として記録せず、次のサイクルに回す）
+    DEFERRED_ERRORS = ("LEASE_LOST", "PAGE_LOCKED")
+    # 再試行しても直らないリクエストのエラー（reconcileはそのページを記録して続きを書き込む）
+    PERMANENT_ERROR_STATUSES = (400, 404)
+
+    def __init__(self, NOTION_API_KEY: str, TASK_DB_ID: str, WORKLOAD_SUMMARY_DB_ID: str,
+                 page_size: int = 100, transport: Optional[NotionTransport] = None,
+                 requests_per_second: float = 3.0, max_workers: int = 1,
+                 state_path: Optional[str] = None, full_sweep_interval: float = 3600.0,
+                 metrics: Optional[MetricsHook] = None, schema_cache_path: Optional[str] = None,
+                 failure_ledger_path: Optional[str] = None, journal_path: Optional[str] = None,
+                 leases: Optional[LeaseStore] = None):
         self.NOTION_API_KEY = NOTION_API_KEY
         self.TASK_DB_ID = TASK_DB_ID
         self.WORKLOAD_SUMMARY_DB_ID = WORKLOAD_SUMMARY_DB_ID
+        # タスクDBクエリの1ページあたりの件数（Notion APIの上限は100）
+        self.page_size = page_size
+        # エントリー処理の並列数（1の場合は逐次処理）
+        self.max_workers = max_workers
+        # 差分ポーリングの状態（state_pathを指定した場合のみ有効）
+        self.poll_state = PollState(state_path) if state_path else None
+        # 差分ポーリング時に全件検索を行う間隔（秒）
+        self.full_sweep_interval = full_sweep_interval
 
-        self.headers = {
-            "Authorization": f"Bearer {self.NOTION_API_KEY}",
-            "Content-Type": "application/json",
-            "Notion-Version": "2022-06-28"
-        }
+        self.headers = notion_headers(self.NOTION_API_KEY)
+
+        # 計測フック（Noneの場合は計測しない）
+        self.metrics = metrics
+
+        # 全てのAPI呼び出しで共有するHTTPトランスポート（テストでは差し替え可能）
+        self.transport = transport or NotionTransport(
+            self.headers, rate_limiter=RateLimiter(rate=requests_per_second), metrics=metrics)
 
         # タスクDB用のプロパティ
         self.task_properties = {
@@ -63,13 +140,37 @@ class NotionWorkloadManagement:
             'title': '名前'
         }
 
+        # 顧問先ID → 工数集計ページのインデックス（集計DBの検索を省くためのキャッシュ）
+        self.summary_index = WorkloadSummaryIndex()
+        # データベースID → プロパティ名とプロパティIDの対応表（schema_cache_pathを指定するとファイルに保存）
+        self.schema_cache = SchemaCache(schema_cache_path)
+        # 処理に失敗したエントリーの記録（failure_ledger_pathを指定するとファイルに保存）
+        self.failures = FailureLedger(failure_ledger_path)
+        # 書き込み手順の先行書き込みログ（journal_pathを指定すると再起動時に未完了の手順を再実行できる）
+        self.journal = Journal(journal_path)
+        # タスクの親子関係のローカルグラフ（親タスクはrollupではなくこちらから求める）
+        self.task_graph = TaskGraph()
+        # 親タスクID → 子タスクID（1サイクルの間だけ保持し、同じ親タスクの読み込みを省く）
+        self._parent_children: Dict[str, RelationIds] = {}
+        # ページID → 書き込んだ時刻（自分の書き込みによるwebhookの通知を無視するために使う）
+        self._recent_writes: "OrderedDict[str, float]" = OrderedDict()
+        self._recent_writes_lock = threading.Lock()
+        # 並列処理時に同じページへの書き込みを直列化するロック
+        self._page_locks = KeyedLocks()
+        # 複数ワーカーで分担する場合のパーティションのリース（Noneの場合は全ての顧問先を処理する）
+        self.leases = leases
+        # 前回のサイクル開始時に持っていたパーティション
+        self._lease_partitions: Set[int] = set()
+
     def get_database_properties(self):
         """データベースのプロパティを取得して表示"""
-        task_url = f"https://api.notion.com/v1/databases/{self.TASK_DB_ID}"
-        task_response = requests.get(task_url, headers=self.headers)
+        task_url = f"databases/{self.TASK_DB_ID}"
+        task_response = self.transport.get(task_url, operation="get_database")
 
         if task_response.status_code == 200:
-            properties = task_response.json().get('properties', {})
+            properties = parse_json(task_response).get('properties', {})
+            if self.schema_cache.update(self.TASK_DB_ID, properties):
+                print("Task database schema cache updated")
             print("\nTask Database Properties:")
             for prop_name, prop_info in properties.items():
                 print(f"- {prop_name} (type: {prop_info['type']})")
@@ -77,12 +178,13 @@ class NotionWorkloadManagement:
             print(f"Error fetching task database properties: {
                   task_response.text}")
 
-        workload_url = f"https://api.notion.com/v1/databases/{
-            self.WORKLOAD_SUMMARY_DB_ID}"
-        workload_response = requests.get(workload_url, headers=self.headers)
+        workload_url = f"databases/{self.WORKLOAD_SUMMARY_DB_ID}"
+        workload_response = self.transport.get(workload_url, operation="get_database")
 
         if workload_response.status_code == 200:
-            properties = workload_response.json().get('properties', {})
+            properties = parse_json(workload_response).get('properties', {})
+            if self.schema_cache.update(self.WORKLOAD_SUMMARY_DB_ID, properties):
+                print("Workload summary database schema cache updated")
             print("\nWorkload Summary Database Properties:")
             for prop_name, prop_info in properties.items():
                 print(f"- {prop_name} (type: {prop_info['type']})")
@@ -90,11 +192,138 @@ class NotionWorkloadManagement:
             print(f"Error fetching workload database properties: {
                   workload_response.text}")
 
-    def get_new_schedule_entries(self) -> List[ScheduleEntity]:
-        """新規スケジュールエントリーの取得"""
-        url = f"https://api.notion.com/v1/databases/{self.TASK_DB_ID}/query"
+    def _projection(self, database_id: str, property_names: List[str]) -> Optional[List[str]]:
+        """クエリで取得するプロパティのIDを返す（スキーマが取得できない場合はNoneで全プロパティを取得）"""
+        properties = self.schema_cache.get(database_id)
+        if properties is None:
+            properties, _ = self._fetch_schema(database_id)
+        if not properties:
+            return None
+
+        property_ids = [properties.get(name) for name in property_names]
+        if not all(property_ids):
+            return None
+        return property_ids
+
+    @staticmethod
+    def _is_projection_rejected(response) -> bool:
+        """filter_propertiesのプロパティIDが見つからないというバリデーションエラーか"""
+        if response.status_code != 400:
+            return False
+        try:
+            data = parse_json(response)
+        except ValueError:
+            return False
+        message = str(data.get("message", ""))
+        return data.get("code") == "validation_error" and (
+            "filter_properties" in message or "property with id" in message)
+
+    def _query_projected_page(self, url: str, payload: dict, start_cursor: Optional[str],
+                              operation: str, property_ids: Optional[List[str]]):
+        """データベースクエリを1ページ分実行し、レスポンスと実際に使ったプロパティIDを返す
+
+        プロパティIDが無効になっていた場合は、そのデータベースのスキーマのキャッシュのみ破棄し、
+        全プロパティで再実行する（プロパティIDはNoneを返す）。
+        """
+        page_payload = dict(payload)
+        if start_cursor:
+            page_payload["start_cursor"] = start_cursor
+
+        if property_ids:
+            # プロパティIDはAPIから返された（URLエンコード済みの）形のまま渡す
+            query = "&".join(f"filter_properties={property_id}" for property_id in property_ids)
+            response = self.transport.post(f"{url}?{query}", json=page_payload, operation=operation)
+            if not self._is_projection_rejected(response):
+                return response, property_ids
+            # スキーマ変更でプロパティIDが無効になったため、キャッシュを破棄して全プロパティで再実行
+            database_id = url.split("/")[1]
+            print(f"Projected query rejected, clearing schema cache of {database_id}: {response.text}")
+            self.schema_cache.invalidate(database_id)
+
+        return self.transport.post(url, json=page_payload, operation=operation), None
+
+    def _query_database_page(self, url: str, payload: dict, start_cursor: Optional[str] = None,
+                             operation: str = "query_tasks", property_ids: Optional[List[str]] = None):
+        """データベースクエリを1ページ分実行"""
+        response, _ = self._query_projected_page(url, payload, start_cursor, operation, property_ids)
+        return response
+
+    def _iter_query_pages(self, url: str, payload: dict, page_size: int,
+                          error_label: str = "new schedule entries",
+                          operation: str = "query_tasks",
+                          property_ids: Optional[List[str]] = None,
+                          failed: Optional[list] = None) -> Iterator[List[dict]]:
+        """next_cursorを辿りながらクエリ結果をページ単位で返す
+
+        呼び出し側が現在のページを処理している間に次のページを先読みする。
+        保持するのは処理中と先読み中の最大2ページ分のみ。
+        property_idsを指定した場合はfilter_propertiesでそのプロパティのみを取得する
+        （プロパティIDが無効になっていた場合は、以降のページも全プロパティで取得する）。
+        途中でエラーになった場合はそこで終わる（failedを指定した場合はエラーのレスポンスを追加し、
+        呼び出し側が最後まで読めなかったことを判別できるようにする）。
+        """
+        payload = dict(payload, page_size=max(1, min(page_size, 100)))
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(
+                self._query_projected_page, url, payload, None, operation, property_ids)
+            while pending is not None:
+                response, property_ids = pending.result()
+                pending = None
+
+                if response.status_code != 200:
+                    print(f"Error fetching {error_label}: {response.text}")
+                    if failed is not None:
+                        failed.append(response)
+                    return
+
+                data = parse_json(response)
+                next_cursor = data.get("next_cursor")
+                if data.get("has_more") and next_cursor:
+                    pending = executor.submit(
+                        self._query_projected_page, url, payload, next_cursor, operation, property_ids)
+
+                yield data.get("results", [])
+
+    def _parse_schedule_entry(self, result: dict) -> ScheduleEntity:
+        """クエリ結果の1件をScheduleEntityに変換
+
+        各プロパティは1回だけ参照し、値が無い・nullの場合は既定値にする。
+        """
+        properties = result.get("properties") or _EMPTY
+        names = self.task_properties
+
+        title = (properties.get(names['title']) or _EMPTY).get("title")
+        client = (properties.get(names['client']) or _EMPTY).get("relation")
+        start_date = (properties.get(names['start_date']) or _EMPTY).get("date") or _EMPTY
+        end_date = (properties.get(names['end_date']) or _EMPTY).get("date") or _EMPTY
+        # rollupから親タスクの情報を取得
+        parent_task = ((properties.get(names['parent_task']) or _EMPTY).get("rollup") or _EMPTY).get("array")
+        child_tasks = (properties.get(names['child_tasks']) or _EMPTY).get("relation") or ()
+
+        return ScheduleEntity(
+            result["id"],
+            title[0].get("plain_text", "") if title else "",
+            client[0].get("id", "") if client else "",
+            (properties.get(names['flag']) or _EMPTY).get("checkbox", False),
+            start_date.get("start") or "",
+            end_date.get("end") or "",
+            (properties.get(names['workload']) or _EMPTY).get("number") or 0,
+            parent_task[0].get("relation", _EMPTY).get("id", "") if parent_task else "",
+            tuple([child.get("id", "") for child in child_tasks]),
+            result.get("last_edited_time", ""))
+
+    def iter_new_schedule_batches(self, page_size: Optional[int] = None,
+                                  since: Optional[str] = None,
+                                  failed: Optional[list] = None) -> Iterator[List[ScheduleEntity]]:
+        """新規スケジュールエントリーをクエリのページ単位でまとめて返す
+
+        last_edited_timeの昇順で取得する（途中でエラーになっても、読めたページより前に未読のページが残らない）。
+        sinceを指定した場合はそれ以降に編集されたタスクのみを取得する。
+        """
+        url = f"databases/{self.TASK_DB_ID}/query"
         payload = {
-                "filter": {
+            "filter": {
                 "and": [
                     {
                         "property": self.task_properties['flag'],
@@ -109,134 +338,384 @@ class NotionWorkloadManagement:
                         }
                     }
                 ]
-            }
+            },
+            "sorts": [
+                {
+                    "timestamp": "last_edited_time",
+                    "direction": "ascending"
+                }
+            ]
         }
+        if since:
+            payload["filter"]["and"].append({
+                "timestamp": "last_edited_time",
+                "last_edited_time": {
+                    "on_or_after": since
+                }
+            })
 
-        response = requests.post(url, json=payload, headers=self.headers)
+        property_ids = self._projection(self.TASK_DB_ID, list(self.task_properties.values()))
+        pages = self._iter_query_pages(
+            url, payload, page_size or self.page_size, property_ids=property_ids, failed=failed)
+        for results in pages:
+            yield [self._parse_schedule_entry(result) for result in results]
 
-        if response.status_code != 200:
-            print(f"Error fetching new schedule entries: {response.text}")
-            return []
-
-        results = response.json().get("results", [])
-        schedule_entries = []
-
-        for result in results:
-            properties = result.get("properties", {})
-
-            # rollupから親タスクの情報を取得
-            parent_task_id = ""
-            parent_task_rollup = properties.get(
-                self.task_properties['parent_task'], {})
-            if parent_task_rollup.get("rollup", {}).get("array", []):
-                parent_task_id = parent_task_rollup["rollup"]["array"][0].get(
-                    "relation", {}).get("id", "")
-
-            # 子タスクIDsの取得
-            child_task_ids = []
-            child_task_relations = properties.get(
-                self.task_properties['child_tasks'], {}).get("relation", [])
-            for child in child_task_relations:
-                child_task_ids.append(child.get("id", ""))
-
-            schedule_entries.append(
-                ScheduleEntity(
-                    id=result["id"],
-                    title=properties.get(self.task_properties['title'], {}).get(
-                        "title", [{}])[0].get("plain_text", ""),
-                    client_id=properties.get(self.task_properties['client'], {}).get("relation", [{}])[0].get(
-                        "id", "") if properties.get(self.task_properties['client'], {}).get("relation") else "",
-                    flag=properties.get(self.task_properties['flag'], {}).get(
-                        "checkbox", False),
-                    start_date=properties.get(self.task_properties['start_date'], {}).get(
-                        "date", {}).get("start", ""),
-                    end_date=properties.get(self.task_properties['end_date'], {}).get(
-                        "date", {}).get("end", ""),
-                    workload=properties.get(
-                        self.task_properties['workload'], {}).get("number", 0),
-                    parent_task_id=parent_task_id,
-                    child_task_ids=child_task_ids
-                )
-            )
+    def iter_new_schedule_entries(self, page_size: Optional[int] = None) -> Iterator[ScheduleEntity]:
+        """新規スケジュールエントリーをページ単位で取得しながら順次返す"""
+        for batch in self.iter_new_schedule_batches(page_size):
+            yield from batch
 
-        return schedule_entries
+    def get_new_schedule_entries(self, page_size: Optional[int] = None) -> List[ScheduleEntity]:
+        """新規スケジュールエントリーの取得"""
+        return list(self.iter_new_schedule_entries(page_size))
 
     def update_parent_task(self, schedule: ScheduleEntity) -> Response:
         """親タスクの更新"""
         if not schedule.parent_task_id:
             return Response()
+        return self.update_parent_tasks(schedule.parent_task_id, [schedule])
 
-        url = f"https://api.notion.com/v1/pages/{schedule.parent_task_id}"
+    def update_parent_tasks(self, parent_task_id: str, schedules: List[ScheduleEntity]) -> Response:
+        """同じ親タスクを持つ複数エントリーを1回のPATCHで親タスクの子タスクに追加
 
-        # 親タスクの子タスクリレーションを更新
-        payload = {
-            "properties": {
-                self.task_properties['child_tasks']: {
-                    "relation": [{"id": schedule.id}]
+        既存の子タスクを全件読み込んでから追加する（全て登録済みの場合は書き込まない）。
+        """
+        url = f"pages/{parent_task_id}"
+
+        # 同じ親タスクへの読み込み〜書き込みは直列化する（複数ワーカーの場合は全ワーカーで）
+        with self._page_locks.hold(parent_task_id), self._hold_shared_page(parent_task_id) as error:
+            if error:
+                return error
+            # 複数ワーカーの場合は他のワーカーが書き込んでいる可能性があるため、毎回読み直す
+            child_ids = self._parent_children.get(parent_task_id) if self.leases is None else None
+            if child_ids is None:
+                child_ids, error = self._read_child_task_ids(parent_task_id)
+                if error:
+                    return error
+
+            new_child_ids = child_ids.copy()
+            added = [schedule.id for schedule in schedules if new_child_ids.add(schedule.id)]
+            if not added:
+                self._parent_children[parent_task_id] = child_ids
+                return Response()
+            error = self._check_relation_limit(parent_task_id, self.task_properties['child_tasks'], new_child_ids)
+            if error:
+                return error
+
+            # 親タスクの子タスクリレーションを更新
+            payload = {
+                "properties": {
+                    self.task_properties['child_tasks']: {
+                        "relation": new_child_ids.to_relation()
+                    }
                 }
             }
-        }
 
-        response = requests.patch(url, json=payload, headers=self.headers)
+            response = self.transport.patch(url, json=payload, operation="patch_parent")
 
-        if response.status_code != 200:
-            return Response(
-                status_code=response.status_code,
-                error_code="PARENT_UPDATE_FAILED",
-                error_message=response.text
-            )
+            if response.status_code != 200:
+                self._parent_children.pop(parent_task_id, None)
+                return Response(
+                    status_code=response.status_code,
+                    error_code="PARENT_UPDATE_FAILED",
+                    error_message=response.text
+                )
 
+            self._parent_children[parent_task_id] = new_child_ids
+            self._mark_written([parent_task_id])
+        for schedule in schedules:
+            self.task_graph.set_parent(schedule.id, parent_task_id)
         return Response()
 
-    def update_workload_entry(self, schedule: ScheduleEntity) -> Response:
-        """工数集計DBの更新"""
-        query_url = f"https://api.notion.com/v1/databases/{
-            self.WORKLOAD_SUMMARY_DB_ID}/query"
+    @contextmanager
+    def _hold_shared_page(self, page_id: str):
+        """複数ワーカーで分担している場合は全ワーカーでページへの書き込みを直列化する
+
+        他のワーカーが書き込み中で取得できない場合はPAGE_LOCKEDのエラーを渡す。
+        """
+        if self.leases is None:
+            yield None
+            return
+        if not self.leases.acquire_page(page_id):
+            yield Response(status_code=409, error_code="PAGE_LOCKED",
+                           error_message=f"Page {page_id} is locked by another worker")
+            return
+        try:
+            yield None
+        finally:
+            self.leases.release_page(page_id)
+
+    def refresh_summary_index(self) -> int:
+        """工数集計インデックスを更新
+
+        初回は工数集計DB全体をページングして一括で読み込み、
+        以降は前回以降に編集されたページのみを取得する。
+        編集日時の昇順で取得するため、途中でエラーになった場合も
+        最高水位より前に編集されたページは全て読み込み済みになる。
+        """
+        url = f"databases/{self.WORKLOAD_SUMMARY_DB_ID}/query"
+        payload = {"sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}]}
+        if self.summary_index.loaded and self.summary_index.watermark:
+            payload["filter"] = {
+                "timestamp": "last_edited_time",
+                "last_edited_time": {
+                    "on_or_after": self.summary_index.watermark
+                }
+            }
+
+        count = 0
+        completed = False
+        property_ids = self._projection(self.WORKLOAD_SUMMARY_DB_ID, [
+            self.workload_properties['client'], self.workload_properties['task']])
+        pages = self._iter_query_pages(
+            url, payload, self.page_size, "workload summary index", "query_summary", property_ids)
+        for results in pages:
+            count += self.summary_index.ingest(
+                results, self.workload_properties['client'], self.workload_properties['task'])
+            completed = True
+
+        if completed:
+            self.summary_index.loaded = True
+        return count
+
+    def refresh_task_graph(self) -> int:
+        """タスクの親子関係のグラフを更新
+
+        初回はタスクDB全体をページングして一括で読み込み、
+        以降は前回以降に編集されたページのみを取得する。
+        子タスクが切り詰められているページはプロパティアイテムAPIで全件読み込む。
+        """
+        url = f"databases/{self.TASK_DB_ID}/query"
+        # 途中でエラーになった場合も最高水位より前のページを読み飛ばさないよう、初回も編集日時の昇順で取得する
+        payload = {"sorts": [{"timestamp": "last_edited_time", "direction": "ascending"}]}
+        if self.task_graph.loaded and self.task_graph.watermark:
+            payload["filter"] = {
+                "timestamp": "last_edited_time",
+                "last_edited_time": {
+                    "on_or_after": self.task_graph.watermark
+                }
+            }
+
+        count = 0
+        completed = False
+        property_ids = self._projection(self.TASK_DB_ID, [
+            self.task_properties['child_tasks'], self.task_properties['workload']])
+        pages = self._iter_query_pages(
+            url, payload, self.page_size, "task graph", "query_graph", property_ids)
+        for results in pages:
+            truncated = self.task_graph.ingest(
+                results, self.task_properties['child_tasks'], self.task_properties['workload'])
+            for page_id in truncated:
+                child_ids, error = self._read_child_task_ids(page_id)
+                if error:
+                    print(f"Error reading child tasks of {page_id}: {error.error_message}")
+                    continue
+                self.task_graph.set_children(page_id, child_ids)
+            count += len(results)
+            completed = True
+
+        if completed:
+            self.task_graph.loaded = True
+        return count
+
+    def _resolve_parents(self, entries: List[ScheduleEntity]):
+        """rollupの親タスクが空（切り詰められている）場合のみ、親タスクをグラフから求める
+
+        rollupはエントリーを取得した時点の値のため、別の親タスクに移された直後で
+        グラフが古い親タスクのままでもrollupを優先する。
+        """
+        for entry in entries:
+            if entry.parent_task_id:
+                continue
+            parent_task_id = self.task_graph.parent(entry.id)
+            if parent_task_id:
+                entry.parent_task_id = parent_task_id
+
+    def _find_workload_summary(self, client_id: str):
+        """顧問先の工数集計ページを取得（インデックスに無い場合のみAPIで検索）"""
+        entry = self.summary_index.get(client_id)
+        if entry is not WorkloadSummaryIndex.MISS:
+            return entry, None
+
+        query_url = f"databases/{self.WORKLOAD_SUMMARY_DB_ID}/query"
         query_payload = {
             "filter": {
                 "property": self.workload_properties['client'],
                 "relation": {
-                    "contains": schedule.client_id
+                    "contains": client_id
                 }
             }
         }
 
-        query_response = requests.post(
-            query_url, json=query_payload, headers=self.headers)
+        property_ids = self._projection(self.WORKLOAD_SUMMARY_DB_ID, [
+            self.workload_properties['client'], self.workload_properties['task']])
+        query_response = self._query_database_page(
+            query_url, query_payload, operation="query_summary", property_ids=property_ids)
 
         if query_response.status_code != 200:
-            return Response(
+            return None, Response(
                 status_code=query_response.status_code,
                 error_code="QUERY_FAILED",
                 error_message=query_response.text
             )
 
-        results = query_response.json().get("results", [])
+        results = parse_json(query_response).get("results", [])
         if not results:
-            print(f"No workload entry found for client ID: {
-                  schedule.client_id}")
+            # 集計ページが無い顧問先は短時間だけ記録しておく
+            self.summary_index.put(client_id, None)
+            return None, None
+
+        entry = SummaryEntry.from_page(
+            results[0], self.workload_properties['task'], self.workload_properties['client'])
+        self.summary_index.put(client_id, entry)
+        return entry, None
+
+    def _fetch_schema(self, database_id: str):
+        """データベーススキーマを取得してキャッシュを更新"""
+        response = self.transport.get(f"databases/{database_id}", operation="get_database")
+        if response.status_code != 200:
+            return None, Response(
+                status_code=response.status_code,
+                error_code="SCHEMA_FETCH_FAILED",
+                error_message=response.text
+            )
+
+        self.schema_cache.update(database_id, parse_json(response).get("properties", {}))
+        return self.schema_cache.get(database_id), None
+
+    def _get_property_id(self, database_id: str, property_name: str):
+        """データベーススキーマからプロパティIDを取得（取得済みのものは再利用）"""
+        property_id = self.schema_cache.property_id(database_id, property_name)
+        if property_id:
+            return property_id, None
+
+        properties, error = self._fetch_schema(database_id)
+        if error:
+            return None, error
+
+        if property_name not in properties:
+            return None, Response(
+                status_code=404,
+                error_code="PROPERTY_NOT_FOUND",
+                error_message=f"Property not found: {property_name}"
+            )
+        return properties[property_name], None
+
+    def read_relation_ids(self, page_id: str, property_id: str):
+        """プロパティアイテムAPIをページングしてリレーションの全IDを取得"""
+        url = f"pages/{page_id}/properties/{property_id}"
+        relation_ids = RelationIds()
+        params = {"page_size": 100}
+
+        while True:
+            response = self.transport.get(url, params=params, operation="read_relation")
+            if response.status_code != 200:
+                return None, Response(
+                    status_code=response.status_code,
+                    error_code="RELATION_READ_FAILED",
+                    error_message=response.text
+                )
+
+            data = parse_json(response)
+            for item in data.get("results", []):
+                relation_ids.add(item.get("relation", {}).get("id", ""))
+
+            if not data.get("has_more") or not data.get("next_cursor"):
+                return relation_ids, None
+            params = {"page_size": 100, "start_cursor": data["next_cursor"]}
+
+    def _read_child_task_ids(self, page_id: str):
+        """タスクの子タスクリレーションを全件取得"""
+        property_id, error = self._get_property_id(self.TASK_DB_ID, self.task_properties['child_tasks'])
+        if error:
+            return None, error
+        return self.read_relation_ids(page_id, property_id)
+
+    def _load_summary_tasks(self, summary: SummaryEntry) -> Optional[Response]:
+        """切り詰められている集計ページのリレーションを全件読み直す"""
+        if summary.complete:
+            return None
+
+        property_id, error = self._get_property_id(
+            self.WORKLOAD_SUMMARY_DB_ID, self.workload_properties['task'])
+        if error:
+            return error
+
+        task_ids, error = self.read_relation_ids(summary.page_id, property_id)
+        if error:
+            return error
+
+        summary.task_ids = task_ids
+        summary.complete = True
+        return None
+
+    def update_workload_entry(self, schedule: ScheduleEntity) -> Response:
+        """工数集計DBの更新"""
+        return self.update_workload_entries(schedule.client_id, [schedule])
+
+    def update_workload_entries(self, client_id: str, schedules: List[ScheduleEntity]) -> Response:
+        """同じ顧問先の複数エントリーを1回のPATCHで工数集計DBに反映"""
+        summary, error = self._find_workload_summary(client_id)
+        if error:
+            return error
+
+        if summary is None:
+            print(f"No workload entry found for client ID: {client_id}")
             return Response(
                 status_code=404,
                 error_code="NOT_FOUND",
                 error_message="Workload entry not found"
             )
 
+        # 同じ集計ページへの読み込み〜書き込みは直列化する
+        # 複数の顧問先に紐付いたページは他のパーティションを持つワーカーからも書き込まれるため、全ワーカーで直列化する
+        shared = self.leases is not None and summary.client_count > 1
+        with self._page_locks.hold(summary.page_id), \
+                (self._hold_shared_page(summary.page_id) if shared else nullcontext()) as error:
+            if error:
+                return error
+            if shared:
+                # キャッシュは他のワーカーの書き込みを含まないため読み直す
+                summary.complete = False
+            return self._write_summary_tasks(summary, schedules)
+
+    def _write_summary_tasks(self, summary: SummaryEntry, schedules: List[ScheduleEntity]) -> Response:
+        """集計ページの予定リレーションにエントリーを追加"""
+        # 既存のリレーションを全件揃えてから追加する
+        error = self._load_summary_tasks(summary)
+        if error:
+            return error
+
         # 既存の工数集計レコードを更新
-        workload_entry_id = results[0]["id"]
-        url = f"https://api.notion.com/v1/pages/{workload_entry_id}"
+        url = f"pages/{summary.page_id}"
 
-        existing_tasks = results[0]["properties"][self.workload_properties['task']]["relation"]
-        new_schedules = existing_tasks + [{"id": schedule.id}]
+        new_task_ids = summary.task_ids.copy()
+        added = [schedule.id for schedule in schedules if new_task_ids.add(schedule.id)]
+        if not added:
+            # 全て登録済みなので書き込み不要
+            return Response()
+        error = self._check_relation_limit(summary.page_id, self.workload_properties['task'], new_task_ids)
+        if error:
+            return error
 
         payload = {
             "properties": {
                 self.workload_properties['task']: {
-                    "relation": new_schedules
+                    "relation": new_task_ids.to_relation()
                 }
             }
         }
 
-        response = requests.patch(url, json=payload, headers=self.headers)
+        # 読み込みに時間がかかった間にリースが切れて他のワーカーに引き継がれた場合は書き込まない
+        client_id = schedules[0].client_id
+        if self.leases and not self.leases.owns(client_id):
+            return Response(
+                status_code=409,
+                error_code="LEASE_LOST",
+                error_message=f"Lease for client {client_id} expired before writing {summary.page_id}"
+            )
+
+        response = self.transport.patch(url, json=payload, operation="patch_summary")
 
         if response.status_code != 200:
             return Response(
@@ -245,11 +724,25 @@ class NotionWorkloadManagement:
                 error_message=response.text
             )
 
+        # 書き込みに成功した内容でキャッシュも更新
+        summary.task_ids = new_task_ids
         return Response()
 
+    def _check_relation_limit(self, page_id: str, property_name: str,
+                              relation_ids: RelationIds) -> Optional[Response]:
+        """書き込むリレーションがAPIの上限を超える場合はエラーを返す（リレーションは全件で置き換えるため分割できない）"""
+        if len(relation_ids) <= self.RELATION_LIMIT:
+            return None
+        return Response(
+            status_code=400,
+            error_code="RELATION_LIMIT_EXCEEDED",
+            error_message=(f"{property_name} of page {page_id} would have {len(relation_ids)} related pages, "
+                           f"but the Notion API accepts at most {self.RELATION_LIMIT} per request")
+        )
+
     def update_schedule_flag(self, schedule: ScheduleEntity) -> Response:
         """スケジュールフラグの更新"""
-        url = f"https://api.notion.com/v1/pages/{schedule.id}"
+        url = f"pages/{schedule.id}"
         payload = {
             "properties": {
                 self.task_properties['flag']: {
@@ -258,7 +751,7 @@ class NotionWorkloadManagement:
             }
         }
 
-        response = requests.patch(url, json=payload, headers=self.headers)
+        response = self.transport.patch(url, json=payload, operation="patch_flag")
 
         if response.status_code != 200:
             return Response(
@@ -269,50 +762,587 @@ class NotionWorkloadManagement:
 
         return Response()
 
-    def process_new_entries(self):
-        """新規エントリーの処理"""
-        new_entries = self.get_new_schedule_entries()
-        print(f"Found {len(new_entries)} new entries to process")
+    def _update_parents(self, entries: List[ScheduleEntity],
+                        executor: Optional[ThreadPoolExecutor] = None) -> List[ScheduleEntity]:
+        """エントリーを親タスクごとにまとめて子タスクを更新し、親タスクの更新が済んだエントリーを返す
 
-        for entry in new_entries:
+        ジャーナルで親タスクの更新が完了済みのエントリーは飛ばす。
+        """
+        by_parent: Dict[str, List[ScheduleEntity]] = {}
+        for entry in entries:
             print(f"Processing entry: {entry.title}")
+            if entry.parent_task_id and "parent" not in self.journal.completed(entry.id, _journal_data(entry)):
+                by_parent.setdefault(entry.parent_task_id, []).append(entry)
+
+        if not by_parent:
+            return entries
 
-            # 親タスクの更新
-            parent_response = self.update_parent_task(entry)
+        self.journal.intents("parent", [(entry.id, _journal_data(entry))
+                                        for children in by_parent.values() for entry in children])
+        groups = list(by_parent.items())
+        responses = (executor.map(lambda group: self.update_parent_tasks(*group), groups) if executor
+                     else [self.update_parent_tasks(parent_task_id, children)
+                           for parent_task_id, children in groups])
+
+        failed = set()
+        for (_, children), parent_response in zip(groups, responses):
             if parent_response.status_code != 200:
-                print(f"Failed to update parent task for entry {
-                      entry.id}: {parent_response.error_message}")
-                continue
+                for entry in children:
+                    print(f"Failed to update parent task for entry {
+                          entry.id}: {parent_response.error_message}")
+                    if parent_response.error_code not in self.DEFERRED_ERRORS:
+                        self._record_failure(entry, "parent", parent_response)
+                    failed.add(entry.id)
+            else:
+                self.journal.done_many("parent", [entry.id for entry in children])
 
-            # 工数の更新
-            workload_response = self.update_workload_entry(entry)
-            if workload_response.status_code == 200:
-                flag_response = self.update_schedule_flag(entry)
-                if flag_response.status_code != 200:
-                    print(f"Failed to update flag for entry {
-                          entry.id}: {flag_response.error_message}")
-                else:
-                    print(f"Successfully processed entry: {entry.title}")
+        return [entry for entry in entries if entry.id not in failed]
+
+    def _process_client_entries(self, client_id: str,
+                                entries: List[ScheduleEntity]) -> List[ScheduleEntity]:
+        """1顧問先分のエントリーの工数を更新し、フラグを更新できるエントリーを返す
+
+        ジャーナルで工数の更新が完了済みのエントリーは飛ばす。
+        """
+        ready = []
+        pending_workload = []
+        for entry in entries:
+            if "workload" in self.journal.completed(entry.id, _journal_data(entry)):
+                ready.append(entry)
             else:
+                pending_workload.append(entry)
+
+        if not pending_workload:
+            return ready
+
+        # 工数の更新（顧問先ごとに1回）
+        self.journal.intents("workload", [(entry.id, _journal_data(entry)) for entry in pending_workload])
+        workload_response = self.update_workload_entries(client_id, pending_workload)
+        if workload_response.status_code != 200:
+            for entry in pending_workload:
                 print(f"Failed to update workload for entry {
                       entry.id}: {workload_response.error_message}")
+                if workload_response.error_code not in self.DEFERRED_ERRORS:
+                    self._record_failure(entry, "workload", workload_response)
+            return ready
+
+        self.journal.done_many("workload", [entry.id for entry in pending_workload])
+        return ready + pending_workload
+
+    def _update_flags(self, entries: List[ScheduleEntity],
+                      executor: Optional[ThreadPoolExecutor] = None) -> int:
+        """工数の書き込みに成功したエントリーのフラグをまとめて更新し、成功件数を返す"""
+        if not entries:
+            return 0
+
+        self.journal.intents("flag", [(entry.id, _journal_data(entry)) for entry in entries])
+        responses = (executor.map(self.update_schedule_flag, entries) if executor
+                     else map(self.update_schedule_flag, entries))
+
+        succeeded = []
+        for entry, flag_response in zip(entries, responses):
+            if flag_response.status_code != 200:
+                print(f"Failed to update flag for entry {
+                      entry.id}: {flag_response.error_message}")
+                self._record_failure(entry, "flag", flag_response)
+            else:
+                print(f"Successfully processed entry: {entry.title}")
+                self.failures.record_success(entry.id)
+                succeeded.append(entry.id)
+
+        # フラグの更新が最後の手順なので、完了したエントリーはジャーナルから外す
+        self.journal.finish(succeeded)
+        self._mark_written(succeeded)
+        return len(succeeded)
+
+    def _record_failure(self, entry: ScheduleEntity, step: str, response: Response):
+        reason = f"{response.error_code}: {response.error_message}"
+        # リレーションの上限は再試行しても解消しないため、最長の間隔を空ける
+        retry_after = self.failures.max_delay if response.error_code == "RELATION_LIMIT_EXCEEDED" else None
+        self.failures.record_failure(entry.id, entry.last_edited_time, reason, entry.title, retry_after)
+        self.journal.failed(step, entry.id)
+
+    def _process_batch(self, entries: List[ScheduleEntity],
+                       executor: Optional[ThreadPoolExecutor] = None) -> int:
+        """1ページ分のエントリーを顧問先ごとにまとめて処理し、成功件数を返す
+
+        親タスク → 工数（顧問先ごと）→ フラグの順に、それぞれまとめて更新する。
+        executorが渡された場合は親タスク・顧問先・エントリー単位で並列に処理する。
+        """
+        entries = self._update_parents(entries, executor)
+
+        by_client: Dict[str, List[ScheduleEntity]] = {}
+        for entry in entries:
+            by_client.setdefault(entry.client_id, []).append(entry)
+
+        if executor is None:
+            ready = [entry for client_id, client_entries in by_client.items()
+                     for entry in self._process_client_entries(client_id, client_entries)]
+        else:
+            futures = [executor.submit(self._process_client_entries, client_id, client_entries)
+                       for client_id, client_entries in by_client.items()]
+            ready = [entry for future in futures for entry in future.result()]
+
+        return self._update_flags(ready, executor)
+
+    def _owned_entries(self, entries: List[ScheduleEntity]) -> List[ScheduleEntity]:
+        """リースを持つパーティションの顧問先のエントリーのみを返す（他のワーカーが処理する）"""
+        if self.leases is None:
+            return entries
+        return [entry for entry in entries if self.leases.owns(entry.client_id)]
+
+    def _mark_written(self, page_ids: List[str]):
+        now = time.monotonic()
+        with self._recent_writes_lock:
+            for page_id in page_ids:
+                self._recent_writes[page_id] = now
+                self._recent_writes.move_to_end(page_id)
+            # 古いものから捨てる
+            while self._recent_writes and next(iter(self._recent_writes.values())) < now - self.RECENT_WRITE_TTL:
+                self._recent_writes.popitem(last=False)
+
+    def _written_recently(self, page_id: str) -> bool:
+        written = self._recent_writes.get(page_id)
+        return written is not None and written >= time.monotonic() - self.RECENT_WRITE_TTL
+
+    def get_task_page(self, page_id: str) -> Optional[ScheduleEntity]:
+        """タスクのページを取得（未処理のタスクでない場合はNone）"""
+        response = self.transport.get(f"pages/{page_id}", operation="get_page")
+        if response.status_code != 200:
+            print(f"Error fetching page {page_id}: {response.text}")
+            return None
+
+        page = parse_json(response)
+        database_id = (page.get("parent") or {}).get("database_id", "")
+        if database_id.replace("-", "") != self.TASK_DB_ID.replace("-", ""):
+            return None
+        entry = self._parse_schedule_entry(page)
+        if entry.flag or not entry.client_id:
+            return None
+        return entry
+
+    def process_pages(self, page_ids: List[str], max_workers: Optional[int] = None) -> CycleStats:
+        """webhookで通知されたページのみを処理
+
+        直前に自分が書き込んだページ（フラグを立てたタスク・更新した親タスク）の通知は読み込まずに無視する。
+        """
+        started = time.monotonic()
+        max_workers = max_workers or self.max_workers
+        page_ids = [page_id for page_id in page_ids if not self._written_recently(page_id)]
+        stats = CycleStats()
+        if not page_ids:
+            return stats
+
+        # 工数集計インデックスを差分更新（親子関係のグラフは定期ポーリングで更新する）
+        self.refresh_summary_index()
+        self._parent_children = {}
+
+        executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+        try:
+            fetched = executor.map(self.get_task_page, page_ids) if executor else map(self.get_task_page, page_ids)
+            entries = self._owned_entries([entry for entry in fetched if entry is not None])
+            stats.entries = len(entries)
+            pending = [entry for entry in entries
+                       if not self.failures.should_skip(entry.id, entry.last_edited_time)]
+            stats.skipped = len(entries) - len(pending)
+            self._resolve_parents(pending)
+            stats.succeeded = self._process_batch(pending, executor)
+        finally:
+            if executor:
+                executor.shutdown()
+        self.failures.save()
+        self.journal.prune(lambda page_id: page_id in self.failures)
+        self.journal.compact()
+
+        stats.duration = time.monotonic() - started
+        if self.metrics:
+            self.metrics.on_cycle(stats.entries, stats.succeeded, stats.duration)
+        print(f"Processed {stats.entries} notified entries ({stats.succeeded} succeeded, "
+              f"{stats.skipped} skipped) in {stats.duration:.2f}s")
+        return stats
+
+    def recover(self) -> int:
+        """前回の実行が途中で停止した場合に、ジャーナルに残っている未完了の手順のみを再実行する"""
+        unfinished = self.journal.unfinished()
+        if not unfinished:
+            return 0
+
+        print(f"Replaying {len(unfinished)} unfinished entries from the journal")
+        entries = [ScheduleEntity(page_id, client_id=data["client_id"],
+                                  parent_task_id=data["parent_task_id"])
+                   for page_id, data in unfinished.items()]
+        # リースを持たない顧問先のエントリーはジャーナルに残し、担当のワーカーに任せる
+        entries = self._owned_entries(entries)
+        succeeded = self._process_batch(entries)
+        self.journal.compact()
+        return succeeded
+
+    def process_new_entries(self, max_workers: Optional[int] = None,
+                            max_batches: Optional[int] = None) -> CycleStats:
+        """新規エントリーの処理
+
+        max_batchesを指定した場合はクエリのページ数がそれに達した時点でサイクルを終え、
+        残りは次のサイクルで処理する（複数テナントを交互に処理する場合に使う）。
+        """
+        started = time.monotonic()
+        max_workers = max_workers or self.max_workers
+
+        gained = set()
+        if self.leases:
+            # 書き込み中でないサイクルの開始時に取り分を超えたリースを手放し、空いているパーティションを取得する
+            partitions = self.leases.heartbeat(rebalance=True)
+            gained = partitions - self._lease_partitions
+            self._lease_partitions = partitions
+            if gained:
+                # 引き継いだ顧問先の集計ページは他のワーカーが書き込んでいるため、キャッシュを破棄して読み直す
+                self.summary_index.invalidate_where(
+                    lambda client_id: partition_of(client_id, self.leases.partitions) in gained)
+
+        # 工数集計インデックスとタスクの親子関係のグラフを差分更新
+        self.refresh_summary_index()
+        self.refresh_task_graph()
+        # 親タスクの子タスクは毎サイクル読み直す（サイクル中に手動で変更された場合に備える）
+        self._parent_children = {}
+
+        # 差分ポーリング時は前回の最高水位以降のみ取得（定期的に全件検索も行う）
+        since = None
+        full_sweep = False
+        if self.poll_state:
+            full_sweep = self.poll_state.full_sweep_due(self.full_sweep_interval)
+            since = None if full_sweep else self.poll_state.watermark
+
+        if self.poll_state and gained:
+            # 引き継いだパーティションのエントリーは最高水位より前に編集されている場合があるため全件検索する
+            full_sweep = True
+            since = None
+
+        stats = CycleStats()
+        stopped_early = False
+        failed = []
+        batches = self.iter_new_schedule_batches(since=since, failed=failed)
+        executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+        try:
+            for count, batch in enumerate(batches, 1):
+                stats.has_more = stats.has_more or len(batch) >= (self.page_size or 100)
+                owned = self._owned_entries(batch)
+                stats.entries += len(owned)
+                # 失敗を繰り返しているエントリーは再試行時刻まで（またはページが編集されるまで）見送る
+                pending = [entry for entry in owned
+                           if not self.failures.should_skip(entry.id, entry.last_edited_time)]
+                stats.skipped += len(owned) - len(pending)
+                self._resolve_parents(pending)
+                stats.succeeded += self._process_batch(pending, executor)
+                if self.poll_state:
+                    for entry in batch:
+                        self.poll_state.advance(entry.last_edited_time)
+                if max_batches and count >= max_batches and stats.has_more:
+                    stopped_early = True
+                    break
+        finally:
+            if executor:
+                executor.shutdown()
+
+        if self.poll_state:
+            # 途中でエラーになった全件検索は完了扱いにせず、次のサイクルでやり直す
+            # （最高水位は読めたページまでしか進めていないため、未読のページは次のサイクルで取得される）
+            if full_sweep and not stopped_early and not failed:
+                self.poll_state.last_full_sweep = time.time()
+            self.poll_state.save()
+        self.failures.save()
+        self.journal.prune(lambda page_id: page_id in self.failures)
+        self.journal.compact()
+
+        stats.duration = time.monotonic() - started
+        if self.metrics:
+            self.metrics.on_cycle(stats.entries, stats.succeeded, stats.duration)
+        print(f"Processed {stats.entries} new entries ({stats.succeeded} succeeded, "
+              f"{stats.skipped} skipped) in "
+              f"{stats.duration:.2f}s ({stats.throughput:.1f} entries/s)")
+        return stats
+
+    def _scan_tasks_for_reconcile(self):
+        """タスクDB全体から、顧問先ID → タスクID・フラグが立っていないタスクID・その親タスクIDを集める"""
+        url = f"databases/{self.TASK_DB_ID}/query"
+        property_ids = self._projection(self.TASK_DB_ID, [
+            self.task_properties['client'], self.task_properties['flag'], self.task_properties['parent_task']])
+        expected: Dict[str, List[str]] = {}
+        unflagged = set()
+        # フラグが立っていないタスクID → 親タスクID
+        parents: Dict[str, str] = {}
+        scanned = 0
+        failed = []
+        for results in self._iter_query_pages(
+                url, {}, 100, "tasks for reconcile", "query_tasks", property_ids, failed):
+            for result in results:
+                entry = self._parse_schedule_entry(result)
+                scanned += 1
+                if not entry.client_id:
+                    continue
+                expected.setdefault(entry.client_id, []).append(entry.id)
+                if not entry.flag:
+                    unflagged.add(entry.id)
+                    if entry.parent_task_id:
+                        parents[entry.id] = entry.parent_task_id
+        if failed:
+            # 途中までの結果で突き合わせると、読めなかったタスクを余分として外してしまう
+            raise RuntimeError(f"Failed to scan tasks: {failed[0].text}")
+        return expected, unflagged, parents, scanned
+
+    def _scan_summaries_for_reconcile(self):
+        """工数集計DB全体から、顧問先ID → (集計ページID, 予定の全ID)を集める"""
+        url = f"databases/{self.WORKLOAD_SUMMARY_DB_ID}/query"
+        property_ids = self._projection(self.WORKLOAD_SUMMARY_DB_ID, [
+            self.workload_properties['client'], self.workload_properties['task']])
+        summaries = {}
+        failed = []
+        for results in self._iter_query_pages(
+                url, {}, 100, "workload summaries for reconcile", "query_summary", property_ids, failed):
+            for page in results:
+                entry = SummaryEntry.from_page(page, self.workload_properties['task'])
+                error = self._load_summary_tasks(entry)
+                if error:
+                    raise RuntimeError(f"Failed to read 予定 of {entry.page_id}: {error.error_message}")
+                clients = page.get("properties", {}).get(self.workload_properties['client'], {}).get("relation", [])
+                for client in clients:
+                    summaries.setdefault(client.get("id", ""), (entry.page_id, list(entry.task_ids)))
+        if failed:
+            raise RuntimeError(f"Failed to scan workload summaries: {failed[0].text}")
+        return summaries
+
+    def reconcile(self, apply: bool = False, prune: bool = False,
+                  checkpoint_path: Optional[str] = None) -> Optional[ReconcileReport]:
+        """タスクDBと工数集計DBを突き合わせ、予定の不足（pruneの場合は余分も）を最小限の書き込みで直す
+
+        applyがFalseの場合は差分を表示するだけで書き込まない。
+        checkpoint_pathを指定すると書き込み計画と進捗を保存し、中断した場合は再スキャンせずに続きから書き込む
+        （別のデータベースの組や古い計画のファイルからは再開せずNoneを返す）。
+        親タスクがあるタスクは、親タスクの子タスクに追加してからフラグを立てる。
+        実行中の常駐プロセスはキャッシュした予定で上書きする可能性があるため、停止してから実行する。
+        """
+        checkpoint = ReconcileCheckpoint(checkpoint_path if apply else None)
+        # スキャン時点の予定（続きから書き込む場合は書き込み前に読み直す）
+        scanned: Dict[str, List[str]] = {}
+
+        if checkpoint.active:
+            reason = checkpoint.stale_reason(self.TASK_DB_ID, self.WORKLOAD_SUMMARY_DB_ID)
+            if reason:
+                print(f"Refusing to resume reconcile from {checkpoint_path}: {reason}. "
+                      f"Delete the file or pass another --checkpoint to start over.")
+                return None
+            print(f"Resuming reconcile from {checkpoint_path} ({len(checkpoint.done)} writes already done)")
+        else:
+            # タスクDBと工数集計DBを並列に読み込む
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                tasks = executor.submit(self._scan_tasks_for_reconcile)
+                summaries_future = executor.submit(self._scan_summaries_for_reconcile)
+                expected, unflagged, parents, tasks_scanned = tasks.result()
+                summaries = summaries_future.result()
+
+            report, plan, flags = build_plan(expected, summaries, unflagged, prune)
+            report.tasks_scanned = tasks_scanned
+            report.summaries_scanned = len({page_id for page_id, _ in summaries.values()})
+            print(report.format())
+            if not apply:
+                return report
+            checkpoint.start(report, plan, flags,
+                             {task_id: parents[task_id] for task_id in flags if task_id in parents},
+                             self.TASK_DB_ID, self.WORKLOAD_SUMMARY_DB_ID)
+            scanned = {page_id: task_ids for page_id, task_ids in summaries.values()}
+
+        report = checkpoint.report
+        try:
+            for page_id, item in checkpoint.pending_summaries():
+                error = self._reconcile_summary(page_id, item, scanned.get(page_id))
+                if error and error.status_code not in self.PERMANENT_ERROR_STATUSES:
+                    # 一時的なエラーは中断し、再実行時にこのページから書き込む
+                    print(f"Failed to reconcile workload summary {page_id}: {error.error_message}")
+                    return report
+                if error:
+                    print(f"Skipping workload summary {page_id}: {error.error_code}: {error.error_message}")
+                    report.summaries_failed[page_id] = f"{error.error_code}: {error.error_message}"
+                else:
+                    report.summaries_patched += 1
+                checkpoint.mark_done(f"summary:{page_id}")
+
+            # 予定に追加できなかったタスクはフラグを立てずに残す（通常の処理で失敗として記録される）
+            unsummarized = {task_id for page_id in report.summaries_failed
+                            for task_id in checkpoint.summaries.get(page_id, {}).get("add", ())}
+            pending_flags = checkpoint.pending_flags()
+            by_parent: Dict[str, List[ScheduleEntity]] = {}
+            for task_id in pending_flags:
+                parent_task_id = checkpoint.parents.get(task_id)
+                if parent_task_id:
+                    by_parent.setdefault(parent_task_id, []).append(
+                        ScheduleEntity(task_id, parent_task_id=parent_task_id))
+            # フラグを立てると通常の処理で親タスクが更新されなくなるため、先に子タスクに追加する
+            unparented = set()
+            for parent_task_id, children in by_parent.items():
+                children = [child for child in children if child.id not in unsummarized]
+                if not children:
+                    continue
+                parent_response = self.update_parent_tasks(parent_task_id, children)
+                if parent_response.status_code != 200:
+                    # フラグを立てずに残し、通常の処理（失敗の記録と再試行）に任せる
+                    print(f"Failed to update parent task {parent_task_id}, leaving {len(children)} tasks "
+                          f"unflagged: {parent_response.error_message}")
+                    unparented.update(child.id for child in children)
+
+            for task_id in pending_flags:
+                if task_id in unparented or task_id in unsummarized:
+                    report.flags_skipped += 1
+                    checkpoint.mark_done(f"flag:{task_id}")
+                    continue
+                flag_response = self.update_schedule_flag(ScheduleEntity(task_id))
+                if flag_response.status_code != 200:
+                    print(f"Failed to update flag for entry {task_id}: {flag_response.error_message}")
+                    return report
+                report.flags_patched += 1
+                checkpoint.mark_done(f"flag:{task_id}")
+        finally:
+            # 中断した場合も進捗を保存しておく
+            checkpoint.save()
+
+        checkpoint.finish()
+        print(f"Reconciled {report.summaries_patched} workload summaries and {report.flags_patched} flags "
+              f"({len(report.summaries_failed)} summaries failed, {report.flags_skipped} tasks left unflagged)")
+        return report
+
+    def _reconcile_summary(self, page_id: str, item: dict,
+                           current: Optional[List[str]] = None) -> Optional[Response]:
+        """集計ページの予定に不足分を追加し、余分を外す"""
+        with self._page_locks.hold(page_id):
+            if current is None:
+                summary = SummaryEntry(page_id, complete=False)
+                error = self._load_summary_tasks(summary)
+                if error:
+                    return error
+                current = summary.task_ids
+
+            task_ids = RelationIds(current)
+            for task_id in item["add"]:
+                task_ids.add(task_id)
+            remove = set(item["remove"])
+            if remove:
+                task_ids = RelationIds(task_id for task_id in task_ids if task_id not in remove)
+            if list(task_ids) == list(current):
+                return None
+            error = self._check_relation_limit(page_id, self.workload_properties['task'], task_ids)
+            if error:
+                return error
+
+            payload = {
+                "properties": {
+                    self.workload_properties['task']: {
+                        "relation": task_ids.to_relation()
+                    }
+                }
+            }
+            response = self.transport.patch(f"pages/{page_id}", json=payload, operation="patch_summary")
+            if response.status_code != 200:
+                return Response(
+                    status_code=response.status_code,
+                    error_code="UPDATE_FAILED",
+                    error_message=response.text
+                )
+
+        # 書き込んだ顧問先のインデックスは読み直す
+        for client_id in item["client_ids"]:
+            self.summary_index.invalidate(client_id)
+        return None
+
+    def run(self, interval: int = 15, max_workers: Optional[int] = None,
+            min_interval: float = 1.0, max_interval: float = 120.0):
+        """メインの実行ループ
+
+        ポーリング間隔はintervalから始め、処理結果に応じて
+        min_interval〜max_intervalの範囲で調整する。
+        """
+        if max_workers:
+            self.max_workers = max_workers
+        self.scheduler = AdaptivePollScheduler(interval, min_interval, max_interval)
 
-    def run(self, interval: int = 15):
-        """メインの実行ループ"""
         print("Starting Notion Workload Manager...")
         print(f"Task DB ID: {self.TASK_DB_ID}")
         print(f"Workload Summary DB ID: {self.WORKLOAD_SUMMARY_DB_ID}")
+        print(f"Workers: {self.max_workers}")
 
         # 起動時にデータベースプロパティを確認
         self.get_database_properties()
+        # 前回の実行で途中になった書き込みを完了させる
+        self.recover()
 
         while True:
             print(f"\nProcessing new entries at {datetime.now()}")
-            self.process_new_entries()
-            time.sleep(interval)
+            throttled_before = self.transport.throttled
+            stats = self.process_new_entries()
+
+            delay = self.scheduler.next_delay(
+                stats.entries, stats.has_more,
+                throttled=self.transport.throttled > throttled_before,
+                duration=stats.duration)
+            print(f"Next poll in {delay:.1f}s (interval: {self.scheduler.interval:.1f}s)")
+            time.sleep(delay)
+
+    def run_with_webhook(self, receiver: WebhookReceiver, poll_interval: float = 300.0,
+                         debounce: float = 0.05, max_workers: Optional[int] = None):
+        """webhookで通知されたページを即時に処理する実行ループ
+
+        通知の取りこぼしに備えて、poll_interval秒ごとに通常のポーリングも行う。
+        """
+        if max_workers:
+            self.max_workers = max_workers
+
+        print("Starting Notion Workload Manager (webhook mode)...")
+        print(f"Listening for webhooks on {receiver.url}")
+        print(f"Fallback poll interval: {poll_interval:.0f}s")
+
+        self.get_database_properties()
+        self.recover()
+
+        next_poll = time.monotonic()
+        while True:
+            if receiver.pending.ready.wait(max(0.0, next_poll - time.monotonic())):
+                # 同時に届いた通知をまとめて処理する
+                time.sleep(debounce)
+                self.process_pages(receiver.pending.drain())
+
+            if time.monotonic() >= next_poll:
+                print(f"\nFallback poll at {datetime.now()}")
+                self.process_new_entries()
+                next_poll = time.monotonic() + poll_interval
+
+
+def build_tenant_manager(config: TenantConfig, transport: NotionTransport,
+                         metrics: Metrics) -> NotionWorkloadManagement:
+    """MultiTenantRunner用のテナントのマネージャーを生成"""
+    return NotionWorkloadManagement(
+        config.api_key, config.task_db_id, config.summary_db_id,
+        transport=transport,
+        state_path=config.state_path,
+        full_sweep_interval=float(os.getenv("FULL_SWEEP_INTERVAL", "3600")),
+        metrics=metrics,
+        schema_cache_path=config.schema_cache_path,
+        failure_ledger_path=config.failure_ledger_path,
+        journal_path=config.journal_path
+    )
 
 
 if __name__ == "__main__":
+    # TENANTS_PATHを指定した場合は設定ファイルの全テナントを1つのプロセスで処理する
+    if os.getenv("TENANTS_PATH"):
+        runner = MultiTenantRunner(
+            load_tenants(os.getenv("TENANTS_PATH")), build_tenant_manager,
+            max_workers=int(os.getenv("MAX_WORKERS", "4")),
+            max_batches=int(os.getenv("TENANT_MAX_BATCHES", "5")),
+            min_interval=float(os.getenv("POLL_MIN_INTERVAL", "1")),
+            max_interval=float(os.getenv("POLL_MAX_INTERVAL", "120"))
+        )
+        print(f"Starting Notion Workload Manager for {len(runner.tenants)} tenants...")
+        if os.getenv("METRICS_PORT"):
+            MetricsServer(runner.metrics, port=int(os.getenv("METRICS_PORT"))).start()
+        runner.run()
+        exit(0)
+
     NOTION_API_KEY = os.getenv("NOTION_API_KEY")
     TASK_DB_ID = os.getenv("TASK_DB_ID")
     WORKLOAD_SUMMARY_DB_ID = os.getenv("WORKLOAD_SUMMARY_DB_ID")
@@ -325,7 +1355,57 @@ if __name__ == "__main__":
               bool(WORKLOAD_SUMMARY_DB_ID)}")
         exit(1)
 
+    # METRICS_PORTを指定した場合のみ計測し、/metrics と /metrics.json で公開する
+    metrics = None
+    if os.getenv("METRICS_PORT"):
+        metrics = Metrics()
+        MetricsServer(metrics, port=int(os.getenv("METRICS_PORT"))).start()
+
+    # LEASE_PATHを指定した場合は同じファイルを指定した複数のワーカーで顧問先を分担する
+    leases = None
+    if os.getenv("LEASE_PATH"):
+        leases = LeaseStore(
+            os.getenv("LEASE_PATH"), worker_id=os.getenv("WORKER_ID"),
+            partitions=int(os.getenv("LEASE_PARTITIONS", "16")),
+            ttl=float(os.getenv("LEASE_TTL", "30"))).start()
+        # 終了時にリースを手放し、他のワーカーがすぐに引き継げるようにする
+        atexit.register(leases.stop)
+
     workload_manager = NotionWorkloadManagement(
-        NOTION_API_KEY, TASK_DB_ID, WORKLOAD_SUMMARY_DB_ID
+        NOTION_API_KEY, TASK_DB_ID, WORKLOAD_SUMMARY_DB_ID,
+        state_path=os.getenv("POLL_STATE_PATH"),
+        full_sweep_interval=float(os.getenv("FULL_SWEEP_INTERVAL", "3600")),
+        metrics=metrics,
+        schema_cache_path=os.getenv("SCHEMA_CACHE_PATH"),
+        failure_ledger_path=os.getenv("FAILURE_LEDGER_PATH"),
+        journal_path=os.getenv("JOURNAL_PATH"),
+        leases=leases
+    )
+
+    # python Notion_manage.py reconcile [--apply] [--prune] [--checkpoint PATH]
+    # タスクDBと工数集計DBを突き合わせて予定の差分を表示（--applyで書き込み）
+    if sys.argv[1:2] == ["reconcile"]:
+        parser = argparse.ArgumentParser(prog="Notion_manage.py reconcile")
+        parser.add_argument("--apply", action="store_true", help="差分を書き込む（指定しない場合は表示のみ）")
+        parser.add_argument("--prune", action="store_true", help="その顧問先のタスクではない予定を外す")
+        parser.add_argument("--checkpoint", default="reconcile_checkpoint.json",
+                            help="書き込み計画と進捗の保存先（中断した場合は続きから書き込む）")
+        args = parser.parse_args(sys.argv[2:])
+        workload_manager.reconcile(apply=args.apply, prune=args.prune, checkpoint_path=args.checkpoint)
+        exit(0)
+
+    # WEBHOOK_PORTを指定した場合は通知されたページを即時に処理し、ポーリングは取りこぼし対策として間隔を空けて行う
+    if os.getenv("WEBHOOK_PORT"):
+        receiver = WebhookReceiver(
+            host=os.getenv("WEBHOOK_HOST", "127.0.0.1"), port=int(os.getenv("WEBHOOK_PORT")),
+            secret=os.getenv("WEBHOOK_SECRET"), database_id=TASK_DB_ID).start()
+        workload_manager.run_with_webhook(
+            receiver,
+            poll_interval=float(os.getenv("WEBHOOK_POLL_INTERVAL", "300")),
+            max_workers=int(os.getenv("MAX_WORKERS", "1")))
+
+    workload_manager.run(
+        max_workers=int(os.getenv("MAX_WORKERS", "1")),
+        min_interval=float(os.getenv("POLL_MIN_INTERVAL", "1")),
+        max_interval=float(os.getenv("POLL_MAX_INTERVAL", "120"))
     )
-    workload_manager.run()
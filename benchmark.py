@@ -0,0 +1,217 @@
+"""process_new_entries のスループット・レイテンシを計測するベンチマーク
+
+FakeNotionServer を別プロセスで起動し、未処理タスクを用意した状態で
+1. 溜まったタスクを全て処理するまで（entries/s、1エントリーあたりのAPI呼び出し数）
+2. 毎サイクル少数のタスクが追加される定常状態（サイクルのp50/p99レイテンシ）
+を計測する。--parseを指定した場合はクエリ結果のJSON解析とScheduleEntityへの変換のみを
+計測する（1ページあたりのマイクロ秒とエンティティ1件あたりのメモリ）。
+結果は bench_baseline.json と比較して表示する。
+
+    python benchmark.py --tasks 1000 10000 50000
+    python benchmark.py --tasks --parse 10000
+    python benchmark.py --tasks 1000 --latency 0.05 --workers 4
+    python benchmark.py --tasks 1000 10000 --save-baseline
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import time
+import tracemalloc
+from typing import Dict, List
+
+from fake_notion_server import RELATION_LIMIT, FakeNotionServer
+from notion_manage import NotionWorkloadManagement
+from notion_transport import NotionTransport, RateLimiter, json_loads
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# 値が大きいほど良い指標（それ以外は小さいほど良い）
+HIGHER_IS_BETTER = {"entries_per_second"}
+
+
+def _serve(conn, options: dict):
+    """子プロセス側でFakeNotionServerを動かし、親プロセスからの命令を処理する"""
+    server = FakeNotionServer(**options).start()
+    conn.send(server.url)
+    while True:
+        command, args = conn.recv()
+        if command == "stop":
+            server.stop()
+            conn.send(None)
+            return
+        if command == "stats":
+            conn.send({"calls": dict(server.calls), "requests": sum(server.status_codes.values())})
+            continue
+        conn.send(getattr(server, command)(*args))
+
+
+class ServerProcess:
+    """別プロセスで動くFakeNotionServer（サーバーのメモリを計測対象から外すため）"""
+
+    def __init__(self, **options):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_serve, args=(child_conn, options), daemon=True)
+        self._process.start()
+        self.url = self._conn.recv()
+
+    def call(self, command: str, *args):
+        self._conn.send((command, args))
+        return self._conn.recv()
+
+    def stop(self):
+        self.call("stop")
+        self._process.join()
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(percentile / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def _peak_rss_mb() -> float:
+    # Linuxではキロバイト、macOSではバイト単位
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+
+
+def run_benchmark(tasks: int, clients: int, cycles: int, arrivals: int, latency: float,
+                  throttle_rate: float, workers: int, rate: float) -> Dict[str, float]:
+    # 顧問先あたりのタスクが予定のリレーションの上限（100件）を超えないように顧問先を増やす
+    clients = max(clients, -(-tasks * 2 // RELATION_LIMIT))
+    server = ServerProcess(latency=latency, throttle_rate=throttle_rate, retry_after=0.05, seed=tasks)
+    try:
+        seeded = server.call("seed_workload", tasks, clients, 0.2)
+
+        manager = NotionWorkloadManagement(
+            "benchmark", seeded["task_db_id"], seeded["summary_db_id"], max_workers=workers)
+        manager.transport = NotionTransport(
+            manager.headers, base_url=server.url, pool_size=max(10, workers * 2),
+            rate_limiter=RateLimiter(rate=rate, burst=max(1, int(rate))) if rate else None,
+            backoff_base=0.01)
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            # 溜まったタスクを全て処理
+            server.call("reset_stats")
+            started = time.monotonic()
+            drained = 0
+            while True:
+                stats = manager.process_new_entries()
+                drained += stats.succeeded
+                if stats.entries == 0 or stats.succeeded == 0:
+                    break
+            drain_duration = time.monotonic() - started
+            drain_requests = server.call("stats")["requests"]
+
+            # 定常状態（毎サイクルarrivals件のタスクが追加される）
+            cycle_durations = []
+            for _ in range(cycles):
+                server.call("add_tasks", seeded["task_db_id"], arrivals, seeded["client_ids"],
+                            seeded["parent_ids"], 0.2)
+                cycle_durations.append(manager.process_new_entries().duration)
+
+        return {
+            "entries_per_second": drained / drain_duration if drain_duration else 0.0,
+            "api_calls_per_entry": drain_requests / drained if drained else 0.0,
+            "cycle_p50_seconds": _percentile(cycle_durations, 50),
+            "cycle_p99_seconds": _percentile(cycle_durations, 99),
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+    finally:
+        server.stop()
+
+
+def run_parse_benchmark(pages: int, repeat: int = 5) -> Dict[str, float]:
+    """クエリ結果のJSON解析とScheduleEntityへの変換のみを計測"""
+    server = FakeNotionServer(seed=pages)
+    try:
+        seeded = server.seed_workload(pages, 200, 0.5)
+        results = [server._render_page(server.pages[page_id])
+                   for page_id in server._rows[seeded["task_db_id"]]][-pages:]
+    finally:
+        server.server_close()
+    body = json.dumps({"results": results}, ensure_ascii=False).encode("utf-8")
+    manager = NotionWorkloadManagement("benchmark", seeded["task_db_id"], seeded["summary_db_id"])
+
+    def timed(func) -> float:
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    decoded = json_loads(body)["results"]
+    decode_seconds = timed(lambda: json_loads(body))
+    parse_seconds = timed(lambda: [manager._parse_schedule_entry(result) for result in decoded])
+
+    tracemalloc.start()
+    entities = [manager._parse_schedule_entry(result) for result in decoded]
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "json_decode_us_per_page": decode_seconds / pages * 1e6,
+        "parse_us_per_page": parse_seconds / pages * 1e6,
+        "entity_bytes": allocated / len(entities),
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]):
+    """ベースラインとの比較を表示"""
+    for size, metrics in results.items():
+        print(f"\n[{size.replace('_', ' ')} {'pages' if size.startswith('parse') else 'tasks'}]")
+        for name, value in metrics.items():
+            line = f"  {name:<22} {value:>12.3f}"
+            base = baseline.get(size, {}).get(name)
+            if base:
+                change = (value - base) / base * 100
+                better = change > 0 if name in HIGHER_IS_BETTER else change < 0
+                line += f"   baseline {base:>12.3f}  ({change:+.1f}%{' better' if better else ''})"
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Notion workload manager benchmark")
+    parser.add_argument("--tasks", type=int, nargs="*", default=[1000, 10000, 50000])
+    parser.add_argument("--parse", type=int, nargs="*", default=[], help="解析のみを計測するページ数")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--cycles", type=int, default=20, help="定常状態で計測するサイクル数")
+    parser.add_argument("--arrivals", type=int, default=50, help="定常状態で毎サイクル追加するタスク数")
+    parser.add_argument("--latency", type=float, default=0.0, help="1リクエストあたりの応答遅延（秒）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="429を返す確率")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--rate", type=float, default=0.0, help="クライアント側のレート制限（0で無効）")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    results = {}
+    for tasks in args.tasks:
+        results[str(tasks)] = run_benchmark(
+            tasks, args.clients, args.cycles, args.arrivals, args.latency,
+            args.throttle_rate, args.workers, args.rate)
+    for pages in args.parse:
+        results[f"parse_{pages}"] = run_parse_benchmark(pages)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    compare(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"\nSaved baseline to {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
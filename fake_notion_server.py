@@ -0,0 +1,439 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+# 1回のリクエストで設定できるリレーション先の件数の上限（Notion APIのリクエスト制限）
+RELATION_LIMIT = 100
+
+TASK_SCHEMA = {
+    '名前': ("title", "title"),
+    'フラグ': ("fl%3Ag", "checkbox"),
+    '顧問先リスト': ("cl%3Ai", "relation"),
+    '工数': ("wo%3Ar", "number"),
+    'ステータス': ("st%3At", "status"),
+    '開始日': ("st%3Ad", "date"),
+    '終了日': ("en%3Ad", "date"),
+    '親タスク': ("pa%3Ar", "rollup"),
+    '子タスク': ("ch%3Ai", "relation"),
+}
+
+SUMMARY_SCHEMA = {
+    '名前': ("title", "title"),
+    '予定': ("ta%3As", "relation"),
+    '顧客先DB': ("cu%3As", "relation"),
+    '工数集計': ("su%3Am", "rollup"),
+}
+
+
+def _now_iso() -> str:
+    moment = datetime.now(timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03d}Z"
+
+
+def _new_id() -> str:
+    return str(uuid.uuid4())
+
+
+class FakeNotionServer(ThreadingHTTPServer):
+    """ローカルで動くNotion APIの代替サーバー（テスト・ベンチマーク用）
+
+    このモジュールが使うエンドポイントのみを実装する。
+    - GET   /v1/databases/{id}
+    - POST  /v1/databases/{id}/query（cursor・filter・sorts・filter_properties）
+    - GET   /v1/pages/{id}
+    - PATCH /v1/pages/{id}
+    - GET   /v1/pages/{id}/properties/{property_id}
+    latencyで応答を遅らせ、throttle_rateの確率で429を返し、
+    クエリ結果のリレーションはrelation_limit件で切り詰める（Notionと同じ25件が既定値）。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0, relation_limit: int = 25,
+                 seed: Optional[int] = None):
+        super().__init__((host, port), _FakeNotionHandler)
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.relation_limit = relation_limit
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self.databases: Dict[str, dict] = {}
+        self.pages: Dict[str, dict] = {}
+        self._rows: Dict[str, List[str]] = {}
+        self._snapshots = OrderedDict()
+        self.calls = Counter()
+        self.status_codes = Counter()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeNotionServer":
+        """バックグラウンドのスレッドでサーバーを起動"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    # --- データの用意 ---
+
+    def create_database(self, schema: Dict[str, tuple], database_id: Optional[str] = None) -> str:
+        database_id = database_id or _new_id()
+        with self._lock:
+            self.databases[database_id] = {
+                "object": "database",
+                "id": database_id,
+                "properties": {
+                    name: {"id": property_id, "name": name, "type": property_type}
+                    for name, (property_id, property_type) in schema.items()
+                }
+            }
+            self._rows[database_id] = []
+        return database_id
+
+    def create_page(self, database_id: str, values: Dict[str, object],
+                    last_edited_time: Optional[str] = None) -> str:
+        """ページを作成。valuesはプロパティ名 → 型ごとの値"""
+        page_id = _new_id()
+        schema = self.databases[database_id]["properties"]
+        properties = {}
+        for name, info in schema.items():
+            property_type = info["type"]
+            properties[name] = {
+                "id": info["id"],
+                "type": property_type,
+                property_type: values.get(name, self._empty_value(property_type))
+            }
+        timestamp = last_edited_time or _now_iso()
+        with self._lock:
+            self.pages[page_id] = {
+                "object": "page",
+                "id": page_id,
+                "created_time": timestamp,
+                "last_edited_time": timestamp,
+                "parent": {"type": "database_id", "database_id": database_id},
+                "properties": properties
+            }
+            self._rows[database_id].append(page_id)
+        return page_id
+
+    @staticmethod
+    def _empty_value(property_type: str):
+        if property_type in ("title", "rich_text", "relation"):
+            return []
+        if property_type == "checkbox":
+            return False
+        if property_type == "rollup":
+            return {"type": "array", "array": []}
+        return None
+
+    def seed_workload(self, tasks: int, clients: int, parent_ratio: float = 0.0,
+                      existing_tasks_per_client: int = 0) -> Dict[str, object]:
+        """タスクDBと工数集計DBを作成し、未処理のタスクを用意する"""
+        task_db_id = self.create_database(TASK_SCHEMA)
+        summary_db_id = self.create_database(SUMMARY_SCHEMA)
+        client_ids = [_new_id() for _ in range(clients)]
+        for index, client_id in enumerate(client_ids):
+            self.create_page(summary_db_id, {
+                '名前': [{"plain_text": f"Client {index}"}],
+                '顧客先DB': [{"id": client_id}],
+                '予定': [{"id": _new_id()} for _ in range(existing_tasks_per_client)],
+            })
+        # 親タスクあたりの子タスクがリレーションの上限の半分程度に収まるようにする
+        parents = max(1, clients // 10, -(-int(tasks * parent_ratio) * 2 // RELATION_LIMIT))
+        parent_ids = [self.create_page(task_db_id, {
+            '名前': [{"plain_text": f"Parent {index}"}],
+            'フラグ': True,
+        }) for index in range(parents)] if parent_ratio else []
+        self.add_tasks(task_db_id, tasks, client_ids, parent_ids, parent_ratio)
+        return {"task_db_id": task_db_id, "summary_db_id": summary_db_id,
+                "client_ids": client_ids, "parent_ids": parent_ids}
+
+    def add_tasks(self, task_db_id: str, count: int, client_ids: List[str],
+                  parent_ids: List[str] = (), parent_ratio: float = 0.0) -> List[str]:
+        """未処理（フラグ=false）のタスクを追加"""
+        task_ids = []
+        for index in range(count):
+            values = {
+                '名前': [{"plain_text": f"Task {index}"}],
+                '顧問先リスト': [{"id": self._random.choice(client_ids)}],
+                '工数': 1.5,
+                '開始日': {"start": "2024-11-01", "end": None},
+                '終了日': {"start": "2024-11-01", "end": "2024-11-02"},
+            }
+            if parent_ids and self._random.random() < parent_ratio:
+                values['親タスク'] = {"type": "array", "array": [
+                    {"type": "relation", "relation": {"id": self._random.choice(parent_ids)}}]}
+            task_ids.append(self.create_page(task_db_id, values))
+        return task_ids
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.status_codes.clear()
+
+    # --- APIの実装 ---
+
+    def handle_api(self, method: str, path: str, query: Dict[str, List[str]], body: Optional[dict]):
+        """(ステータスコード, レスポンス, 追加ヘッダー)を返す"""
+        # プロパティIDはURLエンコードされた形のまま扱う（Notionと同じ）
+        parts = path.strip("/").split("/")
+        if parts[:1] != ["v1"]:
+            return self._error(404, "object_not_found", "Unknown path")
+        parts = parts[1:]
+
+        if len(parts) == 2 and parts[0] == "databases" and method == "GET":
+            route = "GET /databases/{id}"
+            result = self._get_database(parts[1])
+        elif len(parts) == 3 and parts[0] == "databases" and parts[2] == "query" and method == "POST":
+            route = "POST /databases/{id}/query"
+            result = self._query_database(
+                parts[1], body or {}, {unquote(item) for item in query.get("filter_properties", [])})
+        elif len(parts) == 2 and parts[0] == "pages" and method == "GET":
+            route = "GET /pages/{id}"
+            result = self._get_page(parts[1])
+        elif len(parts) == 2 and parts[0] == "pages" and method == "PATCH":
+            route = "PATCH /pages/{id}"
+            result = self._patch_page(parts[1], body or {})
+        elif len(parts) == 4 and parts[0] == "pages" and parts[2] == "properties" and method == "GET":
+            route = "GET /pages/{id}/properties/{property_id}"
+            result = self._get_property_item(parts[1], parts[3], query)
+        else:
+            route = f"{method} unknown"
+            result = self._error(400, "invalid_request_url", "Invalid request URL.")
+
+        with self._lock:
+            self.calls[route] += 1
+        return result
+
+    def maybe_throttle(self):
+        """設定した確率で429を返す"""
+        if self.throttle_rate and self._random.random() < self.throttle_rate:
+            status, payload, _ = self._error(429, "rate_limited", "Rate limited")
+            return status, payload, {"Retry-After": str(self.retry_after)}
+        return None
+
+    @staticmethod
+    def _error(status: int, code: str, message: str):
+        return status, {"object": "error", "status": status, "code": code, "message": message}, {}
+
+    def _get_database(self, database_id: str):
+        database = self.databases.get(database_id)
+        if database is None:
+            return self._error(404, "object_not_found", f"Could not find database {database_id}")
+        return 200, database, {}
+
+    def _get_page(self, page_id: str):
+        page = self.pages.get(page_id)
+        if page is None:
+            return self._error(404, "object_not_found", f"Could not find page {page_id}")
+        return 200, self._render_page(page), {}
+
+    def _render_page(self, page: dict, property_ids: Optional[set] = None) -> dict:
+        """クエリ結果と同様にリレーションを切り詰めたページを返す"""
+        properties = {}
+        for name, value in page["properties"].items():
+            if property_ids and unquote(value["id"]) not in property_ids and name not in property_ids:
+                continue
+            if value["type"] == "relation" and len(value["relation"]) > self.relation_limit:
+                value = dict(value, relation=value["relation"][:self.relation_limit], has_more=True)
+            properties[name] = value
+        return dict(page, properties=properties)
+
+    def _query_database(self, database_id: str, body: dict, property_ids: set):
+        if database_id not in self.databases:
+            return self._error(404, "object_not_found", f"Could not find database {database_id}")
+
+        known_ids = {unquote(info["id"]) for info in self.databases[database_id]["properties"].values()}
+        if property_ids - known_ids:
+            return self._error(400, "validation_error", "Could not find property with id in filter_properties.")
+
+        page_size = min(int(body.get("page_size", 100)), 100)
+        cursor = body.get("start_cursor")
+        with self._lock:
+            if cursor:
+                token, _, offset = cursor.partition(":")
+                matched = self._snapshots.get(token)
+                if matched is None:
+                    return self._error(400, "validation_error", "Invalid start_cursor.")
+                offset = int(offset)
+            else:
+                try:
+                    matched = [page_id for page_id in self._rows[database_id]
+                               if self._matches(self.pages[page_id], body.get("filter"))]
+                except ValueError as e:
+                    return self._error(400, "validation_error", str(e))
+                for sort in body.get("sorts", []):
+                    key = sort.get("timestamp", "last_edited_time")
+                    matched.sort(key=lambda page_id: self.pages[page_id][key],
+                                 reverse=sort.get("direction") == "descending")
+                token = uuid.uuid4().hex
+                self._snapshots[token] = matched
+                while len(self._snapshots) > 64:
+                    self._snapshots.popitem(last=False)
+                offset = 0
+
+            page_ids = matched[offset:offset + page_size]
+            results = [self._render_page(self.pages[page_id], property_ids) for page_id in page_ids]
+
+        has_more = offset + page_size < len(matched)
+        return 200, {
+            "object": "list",
+            "results": results,
+            "next_cursor": f"{token}:{offset + page_size}" if has_more else None,
+            "has_more": has_more,
+            "type": "page_or_database",
+            "page_or_database": {}
+        }, {}
+
+    def _matches(self, page: dict, condition: Optional[dict]) -> bool:
+        """Notionのフィルター条件のうち、このモジュールで使うものを評価"""
+        if not condition:
+            return True
+        if "and" in condition:
+            return all(self._matches(page, item) for item in condition["and"])
+        if "or" in condition:
+            return any(self._matches(page, item) for item in condition["or"])
+        if "timestamp" in condition:
+            timestamp = page[condition["timestamp"]]
+            rule = condition[condition["timestamp"]]
+            if "on_or_after" in rule:
+                return timestamp >= rule["on_or_after"]
+            if "after" in rule:
+                return timestamp > rule["after"]
+            if "before" in rule:
+                return timestamp < rule["before"]
+            raise ValueError(f"Unsupported timestamp filter: {rule}")
+
+        value = page["properties"].get(condition.get("property"))
+        if value is None:
+            raise ValueError(f"Could not find property with name or id: {condition.get('property')}")
+        if "checkbox" in condition:
+            return value["checkbox"] == condition["checkbox"]["equals"]
+        if "relation" in condition:
+            rule = condition["relation"]
+            ids = [item["id"] for item in value["relation"]]
+            if "is_not_empty" in rule:
+                return bool(ids)
+            if "is_empty" in rule:
+                return not ids
+            if "contains" in rule:
+                return rule["contains"] in ids
+        raise ValueError(f"Unsupported filter: {condition}")
+
+    def _patch_page(self, page_id: str, body: dict):
+        with self._lock:
+            page = self.pages.get(page_id)
+            if page is None:
+                return self._error(404, "object_not_found", f"Could not find page {page_id}")
+
+            for name, update in body.get("properties", {}).items():
+                value = page["properties"].get(name)
+                if value is None:
+                    return self._error(400, "validation_error", f"{name} is not a property that exists.")
+                property_type = value["type"]
+                if property_type not in update:
+                    return self._error(400, "validation_error", f"{name} is expected to be {property_type}.")
+                if property_type == "relation" and len(update["relation"]) > RELATION_LIMIT:
+                    return self._error(400, "validation_error", (
+                        f"body failed validation: body.properties.{name}.relation.length "
+                        f"should be ≤ `{RELATION_LIMIT}`, instead was `{len(update['relation'])}`."))
+                page["properties"][name] = dict(value, **{property_type: update[property_type]})
+
+            page["last_edited_time"] = _now_iso()
+            return 200, self._render_page(page), {}
+
+    def _get_property_item(self, page_id: str, property_id: str, query: Dict[str, List[str]]):
+        page = self.pages.get(page_id)
+        if page is None:
+            return self._error(404, "object_not_found", f"Could not find page {page_id}")
+
+        value = next((item for item in page["properties"].values()
+                      if unquote(item["id"]) == unquote(property_id)), None)
+        if value is None:
+            return self._error(404, "object_not_found", f"Could not find property {property_id}")
+        if value["type"] != "relation":
+            return 200, {"object": "property_item", "id": property_id, "type": value["type"],
+                         value["type"]: value[value["type"]]}, {}
+
+        page_size = min(int(query.get("page_size", ["100"])[0]), 100)
+        offset = int(query.get("start_cursor", ["0"])[0])
+        relation = value["relation"]
+        items = relation[offset:offset + page_size]
+        has_more = offset + page_size < len(relation)
+        return 200, {
+            "object": "list",
+            "results": [{"object": "property_item", "id": property_id, "type": "relation",
+                         "relation": {"id": item["id"]}} for item in items],
+            "next_cursor": str(offset + page_size) if has_more else None,
+            "has_more": has_more,
+            "type": "property_item",
+            "property_item": {"id": property_id, "next_url": None, "type": "relation", "relation": {}}
+        }, {}
+
+
+class _FakeNotionHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # ヘッダーと本文を別々に書き込むため、Nagleによる遅延を避ける
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, method: str):
+        server: FakeNotionServer = self.server
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        parsed = urlparse(self.path)
+        throttled = server.maybe_throttle()
+        if throttled:
+            status, payload, headers = throttled
+        else:
+            try:
+                body = json.loads(raw_body) if raw_body else None
+            except ValueError:
+                body = None
+            status, payload, headers = server.handle_api(
+                method, parsed.path, parse_qs(parsed.query), body)
+
+        with server._lock:
+            server.status_codes[status] += 1
+
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PATCH(self):
+        self._handle("PATCH")
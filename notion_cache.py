@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+
+class RelationIds:
+    """リレーション先のページIDを保持する順序付き集合
+
+    追加と重複チェックをリストの走査無しで行えるように、dictのキーとして保持する。
+    """
+
+    __slots__ = ("_ids",)
+
+    def __init__(self, ids: Iterable[str] = ()):
+        self._ids = dict.fromkeys(ids)
+
+    def add(self, page_id: str) -> bool:
+        """IDを追加し、新しく追加された場合はTrueを返す"""
+        if page_id in self._ids:
+            return False
+        self._ids[page_id] = None
+        return True
+
+    def copy(self) -> "RelationIds":
+        copied = RelationIds()
+        copied._ids = self._ids.copy()
+        return copied
+
+    def to_relation(self) -> List[dict]:
+        """Notion APIのrelation形式に変換"""
+        return [{"id": page_id} for page_id in self._ids]
+
+    def __contains__(self, page_id: str) -> bool:
+        return page_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._ids)
+
+
+class SummaryEntry:
+    """工数集計DBの1ページ分のキャッシュ
+
+    completeがFalseの場合、task_idsはクエリ結果で切り詰められた一部のみを表す。
+    client_countは紐付いている顧問先の数（2以上の場合は複数のワーカーから書き込まれうる）。
+    """
+
+    def __init__(self, page_id: str, task_ids: Iterable[str] = (), last_edited_time: str = "",
+                 complete: bool = True, client_count: int = 1):
+        self.page_id = page_id
+        self.task_ids = RelationIds(task_ids)
+        self.last_edited_time = last_edited_time
+        self.complete = complete
+        self.client_count = client_count
+
+    @classmethod
+    def from_page(cls, page: dict, task_property: str,
+                  client_property: Optional[str] = None) -> "SummaryEntry":
+        """工数集計DBのクエリ結果のページから生成"""
+        properties = page.get("properties", {})
+        relation = properties.get(task_property, {})
+        return cls(
+            page_id=page["id"],
+            task_ids=[item.get("id", "") for item in relation.get("relation", [])],
+            last_edited_time=page.get("last_edited_time", ""),
+            # 関連ページが多い場合、クエリ結果のリレーションは切り詰められhas_moreが立つ
+            complete=not relation.get("has_more", False),
+            client_count=len(properties.get(client_property, {}).get("relation", [])) if client_property else 1
+        )
+
+
+class WorkloadSummaryIndex:
+    """顧問先ID → 工数集計ページのローカルインデックス
+
+    工数集計DBを一括で読み込み、以降はlast_edited_timeで差分更新する。
+    件数はmax_entriesまでに制限し、TTL切れと最も古く使われたものから破棄する。
+    集計ページが存在しない顧問先も negative_ttl 秒だけ記録して再検索を抑える。
+    """
+
+    MISS = object()
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600.0, negative_ttl: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # 差分更新に使う最新のlast_edited_time（一括読み込み前は空）
+        self.watermark = ""
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, client_id: str):
+        """キャッシュを参照。未登録ならMISS、集計ページが無い顧問先ならNoneを返す"""
+        with self._lock:
+            item = self._entries.get(client_id)
+            if item is None:
+                return self.MISS
+            entry, expires_at = item
+            if expires_at <= self._clock():
+                del self._entries[client_id]
+                return self.MISS
+            self._entries.move_to_end(client_id)
+            return entry
+
+    def put(self, client_id: str, entry: Optional[SummaryEntry]):
+        """エントリーを登録（Noneは集計ページが無いことを表す）"""
+        ttl = self.ttl if entry is not None else self.negative_ttl
+        with self._lock:
+            self._entries[client_id] = (entry, self._clock() + ttl)
+            self._entries.move_to_end(client_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, client_id: str):
+        with self._lock:
+            self._entries.pop(client_id, None)
+
+    def invalidate_where(self, predicate: Callable[[str], bool]) -> int:
+        """predicate(顧問先ID)がTrueのエントリーを破棄し、破棄した件数を返す"""
+        with self._lock:
+            client_ids = [client_id for client_id in self._entries if predicate(client_id)]
+            for client_id in client_ids:
+                del self._entries[client_id]
+        return len(client_ids)
+
+    def ingest(self, pages: Iterable[dict], client_property: str, task_property: str) -> int:
+        """工数集計DBのクエリ結果をインデックスに反映し、反映したページ数を返す"""
+        count = 0
+        for page in pages:
+            entry = SummaryEntry.from_page(page, task_property, client_property)
+            for client in page.get("properties", {}).get(client_property, {}).get("relation", []):
+                self.put(client.get("id", ""), entry)
+
+            if entry.last_edited_time > self.watermark:
+                self.watermark = entry.last_edited_time
+            count += 1
+        return count
+
+
+class SchemaCache:
+    """データベースID → プロパティ名とプロパティIDの対応表
+
+    pathを指定した場合はJSONファイルにも保存し、再起動後も再利用する。
+    スキーマ全体（名前・ID・型）のハッシュを持ち、変更されていれば置き換える。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._schemas: Dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._schemas = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading schema cache from {self.path}: {e}")
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._schemas, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def fingerprint(properties: dict) -> str:
+        items = sorted((name, info.get("id", ""), info.get("type", ""))
+                       for name, info in properties.items())
+        return hashlib.sha1(json.dumps(items, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def update(self, database_id: str, properties: dict) -> bool:
+        """データベース取得APIのpropertiesで更新し、スキーマが変わっていればTrueを返す"""
+        fingerprint = self.fingerprint(properties)
+        with self._lock:
+            cached = self._schemas.get(database_id)
+            if cached and cached["fingerprint"] == fingerprint:
+                return False
+            self._schemas[database_id] = {
+                "fingerprint": fingerprint,
+                "properties": {name: info.get("id", "") for name, info in properties.items()}
+            }
+            self.save()
+        return True
+
+    def get(self, database_id: str) -> Optional[Dict[str, str]]:
+        """プロパティ名 → プロパティIDを返す（未取得の場合はNone）"""
+        cached = self._schemas.get(database_id)
+        return cached["properties"] if cached else None
+
+    def property_id(self, database_id: str, property_name: str) -> Optional[str]:
+        properties = self.get(database_id)
+        return properties.get(property_name) if properties else None
+
+    def invalidate(self, database_id: str):
+        """データベースのスキーマを破棄する（次に使う時にデータベース取得APIで読み直す）"""
+        with self._lock:
+            if self._schemas.pop(database_id, None) is not None:
+                self.save()
+
+    def clear(self):
+        with self._lock:
+            self._schemas = {}
+            self.save()
@@ -0,0 +1,35 @@
+import threading
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+class KeyedLocks:
+    """キー（ページID）ごとの排他ロック
+
+    並列処理時に同じ親タスクや工数集計ページへの書き込みを直列化する。
+    使われていないキーのロックは保持しない。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: Dict[str, List] = {}
+
+    @contextmanager
+    def hold(self, key: str):
+        with self._lock:
+            item = self._locks.setdefault(key, [threading.Lock(), 0])
+            item[1] += 1
+
+        item[0].acquire()
+        try:
+            yield
+        finally:
+            item[0].release()
+            with self._lock:
+                item[1] -= 1
+                if item[1] == 0:
+                    del self._locks[key]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._locks)
@@ -0,0 +1,115 @@
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+
+class FailureLedger:
+    """処理に失敗したエントリーの記録（ページID → 失敗情報）
+
+    失敗したエントリーは指数バックオフで決めた再試行時刻まで処理を見送る。
+    ページが編集された（last_edited_timeが変わった）場合は記録を破棄してすぐに再試行する。
+    pathを指定した場合はJSONファイルにも保存し、再起動後も引き継ぐ。
+    """
+
+    def __init__(self, path: Optional[str] = None, base_delay: float = 60.0,
+                 max_delay: float = 86400.0, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading failure ledger from {self.path}: {e}")
+
+    def save(self):
+        """一時ファイルに書き込んでから置き換える（途中で停止しても壊れないように）"""
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._entries, ensure_ascii=False)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def should_skip(self, page_id: str, last_edited_time: str) -> bool:
+        """再試行時刻前のため処理を見送るエントリーかどうか"""
+        with self._lock:
+            record = self._entries.get(page_id)
+            if record is None:
+                return False
+            if record["last_edited_time"] != last_edited_time:
+                # 失敗後にページが編集されたので記録を破棄して再試行する
+                del self._entries[page_id]
+                return False
+            return self._clock() < record["retry_at"]
+
+    def record_failure(self, page_id: str, last_edited_time: str, reason: str, title: str = "",
+                       retry_after: Optional[float] = None):
+        """失敗を記録し、次の再試行時刻を決める（base_delay × 2^(失敗回数-1)、上限max_delay）
+
+        retry_afterを指定した場合は失敗回数によらずその秒数後に再試行する。
+        """
+        now = self._clock()
+        with self._lock:
+            record = self._entries.get(page_id)
+            if record is None or record["last_edited_time"] != last_edited_time:
+                record = {"title": title, "last_edited_time": last_edited_time,
+                          "attempts": 0, "first_failed_at": now}
+            record["attempts"] += 1
+            record["reason"] = reason
+            record["last_failed_at"] = now
+            if retry_after is None:
+                retry_after = min(self.max_delay, self.base_delay * 2 ** (record["attempts"] - 1))
+            record["retry_at"] = now + retry_after
+            self._entries[page_id] = record
+
+    def record_success(self, page_id: str):
+        with self._lock:
+            self._entries.pop(page_id, None)
+
+    def quarantined(self, include_due: bool = False) -> List[dict]:
+        """処理を見送っているエントリーの一覧（再試行時刻順）
+
+        include_dueをTrueにすると、再試行時刻を過ぎた（次のサイクルで再試行する）エントリーも含める。
+        """
+        now = self._clock()
+        with self._lock:
+            records = [dict(record, page_id=page_id) for page_id, record in self._entries.items()
+                       if include_due or record["retry_at"] > now]
+        return sorted(records, key=lambda record: record["retry_at"])
+
+    def __contains__(self, page_id: str) -> bool:
+        return page_id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _format_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+
+
+if __name__ == "__main__":
+    # 記録されている失敗エントリーを表示する
+    #   python notion_failures.py failure_ledger.json
+    path = sys.argv[1] if len(sys.argv) > 1 else os.getenv("FAILURE_LEDGER_PATH", "failure_ledger.json")
+    records = FailureLedger(path).quarantined(include_due=True)
+    if not records:
+        print(f"No failed entries in {path}")
+    for record in records:
+        print(f"{record['page_id']} {record['title']!r} attempts={record['attempts']} "
+              f"retry_at={_format_time(record['retry_at'])} reason={record['reason']}")
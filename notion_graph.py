@@ -0,0 +1,175 @@
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+
+# 親・子・兄弟が無いことを表す番号
+NONE = -1
+
+
+class TaskGraph:
+    """タスクの親子関係のローカルグラフ
+
+    ページIDに連番を振り、親・最初の子・次の兄弟・工数・部分木の工数合計を
+    番号で引く配列で持つ。部分木の工数合計は親子関係や工数が変わるたびに
+    祖先に差分を反映するため、親・祖先・部分木の工数はいずれも深さ分の計算で求まる。
+    タスクDBのクエリ結果（子タスクリレーションと工数）から構築し、
+    以降はlast_edited_timeで差分更新する。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._index: Dict[str, int] = {}
+        self._ids: List[str] = []
+        self._parent = array("l")
+        self._first_child = array("l")
+        self._next_sibling = array("l")
+        self._workload = array("d")
+        self._subtree_workload = array("d")
+        self.watermark = ""
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, page_id: str) -> bool:
+        return page_id in self._index
+
+    def _node(self, page_id: str) -> int:
+        node = self._index.get(page_id)
+        if node is None:
+            node = self._index[page_id] = len(self._ids)
+            self._ids.append(page_id)
+            self._parent.append(NONE)
+            self._first_child.append(NONE)
+            self._next_sibling.append(NONE)
+            self._workload.append(0.0)
+            self._subtree_workload.append(0.0)
+        return node
+
+    def _add_to_ancestors(self, node: int, delta: float):
+        while node != NONE:
+            self._subtree_workload[node] += delta
+            node = self._parent[node]
+
+    def _unlink(self, node: int):
+        parent = self._parent[node]
+        if parent == NONE:
+            return
+        # 兄弟の連結リストから外す
+        if self._first_child[parent] == node:
+            self._first_child[parent] = self._next_sibling[node]
+        else:
+            sibling = self._first_child[parent]
+            while self._next_sibling[sibling] != node:
+                sibling = self._next_sibling[sibling]
+            self._next_sibling[sibling] = self._next_sibling[node]
+        self._next_sibling[node] = NONE
+        self._parent[node] = NONE
+        self._add_to_ancestors(parent, -self._subtree_workload[node])
+
+    def _is_ancestor(self, node: int, of: int) -> bool:
+        while of != NONE:
+            if of == node:
+                return True
+            of = self._parent[of]
+        return False
+
+    def set_parent(self, page_id: str, parent_id: Optional[str]) -> bool:
+        """親タスクを設定（parent_idがNoneの場合は親から外す）
+
+        循環する親子関係になる場合は設定せずFalseを返す。
+        """
+        with self._lock:
+            node = self._node(page_id)
+            parent = self._node(parent_id) if parent_id else NONE
+            if parent == self._parent[node]:
+                return True
+            if parent != NONE and self._is_ancestor(node, parent):
+                print(f"Ignoring cyclic parent {parent_id} for task {page_id}")
+                return False
+
+            self._unlink(node)
+            if parent != NONE:
+                self._parent[node] = parent
+                self._next_sibling[node] = self._first_child[parent]
+                self._first_child[parent] = node
+                self._add_to_ancestors(parent, self._subtree_workload[node])
+            return True
+
+    def set_children(self, parent_id: str, child_ids: Iterable[str]):
+        """子タスクを全件で置き換える（含まれない既存の子タスクは親から外す）"""
+        with self._lock:
+            child_ids = set(child_ids)
+            for child_id in self.children(parent_id):
+                if child_id not in child_ids:
+                    self.set_parent(child_id, None)
+            for child_id in child_ids:
+                self.set_parent(child_id, parent_id)
+
+    def set_workload(self, page_id: str, workload: float):
+        with self._lock:
+            node = self._node(page_id)
+            delta = (workload or 0.0) - self._workload[node]
+            if delta:
+                self._workload[node] += delta
+                self._add_to_ancestors(node, delta)
+
+    def parent(self, page_id: str) -> Optional[str]:
+        node = self._index.get(page_id)
+        if node is None or self._parent[node] == NONE:
+            return None
+        return self._ids[self._parent[node]]
+
+    def ancestors(self, page_id: str) -> List[str]:
+        """親から順に最上位までの祖先"""
+        with self._lock:
+            chain = []
+            node = self._index.get(page_id, NONE)
+            node = self._parent[node] if node != NONE else NONE
+            while node != NONE:
+                chain.append(self._ids[node])
+                node = self._parent[node]
+            return chain
+
+    def children(self, page_id: str) -> List[str]:
+        with self._lock:
+            node = self._index.get(page_id)
+            if node is None:
+                return []
+            children = []
+            child = self._first_child[node]
+            while child != NONE:
+                children.append(self._ids[child])
+                child = self._next_sibling[child]
+            return children
+
+    def subtree_workload(self, page_id: str) -> float:
+        """自身と全ての子孫の工数の合計"""
+        node = self._index.get(page_id)
+        return self._subtree_workload[node] if node is not None else 0.0
+
+    def ingest(self, pages: Iterable[dict], children_property: str,
+               workload_property: str) -> List[str]:
+        """タスクDBのクエリ結果を反映し、子タスクが切り詰められているページのIDを返す
+
+        切り詰められているページの子タスクは呼び出し側で全件を読み込んでset_childrenで反映する。
+        """
+        truncated = []
+        with self._lock:
+            for page in pages:
+                properties = page.get("properties") or {}
+                if workload_property in properties:
+                    self.set_workload(page["id"], (properties[workload_property] or {}).get("number") or 0)
+
+                relation = properties.get(children_property)
+                if relation is not None:
+                    if relation.get("has_more"):
+                        truncated.append(page["id"])
+                    else:
+                        self.set_children(page["id"], [item.get("id", "") for item in relation.get("relation") or ()])
+
+                last_edited_time = page.get("last_edited_time", "")
+                if last_edited_time > self.watermark:
+                    self.watermark = last_edited_time
+        return truncated
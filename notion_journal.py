@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+
+class Journal:
+    """エントリーごとの書き込み手順（親タスク → 工数 → フラグ）の先行書き込みログ
+
+    各手順の実行前に意図（intent）を、成功後に完了（done）を1行のJSONとして追記する。
+    再起動時はログを読み直し、完了済みの手順を飛ばして未完了の手順のみ再実行できる。
+    失敗（failed）を記録したエントリーは再起動時の再実行の対象から外す（再試行はFailureLedgerに任せる）。
+    失敗したまま、または他のワーカーの担当のまま残ったエントリーはprune()で外す。
+    pathを指定しない場合はメモリ上のみで記録する。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_age: float = 86400.0,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        # 最後の意図の記録からこの秒数を過ぎた未完了のエントリーはprune()で外す
+        self.max_age = max_age
+        self._clock = clock
+        self._lock = threading.Lock()
+        # ページID → {"data": 手順の実行に必要な値, "done": 完了した手順, "failed": 最後の手順が失敗したか,
+        #             "at": 最後に意図を記録した時刻}
+        self._entries: Dict[str, dict] = {}
+        self._file = None
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で停止した最終行は無視する
+                        continue
+                    self._apply(record)
+        except OSError as e:
+            print(f"Error loading journal from {self.path}: {e}")
+
+    def _apply(self, record: dict):
+        page_id = record["id"]
+        if record["op"] == "intent":
+            entry = self._entries.get(page_id)
+            if entry is None or entry["data"] != record["data"]:
+                # 初めての、または内容が変わったエントリーは最初からやり直す
+                entry = self._entries[page_id] = {"data": record["data"], "done": set()}
+            entry["failed"] = False
+            # 時刻の無い古い形式の記録は読み込んだ時刻から数える
+            entry["at"] = record.get("at") or self._clock()
+        elif record["op"] == "done" and page_id in self._entries:
+            self._entries[page_id]["done"].add(record["step"])
+        elif record["op"] == "failed" and page_id in self._entries:
+            self._entries[page_id]["failed"] = True
+        elif record["op"] == "finish":
+            self._entries.pop(page_id, None)
+
+    def _append(self, records: List[dict]):
+        with self._lock:
+            for record in records:
+                self._apply(record)
+            if not self.path:
+                return
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+            self._file.flush()
+
+    def intent(self, step: str, page_id: str, data: dict):
+        """手順を実行する前に記録する（dataは再実行に必要な値）"""
+        self.intents(step, [(page_id, data)])
+
+    def intents(self, step: str, items: List[tuple]):
+        now = self._clock()
+        self._append([{"op": "intent", "step": step, "id": page_id, "data": data, "at": now}
+                      for page_id, data in items])
+
+    def done(self, step: str, page_id: str):
+        self.done_many(step, [page_id])
+
+    def done_many(self, step: str, page_ids: List[str]):
+        self._append([{"op": "done", "step": step, "id": page_id} for page_id in page_ids])
+
+    def failed(self, step: str, page_id: str):
+        self._append([{"op": "failed", "step": step, "id": page_id}])
+
+    def finish(self, page_ids: List[str]):
+        """全ての手順が完了したエントリーを記録から外す"""
+        self._append([{"op": "finish", "id": page_id} for page_id in page_ids])
+
+    def completed(self, page_id: str, data: dict) -> Set[str]:
+        """完了済みの手順（記録時と内容が変わっている場合は空）"""
+        with self._lock:
+            entry = self._entries.get(page_id)
+            if entry is None or entry["data"] != data:
+                return set()
+            return set(entry["done"])
+
+    def unfinished(self) -> Dict[str, dict]:
+        """途中で停止したため未完了の手順が残っているエントリー（ページID → data）"""
+        with self._lock:
+            return {page_id: entry["data"] for page_id, entry in self._entries.items()
+                    if not entry["failed"]}
+
+    def prune(self, is_retrying: Callable[[str], bool]) -> int:
+        """再実行しないエントリーを外し、外した件数を返す
+
+        失敗を記録したエントリーはis_retrying(ページID)がFalseになった（FailureLedgerで追跡されなくなった）時点で、
+        それ以外の未完了のエントリーもmax_ageを過ぎた時点で外す
+        （手動でフラグが立てられた・削除されたタスクや、他のワーカーの担当のまま残ったエントリー）。
+        """
+        expired_before = self._clock() - self.max_age
+        with self._lock:
+            stale = [page_id for page_id, entry in self._entries.items()
+                     if entry["at"] < expired_before or (entry["failed"] and not is_retrying(page_id))]
+        if stale:
+            self.finish(stale)
+        return len(stale)
+
+    def compact(self):
+        """未完了のエントリーのみを書き出してログを置き換える"""
+        if not self.path:
+            return
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for page_id, entry in self._entries.items():
+                    f.write(json.dumps({"op": "intent", "step": "parent", "id": page_id,
+                                        "data": entry["data"], "at": entry["at"]}, ensure_ascii=False) + "\n")
+                    for step in sorted(entry["done"]):
+                        f.write(json.dumps({"op": "done", "step": step, "id": page_id}) + "\n")
+                    if entry["failed"]:
+                        f.write(json.dumps({"op": "failed", "step": "", "id": page_id}) + "\n")
+            os.replace(tmp_path, self.path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,178 @@
+import hashlib
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Callable, Optional, Set
+
+
+def partition_of(client_id: str, partitions: int) -> int:
+    """顧問先IDのパーティション番号（Pythonのhash()はプロセスごとに異なるため、全ワーカーで同じになるハッシュを使う）"""
+    digest = hashlib.blake2b((client_id or "").encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % partitions
+
+
+class LeaseStore:
+    """顧問先IDのハッシュで分けたパーティションのリースを、複数のワーカープロセスでSQLiteファイルを通じて共有する
+
+    1つの工数集計ページへの書き込みが1つのワーカーからのみ行われるように、
+    各ワーカーはリースを持つパーティションの顧問先のエントリーのみを処理する。
+    - heartbeat()で自分のリースを延長し、空いている（期限切れの）パーティションを
+      生存しているワーカー数で割った取り分まで取得する（停止したワーカーのリースはttl秒後に引き継ぐ）
+    - rebalance=Trueの場合は取り分を超えたリースを手放す（書き込み中でないサイクルの開始時に行う）
+    - owns()は最後に延長してからttlの半分を過ぎたリースを持っていないものとして扱い、
+      期限切れで他のワーカーに引き継がれる前に書き込みを止める
+    start()でttlの1/3ごとにリースを延長する（新しいパーティションは取得しない）スレッドを開始する。
+    パーティションに分けられないページ（複数の顧問先の子タスクを持つ親タスク）はacquire_page()で全ワーカーで直列化する。
+    """
+
+    # acquire_page()でページのロックが空くのを待つ間隔（秒）
+    LOCK_POLL_INTERVAL = 0.05
+
+    def __init__(self, path: str, worker_id: Optional[str] = None, partitions: int = 16,
+                 ttl: float = 30.0, clock: Callable[[], float] = time.time):
+        self.path = path
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.partitions = partitions
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._owned: Set[int] = set()
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+        with closing(self._connect()) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS leases "
+                               "(partition INTEGER PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS workers "
+                               "(worker_id TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS page_locks "
+                               "(page_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # トランザクションはBEGIN IMMEDIATEで明示的に開始する（他のワーカーの書き込み中は待つ）
+        # 待ち時間はheartbeat()の間隔より短くし、1回待たされても次の延長までにリースが切れないようにする
+        return sqlite3.connect(self.path, timeout=self.ttl / 6, isolation_level=None)
+
+    def heartbeat(self, rebalance: bool = False, acquire: bool = True) -> Set[int]:
+        """リースを延長・取得し、持っているパーティション番号を返す
+
+        acquireがFalseの場合は延長のみ行い、新しいパーティションは取得しない
+        （サイクルの途中で取得すると、サイクル開始時に読み込んだ工数集計ページのキャッシュが古いまま書き込まれるため）。
+        """
+        with self._lock:
+            now = self._clock()
+            expires = now + self.ttl
+            connection = self._connect()
+            try:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute("INSERT OR REPLACE INTO workers VALUES (?, ?)", (self.worker_id, expires))
+                connection.execute("DELETE FROM workers WHERE expires < ?", (now,))
+                live = connection.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+                share = math.ceil(self.partitions / max(live, 1))
+
+                # 期限切れでも他のワーカーに引き継がれていなければ自分のリースのまま延長する
+                owned = sorted(row[0] for row in connection.execute(
+                    "SELECT partition FROM leases WHERE owner = ?", (self.worker_id,)))
+                if rebalance and len(owned) > share:
+                    released = owned[share:]
+                    owned = owned[:share]
+                    connection.executemany("DELETE FROM leases WHERE partition = ? AND owner = ?",
+                                           [(partition, self.worker_id) for partition in released])
+                connection.execute("UPDATE leases SET expires = ? WHERE owner = ?", (expires, self.worker_id))
+
+                if acquire and len(owned) < share:
+                    taken = {row[0] for row in connection.execute(
+                        "SELECT partition FROM leases WHERE expires >= ?", (now,))}
+                    free = [partition for partition in range(self.partitions)
+                            if partition not in taken and partition not in owned]
+                    acquired = free[:share - len(owned)]
+                    connection.executemany("INSERT OR REPLACE INTO leases VALUES (?, ?, ?)",
+                                           [(partition, self.worker_id, expires) for partition in acquired])
+                    owned += acquired
+                connection.execute("COMMIT")
+            except sqlite3.Error as e:
+                connection.rollback()
+                print(f"Error renewing leases in {self.path}: {e}")
+                return self.owned
+            finally:
+                connection.close()
+
+            self._owned = set(owned)
+            self._valid_until = now + self.ttl / 2
+            return set(self._owned)
+
+    @property
+    def owned(self) -> Set[int]:
+        """書き込んでよいパーティション番号（延長できていない場合は空）"""
+        if self._clock() >= self._valid_until:
+            return set()
+        return set(self._owned)
+
+    def owns(self, client_id: str) -> bool:
+        return self._clock() < self._valid_until and partition_of(client_id, self.partitions) in self._owned
+
+    def _try_lock(self, page_id: str) -> bool:
+        now = self._clock()
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            # 停止したワーカーのロックはttl秒で切れる
+            connection.execute("DELETE FROM page_locks WHERE page_id = ? AND expires < ?", (page_id, now))
+            acquired = connection.execute("INSERT OR IGNORE INTO page_locks VALUES (?, ?, ?)",
+                                          (page_id, self.worker_id, now + self.ttl)).rowcount == 1
+            connection.execute("COMMIT")
+            return acquired
+        except sqlite3.Error as e:
+            connection.rollback()
+            print(f"Error locking page {page_id} in {self.path}: {e}")
+            return False
+        finally:
+            connection.close()
+
+    def acquire_page(self, page_id: str, timeout: Optional[float] = None) -> bool:
+        """全てのワーカーで1つのページへの読み込み〜書き込みを直列化するロックを取得する
+
+        timeout秒（省略時はttlの半分）待っても取得できない場合はFalseを返す。
+        """
+        deadline = time.monotonic() + (self.ttl / 2 if timeout is None else timeout)
+        while not self._try_lock(page_id):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.LOCK_POLL_INTERVAL)
+        return True
+
+    def release_page(self, page_id: str):
+        with closing(self._connect()) as connection:
+            connection.execute("DELETE FROM page_locks WHERE page_id = ? AND owner = ?",
+                               (page_id, self.worker_id))
+
+    def release(self):
+        """全てのリースを手放す（他のワーカーは次のheartbeat()ですぐに引き継げる）"""
+        with self._lock:
+            with closing(self._connect()) as connection:
+                connection.execute("DELETE FROM leases WHERE owner = ?", (self.worker_id,))
+                connection.execute("DELETE FROM workers WHERE worker_id = ?", (self.worker_id,))
+                connection.execute("DELETE FROM page_locks WHERE owner = ?", (self.worker_id,))
+            self._owned = set()
+            self._valid_until = 0.0
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            self.heartbeat(acquire=False)
+
+    def start(self) -> "LeaseStore":
+        self.heartbeat()
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.release()
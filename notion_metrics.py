@@ -0,0 +1,249 @@
+import json
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """Prometheus形式の累積バケットを持つヒストグラム"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+            "sum": self.sum,
+            "count": self.count
+        }
+
+
+class MetricsHook:
+    """計測フックのインターフェース（独自の送信先に渡す場合はこれを継承する）"""
+
+    def on_request(self, operation: str, status_code: int, duration: float,
+                   bytes_received: int, retries: int):
+        pass
+
+    def on_cycle(self, entries: int, succeeded: int, duration: float):
+        pass
+
+
+class Metrics(MetricsHook):
+    """API呼び出しの種類ごとのレイテンシ・ステータス・リトライ・受信バイト数と
+    サイクルごとの処理件数を集計する
+
+    operationは query_tasks / query_summary / patch_parent / patch_summary / patch_flag など。
+    labelsはPrometheus出力の全ての系列に付与される（テナント名など）。
+    """
+
+    def __init__(self, labels: Optional[Dict[str, str]] = None):
+        self.labels = labels or {}
+        self._lock = threading.Lock()
+        self.latency: Dict[str, Histogram] = defaultdict(Histogram)
+        self.status_codes: Dict[Tuple[str, int], int] = defaultdict(int)
+        self.retries: Dict[str, int] = defaultdict(int)
+        self.bytes_received: Dict[str, int] = defaultdict(int)
+        self.cycle_duration = Histogram()
+        self.cycle_entries = Histogram((0, 1, 10, 50, 100, 500, 1000, 5000))
+        self.cycles = 0
+        self.entries_total = 0
+        self.succeeded_total = 0
+        self.last_cycle_entries = 0
+
+    def on_request(self, operation: str, status_code: int, duration: float,
+                   bytes_received: int, retries: int):
+        with self._lock:
+            self.latency[operation].observe(duration)
+            self.status_codes[(operation, status_code)] += 1
+            self.retries[operation] += retries
+            self.bytes_received[operation] += bytes_received
+
+    def on_cycle(self, entries: int, succeeded: int, duration: float):
+        with self._lock:
+            self.cycles += 1
+            self.entries_total += entries
+            self.succeeded_total += succeeded
+            self.last_cycle_entries = entries
+            self.cycle_duration.observe(duration)
+            self.cycle_entries.observe(entries)
+
+    def to_dict(self) -> dict:
+        """JSON出力用の辞書"""
+        with self._lock:
+            return {
+                "labels": self.labels,
+                "requests": {
+                    operation: {
+                        "latency_seconds": histogram.to_dict(),
+                        "status_codes": {str(status): count for (op, status), count
+                                         in self.status_codes.items() if op == operation},
+                        "retries": self.retries[operation],
+                        "bytes_received": self.bytes_received[operation]
+                    }
+                    for operation, histogram in self.latency.items()
+                },
+                "cycles": {
+                    "total": self.cycles,
+                    "entries_total": self.entries_total,
+                    "succeeded_total": self.succeeded_total,
+                    "last_entries": self.last_cycle_entries,
+                    "duration_seconds": self.cycle_duration.to_dict(),
+                    "entries": self.cycle_entries.to_dict()
+                }
+            }
+
+    def _label_text(self, **labels) -> str:
+        merged = dict(self.labels, **labels)
+        if not merged:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in merged.items()) + "}"
+
+    def _histogram_lines(self, name: str, histogram: Histogram, **labels) -> List[str]:
+        lines = [f"{name}_bucket{self._label_text(**labels, le=str(bound))} {count}"
+                 for bound, count in zip(histogram.buckets, histogram.counts)]
+        lines.append(f"{name}_bucket{self._label_text(**labels, le='+Inf')} {histogram.count}")
+        lines.append(f"{name}_sum{self._label_text(**labels)} {histogram.sum}")
+        lines.append(f"{name}_count{self._label_text(**labels)} {histogram.count}")
+        return lines
+
+    def prometheus_sections(self) -> Dict[str, Tuple[str, str, List[str]]]:
+        """メトリクス名 → (型, 説明, 系列の行)"""
+        sections = {
+            "notion_request_duration_seconds": ("histogram", "Notion API request latency", []),
+            "notion_requests_total": ("counter", "Notion API responses by status code", []),
+            "notion_request_retries_total": ("counter", "Notion API retries", []),
+            "notion_response_bytes_total": ("counter", "Bytes received from the Notion API", []),
+            "notion_cycle_duration_seconds": ("histogram", "Processing cycle duration", []),
+            "notion_cycle_entries": ("histogram", "Entries fetched per cycle", []),
+            "notion_entries_processed_total": ("counter", "Entries fetched for processing", []),
+            "notion_entries_succeeded_total": ("counter", "Entries processed successfully", []),
+        }
+
+        with self._lock:
+            for operation, histogram in self.latency.items():
+                sections["notion_request_duration_seconds"][2].extend(self._histogram_lines(
+                    "notion_request_duration_seconds", histogram, operation=operation))
+                sections["notion_request_retries_total"][2].append(
+                    f"notion_request_retries_total{self._label_text(operation=operation)} "
+                    f"{self.retries[operation]}")
+                sections["notion_response_bytes_total"][2].append(
+                    f"notion_response_bytes_total{self._label_text(operation=operation)} "
+                    f"{self.bytes_received[operation]}")
+            for (operation, status), count in self.status_codes.items():
+                sections["notion_requests_total"][2].append(
+                    f"notion_requests_total{self._label_text(operation=operation, status=str(status))} "
+                    f"{count}")
+            sections["notion_cycle_duration_seconds"][2].extend(
+                self._histogram_lines("notion_cycle_duration_seconds", self.cycle_duration))
+            sections["notion_cycle_entries"][2].extend(
+                self._histogram_lines("notion_cycle_entries", self.cycle_entries))
+            sections["notion_entries_processed_total"][2].append(
+                f"notion_entries_processed_total{self._label_text()} {self.entries_total}")
+            sections["notion_entries_succeeded_total"][2].append(
+                f"notion_entries_succeeded_total{self._label_text()} {self.succeeded_total}")
+        return sections
+
+    def to_prometheus(self, include_help: bool = True) -> str:
+        """Prometheusのテキスト形式で出力"""
+        return _format_prometheus(self.prometheus_sections(), include_help)
+
+
+class MetricsGroup:
+    """複数のMetrics（テナントごとなど）をまとめて出力する
+
+    Prometheus形式では同じメトリクス名の系列をまとめて出力する。
+    MetricsServerにMetricsの代わりに渡せる。
+    """
+
+    def __init__(self, members: Optional[List[Metrics]] = None):
+        self.members = list(members or [])
+
+    def add(self, metrics: Metrics) -> Metrics:
+        self.members.append(metrics)
+        return metrics
+
+    def to_dict(self) -> dict:
+        return {"members": [metrics.to_dict() for metrics in self.members]}
+
+    def to_prometheus(self, include_help: bool = True) -> str:
+        sections: Dict[str, Tuple[str, str, List[str]]] = {}
+        for metrics in self.members:
+            for name, (metric_type, description, values) in metrics.prometheus_sections().items():
+                sections.setdefault(name, (metric_type, description, []))[2].extend(values)
+        return _format_prometheus(sections, include_help)
+
+
+def _format_prometheus(sections: Dict[str, Tuple[str, str, List[str]]], include_help: bool) -> str:
+    lines = []
+    for name, (metric_type, description, values) in sections.items():
+        if include_help:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(values)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """/metrics（Prometheusテキスト形式）と /metrics.json を返すローカルHTTPサーバー
+
+    metricsにはMetricsまたはMetricsGroupを渡す。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, metrics, host: str = "127.0.0.1", port: int = 9464):
+        super().__init__((host, port), _MetricsHandler)
+        self.metrics = metrics
+        self._thread = None
+
+    def start(self) -> "MetricsServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/metrics":
+            body = self.server.metrics.to_prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/metrics.json":
+            body = json.dumps(self.server.metrics.to_dict(), ensure_ascii=False).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,201 @@
+import json
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+
+class ReconcileReport:
+    """タスクDBと工数集計DBの差分"""
+
+    def __init__(self):
+        self.tasks_scanned = 0
+        self.summaries_scanned = 0
+        # 顧問先ID → 予定に無いタスクID
+        self.missing: Dict[str, List[str]] = {}
+        # 集計ページID → 予定にあるが、そのページの顧問先のタスクではないページID
+        self.extra: Dict[str, List[str]] = {}
+        # 工数集計ページが無い顧問先ID → タスク数
+        self.clients_without_summary: Dict[str, int] = {}
+        # 予定に含まれる（含める）のにフラグが立っていないタスクID
+        self.unflagged: List[str] = []
+        self.summaries_patched = 0
+        self.flags_patched = 0
+        # 親タスク・集計ページを更新できなかったためフラグを立てずに残したタスク数
+        self.flags_skipped = 0
+        # 再試行しても直らないエラーで書き込めなかった集計ページID → エラー
+        self.summaries_failed: Dict[str, str] = {}
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ReconcileReport":
+        report = cls()
+        vars(report).update(data)
+        return report
+
+    def format(self) -> str:
+        lines = [
+            f"Scanned {self.tasks_scanned} tasks and {self.summaries_scanned} workload summary pages",
+            f"Missing from 予定: {sum(map(len, self.missing.values()))} tasks in {len(self.missing)} clients",
+            f"Not belonging in 予定: {sum(map(len, self.extra.values()))} pages in {len(self.extra)} summary pages",
+            f"Clients without a workload summary page: {len(self.clients_without_summary)}",
+            f"Tasks to flag: {len(self.unflagged)}",
+        ]
+        for client_id, task_ids in sorted(self.missing.items()):
+            lines.append(f"  + {client_id}: {len(task_ids)} ({', '.join(task_ids[:5])}{' ...' if len(task_ids) > 5 else ''})")
+        for summary_id, page_ids in sorted(self.extra.items()):
+            lines.append(f"  - {summary_id}: {len(page_ids)} ({', '.join(page_ids[:5])}{' ...' if len(page_ids) > 5 else ''})")
+        for client_id, count in sorted(self.clients_without_summary.items()):
+            lines.append(f"  ! {client_id}: {count} tasks without a summary page")
+        return "\n".join(lines)
+
+
+def build_plan(expected: Dict[str, List[str]], summaries: Dict[str, Tuple[str, Iterable[str]]],
+               unflagged: Set[str], prune: bool = False) -> Tuple[ReconcileReport, dict, List[str]]:
+    """あるべき予定（顧問先ID → タスクID）と実際の予定（顧問先ID → (集計ページID, 予定のID)）の差分から
+    最小限の書き込みを決める
+
+    1つの集計ページに複数の顧問先が紐付いている場合は、全ての顧問先のタスクを合わせてページごとに差分を取る。
+    集計ページID → {"client_ids", "add", "remove"} と、フラグを立てるタスクIDを返す。
+    pruneがFalseの場合、余分な予定は報告のみで外さない。
+    """
+    report = ReconcileReport()
+    plan = {}
+    flags = []
+
+    # 集計ページID → (紐付いている顧問先ID, 予定のID)
+    pages: Dict[str, Tuple[List[str], List[str]]] = {}
+    for client_id, (page_id, actual) in summaries.items():
+        pages.setdefault(page_id, ([], list(actual)))[0].append(client_id)
+
+    for client_id, task_ids in expected.items():
+        if client_id not in summaries:
+            report.clients_without_summary[client_id] = len(task_ids)
+            continue
+        flags.extend(task_id for task_id in task_ids if task_id in unflagged)
+
+    for page_id, (client_ids, actual) in pages.items():
+        actual_ids = set(actual)
+        # ページのあるべき予定（順序付き）
+        expected_ids = {}
+        for client_id in client_ids:
+            task_ids = expected.get(client_id, ())
+            missing = [task_id for task_id in task_ids if task_id not in actual_ids]
+            if missing:
+                report.missing[client_id] = missing
+            expected_ids.update(dict.fromkeys(task_ids))
+
+        add = [task_id for task_id in expected_ids if task_id not in actual_ids]
+        extra = [task_id for task_id in actual if task_id not in expected_ids]
+        if extra:
+            report.extra[page_id] = extra
+        remove = extra if prune else []
+        if add or remove:
+            plan[page_id] = {"client_ids": client_ids, "add": add, "remove": remove}
+
+    report.unflagged = flags
+    return report, plan, flags
+
+
+class ReconcileCheckpoint:
+    """書き込み計画と進捗のJSONファイル（中断した場合は再スキャンせずに続きから書き込む）
+
+    計画を作ったデータベースの組と時刻も保存し、別のデータベースの組や古い計画からは再開しない。
+    """
+
+    # この件数の書き込みが終わるごとに保存する
+    SAVE_EVERY = 25
+    # この秒数より前に作った計画からは再開しない（その間にタスクDB・工数集計DBが変わっている可能性が高い）
+    MAX_AGE = 86400.0
+
+    def __init__(self, path: Optional[str] = None, clock: Callable[[], float] = time.time):
+        self.path = path
+        self._clock = clock
+        self.report: Optional[ReconcileReport] = None
+        self.summaries: Dict[str, dict] = {}
+        self.flags: List[str] = []
+        # フラグを立てるタスクID → 親タスクID（親タスクの子タスクに追加してからフラグを立てる）
+        self.parents: Dict[str, str] = {}
+        self.task_db_id = ""
+        self.summary_db_id = ""
+        self.created_at = 0.0
+        self.done: Set[str] = set()
+        self._unsaved = 0
+        self.load()
+
+    @property
+    def active(self) -> bool:
+        """続きから書き込める計画があるか"""
+        return self.report is not None
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading reconcile checkpoint from {self.path}: {e}")
+            return
+        self.report = ReconcileReport.from_dict(data["report"])
+        self.summaries = data["summaries"]
+        self.flags = data["flags"]
+        self.parents = data.get("parents", {})
+        self.task_db_id = data.get("task_db_id", "")
+        self.summary_db_id = data.get("summary_db_id", "")
+        self.created_at = data.get("created_at", 0.0)
+        self.done = set(data["done"])
+
+    def stale_reason(self, task_db_id: str, summary_db_id: str) -> Optional[str]:
+        """このデータベースの組の続きとして再開できない場合はその理由を返す"""
+        if (self.task_db_id, self.summary_db_id) != (task_db_id, summary_db_id):
+            return (f"it was written for task DB {self.task_db_id or '?'} and "
+                    f"workload summary DB {self.summary_db_id or '?'}")
+        age = self._clock() - self.created_at
+        if age > self.MAX_AGE:
+            return f"it is {age / 3600:.1f} hours old"
+        return None
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"report": self.report.to_dict(), "summaries": self.summaries,
+                       "flags": self.flags, "parents": self.parents,
+                       "task_db_id": self.task_db_id, "summary_db_id": self.summary_db_id,
+                       "created_at": self.created_at, "done": sorted(self.done)}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+    def start(self, report: ReconcileReport, summaries: Dict[str, dict], flags: List[str],
+              parents: Dict[str, str], task_db_id: str, summary_db_id: str):
+        self.report = report
+        self.summaries = summaries
+        self.flags = flags
+        self.parents = parents
+        self.task_db_id = task_db_id
+        self.summary_db_id = summary_db_id
+        self.created_at = self._clock()
+        self.done = set()
+        self.save()
+
+    def pending_summaries(self) -> List[Tuple[str, dict]]:
+        return [(page_id, item) for page_id, item in self.summaries.items()
+                if f"summary:{page_id}" not in self.done]
+
+    def pending_flags(self) -> List[str]:
+        return [task_id for task_id in self.flags if f"flag:{task_id}" not in self.done]
+
+    def mark_done(self, key: str):
+        self.done.add(key)
+        self._unsaved += 1
+        if self._unsaved >= self.SAVE_EVERY:
+            self.save()
+
+    def finish(self):
+        """全て書き込んだらファイルを削除"""
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.report = None
@@ -0,0 +1,29 @@
+class AdaptivePollScheduler:
+    """処理結果に応じてポーリング間隔を調整するスケジューラー
+
+    - 取得件数がページ上限に達した場合は最短間隔で次のサイクルを実行
+    - 新規エントリーがあった場合は間隔を縮める
+    - 新規エントリーが無い場合やAPIに制限された場合は指数的に間隔を延ばす
+    サイクル自体の処理時間は待ち時間から差し引く。
+    """
+
+    def __init__(self, interval: float = 15.0, min_interval: float = 1.0,
+                 max_interval: float = 120.0, factor: float = 2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min(max(interval, min_interval), max_interval)
+
+    def next_delay(self, entries: int, has_more: bool = False, throttled: bool = False,
+                   duration: float = 0.0) -> float:
+        """次のサイクルまでの待ち時間（秒）を決める"""
+        if throttled:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+        elif has_more:
+            self.interval = self.min_interval
+        elif entries > 0:
+            self.interval = max(self.min_interval, self.interval / self.factor)
+        else:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+
+        return max(0.0, self.interval - duration)
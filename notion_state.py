@@ -0,0 +1,48 @@
+import json
+import os
+import time
+from typing import Optional
+
+
+class PollState:
+    """差分ポーリングの状態をローカルのJSONファイルに保存する
+
+    watermarkは処理済みタスクのlast_edited_timeの最大値、
+    last_full_sweepは最後に全件検索を行った時刻（UNIX時間）。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.watermark = ""
+        self.last_full_sweep = 0.0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading poll state from {self.path}: {e}")
+            return
+        self.watermark = data.get("watermark", "")
+        self.last_full_sweep = data.get("last_full_sweep", 0.0)
+
+    def save(self):
+        """一時ファイルに書き込んでから置き換える（途中で停止しても壊れないように）"""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"watermark": self.watermark, "last_full_sweep": self.last_full_sweep}, f)
+        os.replace(tmp_path, self.path)
+
+    def full_sweep_due(self, interval: float, now: Optional[float] = None) -> bool:
+        """全件検索を行うタイミングかどうか"""
+        if not self.watermark:
+            return True
+        now = time.time() if now is None else now
+        return now - self.last_full_sweep >= interval
+
+    def advance(self, last_edited_time: str):
+        if last_edited_time > self.watermark:
+            self.watermark = last_edited_time
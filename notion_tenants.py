@@ -0,0 +1,153 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from requests.adapters import HTTPAdapter
+
+from notion_metrics import Metrics, MetricsGroup
+from notion_scheduler import AdaptivePollScheduler
+from notion_transport import NotionTransport, RateLimiter, notion_headers
+
+
+@dataclass
+class TenantConfig:
+    """1テナント（事務所）分の設定"""
+    name: str
+    api_key: str
+    task_db_id: str
+    summary_db_id: str
+    requests_per_second: float = 3.0
+    state_path: Optional[str] = None
+    schema_cache_path: Optional[str] = None
+    failure_ledger_path: Optional[str] = None
+    journal_path: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "TenantConfig":
+        """設定ファイルの1件から生成（APIキーはapi_key_envで環境変数から読み込める）"""
+        data = dict(data)
+        api_key_env = data.pop("api_key_env", None)
+        if api_key_env:
+            data["api_key"] = os.getenv(api_key_env, "")
+        return cls(**data)
+
+
+def load_tenants(path: str) -> List[TenantConfig]:
+    """テナント設定のJSONファイル（設定の配列）を読み込む"""
+    with open(path, encoding="utf-8") as f:
+        return [TenantConfig.from_dict(item) for item in json.load(f)]
+
+
+class Tenant:
+    """実行中のテナント（マネージャー・ポーリング間隔・計測）"""
+
+    def __init__(self, config: TenantConfig, manager, scheduler: AdaptivePollScheduler,
+                 metrics: Metrics):
+        self.config = config
+        self.manager = manager
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.cycles = 0
+
+
+class MultiTenantRunner:
+    """複数のタスクDB・工数集計DBの組を1つのプロセスで処理する
+
+    - 全てのテナントで接続プール（HTTPAdapter）を共有する
+    - レート制限はAPIキーごとに持つ（同じキーのテナントは制限を共有する）
+    - 次の実行時刻が来たテナントから順に（同時刻なら順番に）処理し、
+      1サイクルあたりのクエリのページ数をmax_batchesに制限して大きなテナントが他を待たせないようにする
+    - 計測はテナントごとに行い、tenantラベルを付けてまとめて出力する
+    manager_factory(config, transport, metrics) でテナントのマネージャーを生成する。
+    """
+
+    def __init__(self, configs: List[TenantConfig], manager_factory: Callable,
+                 max_workers: int = 4, max_batches: int = 5, pool_size: int = 20,
+                 interval: float = 15.0, min_interval: float = 1.0, max_interval: float = 120.0,
+                 base_url: str = NotionTransport.BASE_URL, clock: Callable[[], float] = time.monotonic):
+        self.max_workers = max_workers
+        self.max_batches = max_batches
+        self._clock = clock
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.rate_limiters: Dict[str, RateLimiter] = {}
+        self.metrics = MetricsGroup()
+        self.tenants: List[Tenant] = []
+
+        for config in configs:
+            limiter = self.rate_limiters.get(config.api_key)
+            if limiter is None:
+                limiter = self.rate_limiters[config.api_key] = RateLimiter(rate=config.requests_per_second)
+            metrics = self.metrics.add(Metrics(labels={"tenant": config.name}))
+            transport = NotionTransport(
+                notion_headers(config.api_key), base_url=base_url, rate_limiter=limiter,
+                metrics=metrics, adapter=self.adapter)
+            self.tenants.append(Tenant(
+                config, manager_factory(config, transport, metrics),
+                AdaptivePollScheduler(interval, min_interval, max_interval), metrics))
+
+    def run_cycle(self, tenant: Tenant) -> float:
+        """テナントの1サイクルを処理し、次のサイクルまでの待ち時間を返す"""
+        transport = tenant.manager.transport
+        throttled_before = transport.throttled
+        try:
+            if tenant.cycles == 0:
+                # 前回の実行で途中になった書き込みを完了させる
+                tenant.manager.recover()
+            stats = tenant.manager.process_new_entries(max_batches=self.max_batches)
+        except Exception as e:
+            # 1テナントの失敗で他のテナントを止めない
+            print(f"Error processing tenant {tenant.config.name}: {e}")
+            return tenant.scheduler.next_delay(0, throttled=True)
+        finally:
+            tenant.cycles += 1
+
+        return tenant.scheduler.next_delay(
+            stats.entries, stats.has_more,
+            throttled=transport.throttled > throttled_before,
+            duration=stats.duration)
+
+    def run(self, stop: Optional[threading.Event] = None, max_cycles: Optional[int] = None):
+        """実行ループ（stopがセットされるか、全テナントの合計サイクル数がmax_cyclesに達するまで）"""
+        if not self.tenants:
+            return
+        stop = stop or threading.Event()
+        order = itertools.count()
+        # (次の実行時刻, 順番, テナント)
+        queue = [(self._clock(), next(order), tenant) for tenant in self.tenants]
+        heapq.heapify(queue)
+        running = {}
+        cycles = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while not stop.is_set() and (max_cycles is None or cycles < max_cycles):
+                now = self._clock()
+                while queue and queue[0][0] <= now and len(running) < self.max_workers:
+                    _, _, tenant = heapq.heappop(queue)
+                    running[executor.submit(self.run_cycle, tenant)] = tenant
+
+                if queue and len(running) < self.max_workers:
+                    timeout = max(0.0, queue[0][0] - now)
+                else:
+                    # 空きが無い場合は実行中のサイクルが終わるまで待つ
+                    timeout = None
+                if not running:
+                    stop.wait(timeout)
+                    continue
+
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tenant = running.pop(future)
+                    cycles += 1
+                    heapq.heappush(queue, (self._clock() + future.result(), next(order), tenant))
+
+            # 実行中のサイクルは最後まで処理する
+            wait(running)
+
+    def close(self):
+        self.adapter.close()
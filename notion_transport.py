@@ -0,0 +1,243 @@
+import json
+import random
+import requests
+import threading
+import time
+from collections import deque
+from notion_metrics import MetricsHook
+from requests.adapters import HTTPAdapter
+from typing import Callable, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjsonがインストールされていれば高速なデコーダーを使う
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def notion_headers(api_key: str) -> dict:
+    """Notion APIの共通ヘッダー"""
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "Notion-Version": "2022-06-28"
+    }
+
+
+def parse_json(response):
+    """レスポンスのJSONを解析"""
+    if isinstance(response, requests.Response):
+        return json_loads(response.content)
+    return response.json()
+
+
+class RateLimiter:
+    """トークンバケット方式のクライアント側レートリミッター
+
+    Notion APIの上限（平均3リクエスト/秒）に合わせてリクエストの送信間隔を揃える。
+    429のRetry-Afterを受け取った場合は、その間すべての送信を止める。
+    """
+
+    def __init__(self, rate: float = 3.0, burst: int = 3, window: float = 10.0,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate
+        self.capacity = burst
+        self.window = window
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self._waiting = 0
+        self._sent = deque()
+
+    def _refill(self, now: float):
+        elapsed = max(now - self._updated, 0.0)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """送信可能になるまで待機してトークンを1つ消費"""
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                with self._lock:
+                    now = self._clock()
+                    self._refill(now)
+                    wait = self._blocked_until - now
+                    if wait <= 0 and self._tokens >= 1:
+                        self._tokens -= 1
+                        self._sent.append(now)
+                        return
+                    if wait <= 0:
+                        wait = (1 - self._tokens) / self.rate
+                self._sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def pause(self, seconds: float):
+        """Retry-Afterなどで指定された時間、全ての送信を停止"""
+        with self._lock:
+            now = self._clock()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = now
+
+    @property
+    def current_rate(self) -> float:
+        """直近window秒間の実際の送信レート（リクエスト/秒）"""
+        with self._lock:
+            threshold = self._clock() - self.window
+            while self._sent and self._sent[0] < threshold:
+                self._sent.popleft()
+            return len(self._sent) / self.window
+
+    @property
+    def queue_depth(self) -> int:
+        """トークン待ちのリクエスト数"""
+        with self._lock:
+            return self._waiting
+
+
+class NotionTransport:
+    """Notion APIへのHTTP通信をまとめるトランスポート
+
+    keep-aliveの requests.Session を使い回し、接続プールとデフォルトヘッダーを
+    全てのAPI呼び出しで共有する。
+    """
+
+    BASE_URL = "https://api.notion.com/v1"
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    # 接続エラー・タイムアウトでリトライを使い切った場合に返すレスポンスのステータスコード
+    NETWORK_ERROR_STATUS = 599
+
+    def __init__(self, headers: dict, base_url: str = BASE_URL, pool_size: int = 10,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 session: Optional[requests.Session] = None,
+                 rate_limiter: Optional[RateLimiter] = None, max_retries: int = 5,
+                 backoff_base: float = 0.5, backoff_max: float = 30.0,
+                 sleep: Callable[[float], None] = time.sleep,
+                 metrics: Optional[MetricsHook] = None,
+                 adapter: Optional[HTTPAdapter] = None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sleep = sleep
+        self.retries = 0
+        # 429を受け取った回数（ポーリング間隔の調整に使う）
+        self.throttled = 0
+        # 計測フック（Noneの場合は計測しない）
+        self.metrics = metrics
+
+        self.session = session or requests.Session()
+        # adapterを渡した場合は接続プールを他のトランスポートと共有する
+        adapter = adapter or HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # デフォルトヘッダーはセッション生成時に一度だけ設定する
+        self.session.headers.update(headers)
+
+    def url(self, path: str) -> str:
+        """APIパスを完全なURLに変換"""
+        if path.startswith(("http://", "https://")):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def _retry_delay(self, response: Optional[requests.Response], attempt: int) -> float:
+        """Retry-Afterを優先し、無ければジッター付き指数バックオフで待ち時間を決める"""
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _network_error(self, url: str, error: Exception) -> requests.Response:
+        """接続エラー・タイムアウトを失敗のレスポンスに変換（呼び出し側は他のAPIエラーと同じく扱える）"""
+        response = requests.Response()
+        response.status_code = self.NETWORK_ERROR_STATUS
+        response.url = url
+        response._content = json.dumps({
+            "object": "error", "status": self.NETWORK_ERROR_STATUS,
+            "code": "network_error", "message": str(error)}).encode("utf-8")
+        return response
+
+    def request(self, method: str, path: str, json: Optional[dict] = None,
+                params: Optional[dict] = None, operation: str = "") -> requests.Response:
+        """APIリクエストの送信（429/5xx・接続エラー・タイムアウトは自動でリトライ）
+
+        operationは計測用のAPI呼び出しの種類（query_tasks, patch_flagなど）。
+        """
+        if self.metrics is None:
+            return self._send(method, path, json, params)
+
+        started = time.monotonic()
+        response = self._send(method, path, json, params)
+        self.metrics.on_request(
+            operation or method.lower(), response.status_code, time.monotonic() - started,
+            len(response.content or b""), getattr(response, "retries", 0))
+        return response
+
+    def _send(self, method: str, path: str, json: Optional[dict],
+              params: Optional[dict]) -> requests.Response:
+        url = self.url(path)
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            try:
+                response = self.session.request(
+                    method, url, json=json, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # 5xxと同じくバックオフしてリトライし、使い切った場合は失敗のレスポンスを返す
+                if attempt >= self.max_retries:
+                    print(f"Giving up on {method} {url} after {attempt} retries: {e}")
+                    response = self._network_error(url, e)
+                    response.retries = attempt
+                    return response
+                delay = self._retry_delay(None, attempt)
+                attempt += 1
+                self.retries += 1
+                self._sleep(delay)
+                continue
+
+            if response.status_code not in self.RETRY_STATUS_CODES or attempt >= self.max_retries:
+                # このリクエストで行ったリトライ回数を記録しておく
+                response.retries = attempt
+                return response
+
+            delay = self._retry_delay(response, attempt)
+            attempt += 1
+            self.retries += 1
+            if response.status_code == 429:
+                self.throttled += 1
+            if response.status_code == 429 and self.rate_limiter:
+                # 429の間は他のリクエストも含めてリミッター側で待たせる
+                self.rate_limiter.pause(delay)
+            else:
+                self._sleep(delay)
+
+    def get(self, path: str, params: Optional[dict] = None, operation: str = "") -> requests.Response:
+        return self.request("GET", path, params=params, operation=operation)
+
+    def post(self, path: str, json: Optional[dict] = None, operation: str = "") -> requests.Response:
+        return self.request("POST", path, json=json, operation=operation)
+
+    def patch(self, path: str, json: Optional[dict] = None, operation: str = "") -> requests.Response:
+        return self.request("PATCH", path, json=json, operation=operation)
+
+    def close(self):
+        """接続プールを解放"""
+        self.session.close()
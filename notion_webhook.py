@@ -0,0 +1,154 @@
+import hashlib
+import hmac
+import json
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+
+def _normalize_id(page_id: str) -> str:
+    return page_id.replace("-", "").lower()
+
+
+def sign(secret: str, body: bytes) -> str:
+    """X-Notion-Signatureヘッダーの値（本文のHMAC-SHA256）"""
+    return "sha256=" + hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+
+
+def extract_page(event: dict) -> Tuple[Optional[str], Optional[str]]:
+    """イベントから(ページID, 親データベースID)を取り出す
+
+    Notionのwebhook（entity.id / data.parent.id）と
+    オートメーションの「Webhookを送信」（data.id / data.parent.database_id）の両方に対応する。
+    """
+    data = event.get("data") or {}
+    parent = data.get("parent") or {}
+    parent_id = parent.get("database_id") or parent.get("data_source_id") or parent.get("id")
+
+    entity = event.get("entity") or {}
+    if entity.get("type") == "page" and entity.get("id"):
+        return entity["id"], parent_id
+    if data.get("object") == "page" and data.get("id"):
+        return data["id"], parent_id
+    return None, parent_id
+
+
+class PendingPages:
+    """処理待ちのページID（同じページのイベントは1件にまとめる）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages: "OrderedDict[str, None]" = OrderedDict()
+        self.ready = threading.Event()
+
+    def add(self, page_id: str) -> bool:
+        """追加し、新しいページであればTrueを返す"""
+        with self._lock:
+            if page_id in self._pages:
+                return False
+            self._pages[page_id] = None
+            self.ready.set()
+            return True
+
+    def drain(self) -> List[str]:
+        with self._lock:
+            pages = list(self._pages)
+            self._pages.clear()
+            self.ready.clear()
+            return pages
+
+    def __len__(self) -> int:
+        return len(self._pages)
+
+
+class WebhookReceiver(ThreadingHTTPServer):
+    """Notionのwebhook・オートメーションのコールバックを受け取るローカルHTTPサーバー
+
+    POST（パスは任意）の本文をsecretのHMAC-SHA256で検証し、タスクDBのページのIDを
+    pendingに追加する。secretを指定しない場合は検証しない（ローカルでの確認用）。
+    Notionのwebhook登録時に送られるverification_tokenは表示するので、secretに設定する。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8787, secret: Optional[str] = None,
+                 database_id: Optional[str] = None):
+        super().__init__((host, port), _WebhookHandler)
+        self.secret = secret
+        # 親データベースが分かるイベントはこのデータベースのページのみ受け付ける
+        self.database_id = _normalize_id(database_id) if database_id else None
+        self.pending = PendingPages()
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self._thread = None
+
+    def verify(self, body: bytes, signature: str) -> bool:
+        if not self.secret:
+            return True
+        return hmac.compare_digest(sign(self.secret, body), signature or "")
+
+    def accept(self, event: dict) -> bool:
+        """イベントのページを処理待ちに追加（対象外のイベントはFalse）"""
+        page_id, parent_id = extract_page(event)
+        if not page_id:
+            return False
+        if self.database_id and parent_id and _normalize_id(parent_id) != self.database_id:
+            return False
+
+        self.received += 1
+        if not self.pending.add(page_id):
+            self.duplicates += 1
+        return True
+
+    def start(self) -> "WebhookReceiver":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            event = json.loads(body or b"{}")
+        except ValueError:
+            self._reply(400)
+            return
+
+        if "verification_token" in event:
+            # webhook登録時の確認リクエスト（このトークンをWEBHOOK_SECRETに設定する）
+            print(f"Received webhook verification token: {event['verification_token']}")
+            self._reply(200)
+            return
+
+        if not self.server.verify(body, self.headers.get("X-Notion-Signature")):
+            self.server.rejected += 1
+            self._reply(401)
+            return
+
+        self.server.accept(event)
+        self._reply(200)
@@ -1,6 +1,11 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 from notion_manage import NotionWorkloadManagement, ScheduleEntity, Response
+from fake_notion_server import FakeNotionServer
+from notion_failures import FailureLedger
+from notion_transport import NotionTransport, RateLimiter
 import requests
 
 class TestNotionWorkloadManagementErrors(unittest.TestCase):
@@ -9,10 +14,12 @@ class TestNotionWorkloadManagementErrors(unittest.TestCase):
         self.api_key = "test_api_key"
         self.schedule_db_id = "test_schedule_db_id"
         self.workload_db_id = "test_workload_db_id"
-        self.manager = NotionWorkloadManagement(self.api_key, self.schedule_db_id, self.workload_db_id)
+        self.transport = MagicMock()
+        self.manager = NotionWorkloadManagement(
+            self.api_key, self.schedule_db_id, self.workload_db_id, transport=self.transport)
 
-    @patch('notion_manage.requests.post')
-    def test_get_new_schedule_entries_api_error(self, mock_post):
+    def test_get_new_schedule_entries_api_error(self):
+        mock_post = self.transport.post
         # API エラーのシミュレーション
         mock_response = MagicMock()
         mock_response.status_code = 404
@@ -24,28 +31,50 @@ class TestNotionWorkloadManagementErrors(unittest.TestCase):
         self.assertEqual(result, [])
         self.assertTrue(mock_post.called)
 
-    @patch('notion_manage.requests.patch')
-    def test_update_workload_entry_api_error(self, mock_patch):
+    def test_update_workload_entry_api_error(self):
+        # 工数集計DBの検索は成功させる
+        query_response = MagicMock()
+        query_response.status_code = 200
+        query_response.json.return_value = {
+            "results": [{"id": "summary_id", "properties": {"予定": {"relation": []}}}]
+        }
+        self.transport.post.return_value = query_response
+
         # API エラーのシミュレーション
         mock_response = MagicMock()
         mock_response.status_code = 500
         mock_response.text = "Internal Server Error"
-        mock_patch.return_value = mock_response
+        self.transport.patch.return_value = mock_response
 
-        test_schedule = ScheduleEntity(id="test_id", title="Test Title")
+        test_schedule = ScheduleEntity(id="test_id", title="Test Title", client_id="client_id")
         result = self.manager.update_workload_entry(test_schedule)
 
         self.assertEqual(result.status_code, 500)
         self.assertEqual(result.error_code, "UPDATE_FAILED")
         self.assertEqual(result.error_message, "Internal Server Error")
 
-    @patch('notion_manage.requests.patch')
-    def test_update_schedule_flag_api_error(self, mock_patch):
+    def test_update_workload_entry_not_found_is_cached(self):
+        # 工数集計ページが存在しない顧問先
+        query_response = MagicMock()
+        query_response.status_code = 200
+        query_response.json.return_value = {"results": []}
+        self.transport.post.return_value = query_response
+
+        test_schedule = ScheduleEntity(id="test_id", title="Test Title", client_id="client_id")
+        first = self.manager.update_workload_entry(test_schedule)
+        second = self.manager.update_workload_entry(test_schedule)
+
+        self.assertEqual(first.error_code, "NOT_FOUND")
+        self.assertEqual(second.error_code, "NOT_FOUND")
+        self.assertEqual(self.transport.post.call_count, 1)
+        self.transport.patch.assert_not_called()
+
+    def test_update_schedule_flag_api_error(self):
         # API エラーのシミュレーション
         mock_response = MagicMock()
         mock_response.status_code = 403
         mock_response.text = "Forbidden"
-        mock_patch.return_value = mock_response
+        self.transport.patch.return_value = mock_response
 
         test_schedule = ScheduleEntity(id="test_id", title="Test Title")
         result = self.manager.update_schedule_flag(test_schedule)
@@ -54,12 +83,12 @@ class TestNotionWorkloadManagementErrors(unittest.TestCase):
         self.assertEqual(result.error_code, "FLAG_UPDATE_FAILED")
         self.assertEqual(result.error_message, "Forbidden")
 
-    @patch('notion_manage.NotionWorkloadManagement.get_new_schedule_entries')
-    @patch('notion_manage.NotionWorkloadManagement.update_workload_entry')
+    @patch('notion_manage.NotionWorkloadManagement.iter_new_schedule_batches')
+    @patch('notion_manage.NotionWorkloadManagement.update_workload_entries')
     @patch('notion_manage.NotionWorkloadManagement.update_schedule_flag')
     def test_process_new_entries_with_errors(self, mock_flag, mock_workload, mock_get):
         # 新しいエントリーのシミュレーション
-        mock_get.return_value = [ScheduleEntity(id="test_id", title="Test Title")]
+        mock_get.return_value = iter([[ScheduleEntity(id="test_id", title="Test Title")]])
         
         # workload更新エラーのシミュレーション
         mock_workload.return_value = Response(status_code=500, error_code="UPDATE_FAILED", error_message="Error")
@@ -72,5 +101,261 @@ class TestNotionWorkloadManagementErrors(unittest.TestCase):
         self.assertTrue(mock_workload.called)
         self.assertFalse(mock_flag.called)  # workloadの更新に失敗したので、フラグの更新は呼ばれないはず
 
+    @patch('notion_manage.NotionWorkloadManagement.iter_new_schedule_batches')
+    @patch('notion_manage.NotionWorkloadManagement.update_workload_entries')
+    @patch('notion_manage.NotionWorkloadManagement.update_schedule_flag')
+    def test_failed_entry_is_quarantined_with_backoff(self, mock_flag, mock_workload, mock_get):
+        # 工数集計ページが無い顧問先のエントリーが毎サイクル取得される
+        entry = ScheduleEntity(id="test_id", title="Test Title", client_id="client_id",
+                               last_edited_time="2024-01-01T00:00:00.000Z")
+        mock_get.side_effect = lambda since=None, failed=None: iter([[entry]])
+        mock_workload.return_value = Response(
+            status_code=404, error_code="NOT_FOUND", error_message="Workload summary not found")
+        now = [1000.0]
+        ledger_path = os.path.join(tempfile.mkdtemp(), "failure_ledger.json")
+        self.manager.failures = FailureLedger(ledger_path, base_delay=60, clock=lambda: now[0])
+
+        first = self.manager.process_new_entries()
+        # 再試行時刻前は処理を見送る
+        second = self.manager.process_new_entries()
+
+        self.assertEqual((first.failed, first.skipped), (1, 0))
+        self.assertEqual((second.failed, second.skipped), (0, 1))
+        self.assertEqual(mock_workload.call_count, 1)
+        mock_flag.assert_not_called()
+
+        # 再試行時刻を過ぎると再試行し、次の待ち時間は倍になる
+        now[0] += 60
+        self.manager.process_new_entries()
+        self.assertEqual(mock_workload.call_count, 2)
+        quarantined = FailureLedger(ledger_path, clock=lambda: now[0]).quarantined()
+        self.assertEqual(len(quarantined), 1)
+        self.assertEqual(quarantined[0]["page_id"], "test_id")
+        self.assertEqual(quarantined[0]["attempts"], 2)
+        self.assertEqual(quarantined[0]["retry_at"], now[0] + 120)
+        self.assertIn("NOT_FOUND", quarantined[0]["reason"])
+
+        # ページが編集された場合はすぐに再試行する
+        entry.last_edited_time = "2024-01-02T00:00:00.000Z"
+        mock_workload.return_value = Response()
+        mock_flag.return_value = Response()
+        stats = self.manager.process_new_entries()
+        self.assertEqual(stats.succeeded, 1)
+        self.assertEqual(len(self.manager.failures), 0)
+
+    def test_transport_retries_throttled_request(self):
+        # 429(Retry-After付き)と503の後に成功するセッション
+        throttled = MagicMock(status_code=429, headers={"Retry-After": "2"})
+        unavailable = MagicMock(status_code=503, headers={})
+        success = MagicMock(status_code=200, headers={})
+        session = MagicMock()
+        session.headers = {}
+        session.request.side_effect = [throttled, unavailable, success]
+        limiter = MagicMock()
+        sleeps = []
+        transport = NotionTransport(
+            self.manager.headers, session=session, rate_limiter=limiter, sleep=sleeps.append)
+
+        response = transport.post("databases/test/query", json={})
+
+        self.assertIs(response, success)
+        self.assertEqual(session.request.call_count, 3)
+        self.assertEqual(limiter.acquire.call_count, 3)
+        limiter.pause.assert_called_once_with(2.0)
+        self.assertEqual(len(sleeps), 1)
+        self.assertEqual(transport.retries, 2)
+
+    def test_transport_gives_up_after_max_retries(self):
+        throttled = MagicMock(status_code=429, headers={"Retry-After": "0"})
+        session = MagicMock()
+        session.headers = {}
+        session.request.return_value = throttled
+        transport = NotionTransport(
+            self.manager.headers, session=session, max_retries=2, sleep=lambda _: None)
+
+        response = transport.get("databases/test")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(session.request.call_count, 3)
+
+    def test_interrupted_full_sweep_is_not_marked_complete(self):
+        state_path = os.path.join(tempfile.mkdtemp(), "poll_state.json")
+        manager = NotionWorkloadManagement(
+            self.api_key, self.schedule_db_id, self.workload_db_id, page_size=1,
+            transport=self.transport, state_path=state_path)
+        manager.refresh_summary_index = MagicMock()
+        manager.refresh_task_graph = MagicMock()
+        manager._process_batch = MagicMock(return_value=1)
+
+        # 1ページ目は取得できたが、2ページ目でエラーになる
+        first_page = MagicMock(status_code=200)
+        first_page.json.return_value = {
+            "results": [{"id": "task_1", "last_edited_time": "2024-11-07T09:00:00.000Z",
+                         "properties": {"顧問先リスト": {"relation": [{"id": "client_id"}]}}}],
+            "has_more": True, "next_cursor": "cursor_2"}
+        error = MagicMock(status_code=502, text="Bad Gateway")
+        self.transport.post.side_effect = [first_page, error]
+
+        stats = manager.process_new_entries()
+
+        # 全件検索は昇順で取得し、完了扱いにしない（最高水位は読めたページまで）
+        self.assertEqual(stats.entries, 1)
+        payload = self.transport.post.call_args_list[0].kwargs["json"]
+        self.assertEqual(payload["sorts"], [{"timestamp": "last_edited_time", "direction": "ascending"}])
+        self.assertEqual(manager.poll_state.last_full_sweep, 0.0)
+        self.assertEqual(manager.poll_state.watermark, "2024-11-07T09:00:00.000Z")
+        self.assertTrue(manager.poll_state.full_sweep_due(manager.full_sweep_interval))
+
+    def test_transport_retries_network_errors_then_returns_failed_response(self):
+        # タイムアウト・接続エラーは例外を送出せず、リトライ後に失敗のレスポンスを返す
+        session = MagicMock()
+        session.headers = {}
+        session.request.side_effect = [requests.Timeout("read timed out"),
+                                       MagicMock(status_code=200, headers={})]
+        sleeps = []
+        transport = NotionTransport(self.manager.headers, session=session, sleep=sleeps.append)
+        self.assertEqual(transport.get("databases/test").status_code, 200)
+        self.assertEqual(len(sleeps), 1)
+
+        session.request.side_effect = requests.ConnectionError("connection refused")
+        transport = NotionTransport(
+            self.manager.headers, session=session, max_retries=2, sleep=lambda _: None)
+        response = transport.patch("pages/test", json={})
+        self.assertEqual(response.status_code, NotionTransport.NETWORK_ERROR_STATUS)
+        self.assertIn("connection refused", response.text)
+        self.assertEqual(response.retries, 2)
+
+        # マネージャーからはAPIエラーとして扱われる
+        manager = NotionWorkloadManagement(
+            self.api_key, self.schedule_db_id, self.workload_db_id, transport=transport)
+        flag_response = manager.update_schedule_flag(ScheduleEntity("test_entry_id"))
+        self.assertEqual(flag_response.error_code, "FLAG_UPDATE_FAILED")
+
+    def test_relation_over_api_limit_is_reported_not_retried(self):
+        # 予定が既に上限（100件）まで埋まっている集計ページ
+        server = FakeNotionServer(seed=13).start()
+        self.addCleanup(server.stop)
+        seeded = server.seed_workload(tasks=2, clients=1, existing_tasks_per_client=100)
+        transport = NotionTransport({}, base_url=server.url)
+        summary_id = server._rows[seeded["summary_db_id"]][0]
+
+        # サーバーも101件以上のリレーションは受け付けない
+        response = transport.patch(f"pages/{summary_id}", json={"properties": {"予定": {"relation": [
+            {"id": f"task_{index}"} for index in range(101)]}}})
+        self.assertEqual(response.status_code, 400)
+
+        now = [1000.0]
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"], transport=transport)
+        manager.failures = FailureLedger(clock=lambda: now[0])
+        server.reset_stats()
+        stats = manager.process_new_entries()
+
+        # 書き込まずに理由を記録し、最長の間隔を空けて再試行する
+        self.assertEqual((stats.entries, stats.succeeded), (2, 0))
+        self.assertEqual(server.calls["PATCH /pages/{id}"], 0)
+        quarantined = manager.failures.quarantined()
+        self.assertEqual(len(quarantined), 2)
+        self.assertTrue(all(record["reason"].startswith("RELATION_LIMIT_EXCEEDED") for record in quarantined))
+        self.assertTrue(all(record["retry_at"] == now[0] + manager.failures.max_delay for record in quarantined))
+
+    def test_reconcile_skips_summary_over_relation_limit_and_continues(self):
+        # 1件目の顧問先は予定が102件に、2件目は100件になる
+        server = FakeNotionServer(seed=15).start()
+        self.addCleanup(server.stop)
+        seeded = server.seed_workload(tasks=0, clients=2, existing_tasks_per_client=99)
+        over_limit = server.add_tasks(seeded["task_db_id"], 3, seeded["client_ids"][:1])
+        within_limit = server.add_tasks(seeded["task_db_id"], 1, seeded["client_ids"][1:])
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), "reconcile_checkpoint.json")
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url))
+
+        report = manager.reconcile(apply=True, checkpoint_path=checkpoint_path)
+
+        # 上限を超えるページは記録して完了扱いにし、残りの計画は書き込む
+        self.assertEqual(report.summaries_patched, 1)
+        self.assertEqual(len(report.summaries_failed), 1)
+        self.assertTrue(next(iter(report.summaries_failed.values())).startswith("RELATION_LIMIT_EXCEEDED"))
+        self.assertEqual((report.flags_patched, report.flags_skipped), (1, 3))
+        self.assertFalse(os.path.exists(checkpoint_path))
+        self.assertEqual({entry.id for entry in manager.get_new_schedule_entries()}, set(over_limit))
+        self.assertEqual(server.pages[within_limit[0]]["properties"]["フラグ"]["checkbox"], True)
+
+    def test_rate_limiter_waits_for_tokens_and_retry_after(self):
+        # 仮想時計で待ち時間を検証
+        now = [0.0]
+        sleeps = []
+
+        def fake_sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        limiter = RateLimiter(rate=2.0, burst=1, clock=lambda: now[0], sleep=fake_sleep)
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(sleeps, [0.5])
+
+        limiter.pause(3.0)
+        limiter.acquire()
+        self.assertAlmostEqual(sum(sleeps), 0.5 + 3.0)
+        self.assertEqual(limiter.queue_depth, 0)
+
+    def test_process_new_entries_recovers_from_throttling(self):
+        # 3割のリクエストに429を返すローカルサーバー
+        server = FakeNotionServer(throttle_rate=0.3, retry_after=0.01, seed=2).start()
+        self.addCleanup(server.stop)
+        seeded = server.seed_workload(tasks=20, clients=4)
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url, max_retries=10,
+                                      rate_limiter=RateLimiter(rate=1000, burst=10)))
+
+        stats = manager.process_new_entries()
+
+        self.assertEqual(stats.succeeded, 20)
+        self.assertGreater(server.status_codes[429], 0)
+        self.assertEqual(manager.transport.throttled, server.status_codes[429])
+
+    def test_projected_query_falls_back_when_schema_changed(self):
+        server = FakeNotionServer(seed=5).start()
+        self.addCleanup(server.stop)
+        seeded = server.seed_workload(tasks=5, clients=1)
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"], page_size=2,
+            transport=NotionTransport({}, base_url=server.url))
+        # 古いスキーマ（存在しないプロパティID）がキャッシュされている状態
+        manager.schema_cache.update(seeded["task_db_id"], {
+            name: {"id": f"old-{index}", "type": "rich_text"}
+            for index, name in enumerate(manager.task_properties.values())
+        })
+        manager.schema_cache.update(seeded["summary_db_id"], {"顧客先DB": {"id": "cl%3Ai", "type": "relation"}})
+
+        entries = manager.get_new_schedule_entries()
+
+        # 無効なプロパティIDは1回しか送らず、以降のページは全プロパティで取得する
+        self.assertEqual(len(entries), 5)
+        self.assertEqual(server.status_codes[400], 1)
+        self.assertEqual(server.calls["POST /databases/{id}/query"], 4)
+        # 破棄するのはエラーになったデータベースのスキーマのみ
+        self.assertIsNone(manager.schema_cache.get(seeded["task_db_id"]))
+        self.assertEqual(manager.schema_cache.get(seeded["summary_db_id"]), {"顧客先DB": "cl%3Ai"})
+
+    def test_query_error_other_than_projection_keeps_schema_cache(self):
+        manager = self.manager
+        manager.schema_cache.update(self.schedule_db_id, {"フラグ": {"id": "fl%3Ag", "type": "checkbox"}})
+        rejected = MagicMock(status_code=400, text="Invalid start_cursor.")
+        rejected.json.return_value = {"code": "validation_error", "message": "Invalid start_cursor."}
+        self.transport.post.return_value = rejected
+
+        response = manager._query_database_page(
+            f"databases/{self.schedule_db_id}/query", {}, "cursor", property_ids=["fl%3Ag"])
+
+        # プロパティIDとは関係ないエラーは全プロパティで再実行せず、スキーマも破棄しない
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.transport.post.call_count, 1)
+        self.assertEqual(manager.schema_cache.get(self.schedule_db_id), {"フラグ": "fl%3Ag"})
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
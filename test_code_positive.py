@@ -1,7 +1,22 @@
+import json
+import os
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock
 from datetime import datetime
 from notion_manage import NotionWorkloadManagement, ScheduleEntity, Response
+from fake_notion_server import SUMMARY_SCHEMA, TASK_SCHEMA, FakeNotionServer
+from notion_cache import SummaryEntry, WorkloadSummaryIndex
+from notion_graph import TaskGraph
+from notion_journal import Journal
+from notion_leases import LeaseStore, partition_of
+from notion_metrics import Metrics, MetricsServer
+from notion_reconcile import ReconcileCheckpoint, ReconcileReport, build_plan
+from notion_scheduler import AdaptivePollScheduler
+from notion_tenants import MultiTenantRunner, TenantConfig
+from notion_transport import NotionTransport
+from notion_webhook import WebhookReceiver, sign
 
 
 class TestNotionWorkloadManagement(unittest.TestCase):
@@ -10,11 +25,14 @@ class TestNotionWorkloadManagement(unittest.TestCase):
         self.api_key = "test_api_key"
         self.schedule_db_id = "test_schedule_db_id"
         self.workload_db_id = "test_workload_db_id"
+        # requestsをパッチせずに差し替えられるモックのトランスポート
+        self.transport = MagicMock()
         self.manager = NotionWorkloadManagement(
-            self.api_key, self.schedule_db_id, self.workload_db_id)
+            self.api_key, self.schedule_db_id, self.workload_db_id,
+            transport=self.transport)
 
-    @patch('notion_manage.requests.post')
-    def test_get_new_schedule_entries(self, mock_post):
+    def test_get_new_schedule_entries(self):
+        mock_post = self.transport.post
         # モックレスポンスの設定
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -23,7 +41,7 @@ class TestNotionWorkloadManagement(unittest.TestCase):
                 {
                     "id": "test_id_1",
                     "properties": {
-                        "タイトル": {"title": [{"plain_text": "Test Title 1"}]},
+                        "名前": {"title": [{"plain_text": "Test Title 1"}]},
                         "フラグ": {"number": 0}
                     }
                 }
@@ -41,15 +59,96 @@ class TestNotionWorkloadManagement(unittest.TestCase):
         self.assertEqual(result[0].title, "Test Title 1")
         self.assertEqual(result[0].flag, 0)
 
-    @patch('notion_manage.requests.patch')
-    def test_update_workload_entry(self, mock_patch):
+    def test_get_new_schedule_entries_follows_cursor(self):
+        mock_post = self.transport.post
+        # 2ページに分かれたモックレスポンスの設定
+        first_page = MagicMock()
+        first_page.status_code = 200
+        first_page.json.return_value = {
+            "results": [{"id": "test_id_1", "properties": {}}],
+            "has_more": True,
+            "next_cursor": "cursor_2"
+        }
+        second_page = MagicMock()
+        second_page.status_code = 200
+        second_page.json.return_value = {
+            "results": [{"id": "test_id_2", "properties": {}}],
+            "has_more": False,
+            "next_cursor": None
+        }
+        mock_post.side_effect = [first_page, second_page]
+
+        # メソッドの実行
+        result = list(self.manager.iter_new_schedule_entries(page_size=1))
+
+        # アサーション
+        self.assertEqual([entry.id for entry in result], ["test_id_1", "test_id_2"])
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(mock_post.call_args_list[0].kwargs["json"]["page_size"], 1)
+        self.assertNotIn("start_cursor", mock_post.call_args_list[0].kwargs["json"])
+        self.assertEqual(mock_post.call_args_list[1].kwargs["json"]["start_cursor"], "cursor_2")
+
+    def test_incremental_poll_uses_persisted_watermark(self):
+        state_path = os.path.join(tempfile.mkdtemp(), "poll_state.json")
+        manager = NotionWorkloadManagement(
+            self.api_key, self.schedule_db_id, self.workload_db_id,
+            transport=self.transport, state_path=state_path)
+        manager.refresh_summary_index = MagicMock()
+        manager._process_batch = MagicMock(return_value=1)
+
+        page = MagicMock(status_code=200)
+        page.json.return_value = {
+            "results": [{"id": "task_1", "last_edited_time": "2024-11-07T10:00:00.000Z",
+                         "properties": {}}],
+            "has_more": False
+        }
+        self.transport.post.return_value = page
+
+        # 初回は全件検索し、最高水位を保存する
+        manager.process_new_entries()
+        first_payload = self.transport.post.call_args.kwargs["json"]
+        self.assertEqual(len(first_payload["filter"]["and"]), 2)
+
+        # 再起動後は保存した最高水位以降のみ昇順で取得する
+        restarted = NotionWorkloadManagement(
+            self.api_key, self.schedule_db_id, self.workload_db_id,
+            transport=self.transport, state_path=state_path)
+        restarted.refresh_summary_index = MagicMock()
+        restarted._process_batch = MagicMock(return_value=1)
+        restarted.process_new_entries()
+
+        payload = self.transport.post.call_args.kwargs["json"]
+        self.assertEqual(payload["filter"]["and"][2]["last_edited_time"],
+                         {"on_or_after": "2024-11-07T10:00:00.000Z"})
+        self.assertEqual(payload["sorts"][0]["direction"], "ascending")
+
+        # 全件検索の間隔を過ぎると再び全件検索する（全件検索も昇順で取得する）
+        restarted.full_sweep_interval = 0
+        restarted.process_new_entries()
+        payload = self.transport.post.call_args.kwargs["json"]
+        self.assertEqual(len(payload["filter"]["and"]), 2)
+        self.assertEqual(payload["sorts"][0]["direction"], "ascending")
+
+    def test_update_workload_entry(self):
         # モックレスポンスの設定
+        query_response = MagicMock()
+        query_response.status_code = 200
+        query_response.json.return_value = {
+            "results": [
+                {
+                    "id": "summary_id",
+                    "properties": {"予定": {"relation": [{"id": "existing_id"}]}}
+                }
+            ]
+        }
+        self.transport.post.return_value = query_response
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_patch.return_value = mock_response
+        self.transport.patch.return_value = mock_response
 
         # テスト用のScheduleEntityの作成
-        test_schedule = ScheduleEntity(id="test_id", title="Test Title")
+        test_schedule = ScheduleEntity(
+            id="test_id", title="Test Title", client_id="client_id")
 
         # メソッドの実行
         result = self.manager.update_workload_entry(test_schedule)
@@ -57,13 +156,192 @@ class TestNotionWorkloadManagement(unittest.TestCase):
         # アサーション
         self.assertIsInstance(result, Response)
         self.assertEqual(result.status_code, 200)
+        self.assertEqual(
+            self.transport.patch.call_args.kwargs["json"]["properties"]["予定"]["relation"],
+            [{"id": "existing_id"}, {"id": "test_id"}])
+
+    def test_update_workload_entry_uses_summary_index(self):
+        # 一括読み込み済みのインデックス
+        self.manager.summary_index.ingest([
+            {
+                "id": "summary_id",
+                "last_edited_time": "2024-11-07T00:00:00.000Z",
+                "properties": {
+                    "顧客先DB": {"relation": [{"id": "client_id"}]},
+                    "予定": {"relation": [{"id": "existing_id"}]}
+                }
+            }
+        ], "顧客先DB", "予定")
+        self.transport.patch.return_value = MagicMock(status_code=200)
+
+        # 同じ顧問先のタスクを2件処理
+        for task_id in ("task_1", "task_2"):
+            result = self.manager.update_workload_entry(
+                ScheduleEntity(id=task_id, title="Test Title", client_id="client_id"))
+            self.assertEqual(result.status_code, 200)
+
+        # アサーション（集計DBの検索は行わない）
+        self.transport.post.assert_not_called()
+        self.assertEqual(
+            self.transport.patch.call_args.kwargs["json"]["properties"]["予定"]["relation"],
+            [{"id": "existing_id"}, {"id": "task_1"}, {"id": "task_2"}])
+        self.assertEqual(self.manager.summary_index.watermark, "2024-11-07T00:00:00.000Z")
+
+    def test_summary_index_refresh_resumes_after_partial_scan(self):
+        # 1ページ目の後にエラーで中断した読み込み
+        def summary_page(page_id, edited):
+            return {"id": page_id, "last_edited_time": edited, "properties": {
+                "顧客先DB": {"relation": [{"id": f"client_{page_id}"}]}, "予定": {"relation": []}}}
+        first_page = MagicMock(status_code=200)
+        first_page.json.return_value = {
+            "results": [summary_page("a", "2024-11-01T00:00:00.000Z"),
+                        summary_page("b", "2024-11-02T00:00:00.000Z")],
+            "has_more": True, "next_cursor": "cursor"}
+        empty_page = MagicMock(status_code=200)
+        empty_page.json.return_value = {"results": [], "has_more": False}
+        self.transport.post.side_effect = [first_page, MagicMock(status_code=500, text="error"), empty_page]
+        self.manager.refresh_summary_index()
+        self.manager.refresh_summary_index()
+
+        # 編集日時の昇順で取得し、読み込めた範囲の最高水位から再開する
+        payloads = [call.kwargs["json"] for call in self.transport.post.call_args_list]
+        self.assertTrue(all(payload["sorts"] == [{"timestamp": "last_edited_time", "direction": "ascending"}]
+                            for payload in payloads))
+        self.assertNotIn("filter", payloads[0])
+        self.assertEqual(payloads[2]["filter"]["last_edited_time"]["on_or_after"], "2024-11-02T00:00:00.000Z")
+
+    def test_summary_index_evicts_by_lru_and_ttl(self):
+        now = [0.0]
+        index = WorkloadSummaryIndex(max_entries=2, ttl=10, negative_ttl=1, clock=lambda: now[0])
+        index.put("client_1", SummaryEntry("page_1"))
+        index.put("client_2", SummaryEntry("page_2"))
+        index.get("client_1")
+        index.put("client_3", None)
 
-    @patch('notion_manage.requests.patch')
-    def test_update_schedule_flag(self, mock_patch):
+        # 最も古く使われたclient_2が破棄される
+        self.assertIs(index.get("client_2"), WorkloadSummaryIndex.MISS)
+        self.assertEqual(index.get("client_1").page_id, "page_1")
+        self.assertIsNone(index.get("client_3"))
+
+        # negative_ttl経過後は再検索の対象になる
+        now[0] = 5
+        self.assertIs(index.get("client_3"), WorkloadSummaryIndex.MISS)
+        now[0] = 11
+        self.assertIs(index.get("client_1"), WorkloadSummaryIndex.MISS)
+
+    def test_process_new_entries_coalesces_by_client(self):
+        # 2つの顧問先にまたがる3件のエントリー
+        self.manager.summary_index.loaded = True
+        for client_id, page_id in (("client_a", "summary_a"), ("client_b", "summary_b")):
+            self.manager.summary_index.put(client_id, SummaryEntry(page_id, ["existing_id"]))
+        entries = [
+            ScheduleEntity(id="task_1", title="Task 1", client_id="client_a"),
+            ScheduleEntity(id="task_2", title="Task 2", client_id="client_b"),
+            ScheduleEntity(id="task_3", title="Task 3", client_id="client_a"),
+        ]
+        self.manager.iter_new_schedule_batches = MagicMock(return_value=iter([entries]))
+        self.manager.refresh_summary_index = MagicMock()
+        self.transport.patch.return_value = MagicMock(status_code=200)
+
+        # メソッドの実行
+        self.manager.process_new_entries()
+
+        # アサーション（集計ページへのPATCHは顧問先ごとに1回）
+        patched = [call.args[0] for call in self.transport.patch.call_args_list]
+        self.assertEqual(patched.count("pages/summary_a"), 1)
+        self.assertEqual(patched.count("pages/summary_b"), 1)
+        self.assertEqual(len(patched), 5)
+        summary_a_payload = self.transport.patch.call_args_list[0].kwargs["json"]
+        self.assertEqual(
+            summary_a_payload["properties"]["予定"]["relation"],
+            [{"id": "existing_id"}, {"id": "task_1"}, {"id": "task_3"}])
+
+    def test_process_new_entries_concurrently(self):
+        # 3つの顧問先と共通の親タスクを持つエントリー
+        self.manager.summary_index.loaded = True
+        for client_id in ("client_a", "client_b", "client_c"):
+            self.manager.summary_index.put(client_id, SummaryEntry(f"summary_{client_id}"))
+        entries = [
+            ScheduleEntity(id=f"task_{i}", title=f"Task {i}",
+                           client_id=("client_a", "client_b", "client_c")[i % 3],
+                           parent_task_id="parent_id")
+            for i in range(9)
+        ]
+        self.manager.iter_new_schedule_batches = MagicMock(return_value=iter([entries]))
+        self.manager.refresh_summary_index = MagicMock()
+        self.manager.schema_cache.update(self.schedule_db_id, {"子タスク": {"id": "ch%3At", "type": "relation"}})
+        # 親タスクには既に子タスクが1件ある
+        children = MagicMock(status_code=200)
+        children.json.return_value = {"results": [{"relation": {"id": "existing_child"}}], "has_more": False}
+        self.transport.get.return_value = children
+        self.transport.patch.return_value = MagicMock(status_code=200)
+
+        # メソッドの実行
+        stats = self.manager.process_new_entries(max_workers=3)
+
+        # アサーション（親1件 + 集計3件 + フラグ9件）
+        self.assertEqual(stats.entries, 9)
+        self.assertEqual(stats.succeeded, 9)
+        self.assertEqual(self.transport.patch.call_count, 13)
+        self.assertEqual(len(self.manager._page_locks), 0)
+        self.transport.get.assert_called_once()
+        parent_payload = next(call.kwargs["json"] for call in self.transport.patch.call_args_list
+                              if call.args[0] == "pages/parent_id")
+        self.assertEqual(
+            parent_payload["properties"]["子タスク"]["relation"],
+            [{"id": "existing_child"}] + [{"id": f"task_{i}"} for i in range(9)])
+
+    def test_update_workload_entry_reads_full_relation(self):
+        # クエリ結果のリレーションが切り詰められている集計ページ
+        self.manager.summary_index.ingest([
+            {
+                "id": "summary_id",
+                "properties": {
+                    "顧客先DB": {"relation": [{"id": "client_id"}]},
+                    "予定": {"relation": [{"id": "task_0"}], "has_more": True}
+                }
+            }
+        ], "顧客先DB", "予定")
+
+        schema_response = MagicMock(status_code=200)
+        schema_response.json.return_value = {"properties": {"予定": {"id": "abc%3D"}}}
+        first_page = MagicMock(status_code=200)
+        first_page.json.return_value = {
+            "results": [{"relation": {"id": "task_0"}}, {"relation": {"id": "task_1"}}],
+            "has_more": True,
+            "next_cursor": "cursor_2"
+        }
+        second_page = MagicMock(status_code=200)
+        second_page.json.return_value = {
+            "results": [{"relation": {"id": "task_2"}}],
+            "has_more": False,
+            "next_cursor": None
+        }
+        self.transport.get.side_effect = [schema_response, first_page, second_page]
+        self.transport.patch.return_value = MagicMock(status_code=200)
+
+        # 既に登録済みのtask_1と新規のtask_3
+        result = self.manager.update_workload_entries("client_id", [
+            ScheduleEntity(id="task_1", title="Task 1", client_id="client_id"),
+            ScheduleEntity(id="task_3", title="Task 3", client_id="client_id"),
+        ])
+
+        # アサーション
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(self.transport.get.call_args_list[1].args[0],
+                         "pages/summary_id/properties/abc%3D")
+        self.assertEqual(self.transport.get.call_args_list[2].kwargs["params"]["start_cursor"],
+                         "cursor_2")
+        self.assertEqual(
+            self.transport.patch.call_args.kwargs["json"]["properties"]["予定"]["relation"],
+            [{"id": "task_0"}, {"id": "task_1"}, {"id": "task_2"}, {"id": "task_3"}])
+        self.assertTrue(self.manager.summary_index.get("client_id").complete)
+
+    def test_update_schedule_flag(self):
         # モックレスポンスの設定
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_patch.return_value = mock_response
+        self.transport.patch.return_value = mock_response
 
         # テスト用のScheduleEntityの作成
         test_schedule = ScheduleEntity(id="test_id", title="Test Title")
@@ -75,6 +353,591 @@ class TestNotionWorkloadManagement(unittest.TestCase):
         self.assertIsInstance(result, Response)
         self.assertEqual(result.status_code, 200)
 
+    def test_transport_uses_shared_session(self):
+        # セッションをモックに差し替えたトランスポート
+        session = MagicMock()
+        session.headers = {}
+        transport = NotionTransport(
+            self.manager.headers, session=session, connect_timeout=1, read_timeout=2)
+
+        # メソッドの実行
+        transport.patch("pages/test_id", json={"properties": {}})
+
+        # アサーション
+        self.assertEqual(session.headers["Authorization"], "Bearer test_api_key")
+        session.request.assert_called_once_with(
+            "PATCH", "https://api.notion.com/v1/pages/test_id",
+            json={"properties": {}}, params=None, timeout=(1, 2))
+
+    def test_adaptive_scheduler_adjusts_interval(self):
+        scheduler = AdaptivePollScheduler(interval=16, min_interval=1, max_interval=60)
+
+        # エントリーがある間は間隔を縮め、処理時間を差し引く
+        self.assertEqual(scheduler.next_delay(entries=5, duration=3), 5)
+        # ページ上限に達した場合は最短間隔
+        self.assertEqual(scheduler.next_delay(entries=100, has_more=True), 1)
+        # 空振りが続くと上限まで延ばす
+        for _ in range(10):
+            scheduler.next_delay(entries=0)
+        self.assertEqual(scheduler.interval, 60)
+        # 処理時間が間隔を超えた場合は待たない
+        self.assertEqual(scheduler.next_delay(entries=0, duration=90), 0)
+
+    def test_journal_prunes_entries_that_will_not_be_replayed(self):
+        now = [1000.0]
+        journal = Journal(max_age=3600, clock=lambda: now[0])
+        data = {"client_id": "client_id", "parent_task_id": None}
+        journal.intents("workload", [(page_id, data) for page_id in ("retrying", "given_up", "unowned")])
+        journal.failed("workload", "retrying")
+        journal.failed("workload", "given_up")
+
+        # 失敗したエントリーはFailureLedgerで追跡されなくなった時点で外す
+        self.assertEqual(journal.prune(lambda page_id: page_id == "retrying"), 1)
+        self.assertEqual(set(journal.unfinished()), {"unowned"})
+        self.assertEqual(len(journal), 2)
+
+        # 再実行されないまま残ったエントリーはmax_ageを過ぎた時点で外す
+        now[0] += 3601
+        self.assertEqual(journal.prune(lambda page_id: True), 2)
+        self.assertEqual(len(journal), 0)
+
+    def test_task_graph_answers_hierarchy_locally(self):
+        graph = TaskGraph()
+        graph.set_children("root", ["a", "b"])
+        graph.set_children("a", ["a1", "a2"])
+        for page_id, workload in (("root", 1), ("a", 2), ("b", 3), ("a1", 4), ("a2", 5)):
+            graph.set_workload(page_id, workload)
+
+        self.assertEqual(graph.parent("a1"), "a")
+        self.assertEqual(graph.ancestors("a2"), ["a", "root"])
+        self.assertEqual(graph.subtree_workload("root"), 15)
+        self.assertEqual(graph.subtree_workload("a"), 11)
+
+        # 付け替えと工数の変更は祖先の合計に反映される
+        graph.set_parent("a1", "b")
+        graph.set_workload("a2", 1)
+        self.assertEqual(graph.subtree_workload("a"), 3)
+        self.assertEqual(graph.subtree_workload("b"), 7)
+        self.assertEqual(graph.subtree_workload("root"), 11)
+        self.assertEqual(sorted(graph.children("b")), ["a1"])
+
+        # 循環する親子関係は設定しない
+        self.assertFalse(graph.set_parent("root", "a2"))
+        self.assertIsNone(graph.parent("root"))
+
+    def test_reconcile_plan_diffs_summary_pages_shared_by_clients(self):
+        # 顧問先AとBが同じ集計ページPに紐付いている
+        summaries = {"A": ("P", ["a1", "b1", "x1"]), "B": ("P", ["a1", "b1", "x1"])}
+        report, plan, flags = build_plan({"A": ["a1", "a2"], "B": ["b1", "b2"]}, summaries, {"a2"}, prune=True)
+
+        self.assertEqual(plan, {"P": {"client_ids": ["A", "B"], "add": ["a2", "b2"], "remove": ["x1"]}})
+        self.assertEqual(report.missing, {"A": ["a2"], "B": ["b2"]})
+        self.assertEqual(report.extra, {"P": ["x1"]})
+        self.assertEqual(flags, ["a2"])
+
+    def test_leases_are_shared_rebalanced_and_taken_over(self):
+        path = os.path.join(tempfile.mkdtemp(), "leases.db")
+        now = [1000.0]
+        first = LeaseStore(path, "first", partitions=8, ttl=30, clock=lambda: now[0])
+        second = LeaseStore(path, "second", partitions=8, ttl=30, clock=lambda: now[0])
+
+        # 先に起動したワーカーが全て取得し、後から起動したワーカーは手放されるまで待つ
+        self.assertEqual(first.heartbeat(), set(range(8)))
+        self.assertEqual(second.heartbeat(), set())
+        self.assertEqual(len(first.heartbeat(rebalance=True)), 4)
+        self.assertEqual(len(second.heartbeat()), 4)
+        self.assertEqual(first.owned | second.owned, set(range(8)))
+        self.assertFalse(first.owned & second.owned)
+
+        # 延長が止まったワーカーは期限切れになる前に書き込みを止め、期限切れ後に引き継がれる
+        now[0] += 16
+        self.assertEqual(first.owned, set())
+        self.assertEqual(len(second.heartbeat()), 4)
+        now[0] += 15
+        self.assertEqual(second.heartbeat(), set(range(8)))
+
+        # 終了時に手放したリースはすぐに引き継げる
+        second.release()
+        self.assertEqual(first.heartbeat(), set(range(8)))
+
+
+class TestNotionWorkloadManagementWithFakeServer(unittest.TestCase):
+    """ローカルのNotion API代替サーバーを使った複数の処理にまたがるシナリオ"""
+
+    def setUp(self):
+        self.api_key = "test_api_key"
+
+    def _start_server(self, **kwargs) -> FakeNotionServer:
+        """テスト終了時に停止するローカルのNotion API代替サーバーを起動"""
+        server = FakeNotionServer(**kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_process_new_entries_against_fake_server(self):
+        # 既存の予定が切り詰められる件数（30件）ある集計ページを持つローカルサーバー
+        server = self._start_server(seed=1)
+        seeded = server.seed_workload(
+            tasks=40, clients=3, parent_ratio=0.5, existing_tasks_per_client=30)
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"], page_size=10,
+            transport=NotionTransport({}, base_url=server.url))
+
+        # メソッドの実行
+        stats = manager.process_new_entries()
+
+        # アサーション
+        self.assertEqual(stats.entries, 40)
+        self.assertEqual(stats.succeeded, 40)
+        self.assertEqual(manager.get_new_schedule_entries(), [])
+        linked = sum(len(page["properties"]["予定"]["relation"]) for page in server.pages.values()
+                     if page["parent"]["database_id"] == seeded["summary_db_id"])
+        self.assertEqual(linked, 3 * 30 + 40)
+
+    def test_metrics_record_each_api_call_type(self):
+        server = self._start_server(seed=3)
+        seeded = server.seed_workload(tasks=10, clients=2, parent_ratio=1.0)
+        metrics = Metrics()
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url, metrics=metrics),
+            metrics=metrics)
+
+        manager.process_new_entries()
+
+        # API呼び出しの種類ごとに集計される
+        requests_by_operation = metrics.to_dict()["requests"]
+        for operation in ("query_tasks", "query_summary", "patch_parent", "patch_summary", "patch_flag"):
+            self.assertIn(operation, requests_by_operation)
+        self.assertEqual(requests_by_operation["patch_flag"]["status_codes"], {"200": 10})
+        self.assertGreater(requests_by_operation["query_tasks"]["bytes_received"], 0)
+        self.assertEqual(metrics.to_dict()["cycles"]["entries_total"], 10)
+
+        # /metrics エンドポイントでPrometheus形式を返す
+        metrics_server = MetricsServer(metrics, port=0).start()
+        self.addCleanup(metrics_server.stop)
+        body = NotionTransport({}).session.get(
+            f"http://127.0.0.1:{metrics_server.server_address[1]}/metrics").text
+        self.assertIn('notion_requests_total{operation="patch_flag",status="200"} 10', body)
+
+    def test_queries_request_only_needed_properties(self):
+        server = self._start_server(seed=4)
+        seeded = server.seed_workload(tasks=3, clients=1)
+        schema_path = os.path.join(tempfile.mkdtemp(), "schema_cache.json")
+        transport = NotionTransport({}, base_url=server.url)
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=transport, schema_cache_path=schema_path)
+
+        # 起動時のスキーマ取得でキャッシュを作成
+        manager.get_database_properties()
+        self.assertEqual(server.calls["GET /databases/{id}"], 2)
+
+        # 工数集計DBには取得対象外のプロパティ（名前・工数集計）がある
+        manager.refresh_summary_index()
+        summary_query = server.calls["POST /databases/{id}/query"]
+        self.assertEqual(summary_query, 1)
+        self.assertEqual(len(manager.summary_index), 1)
+
+        # スキーマはファイルに保存され、再起動後はデータベース取得APIを呼ばない
+        restarted = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=transport, schema_cache_path=schema_path)
+        entries = restarted.get_new_schedule_entries()
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(server.calls["GET /databases/{id}"], 2)
+        self.assertEqual(restarted.schema_cache.property_id(seeded["task_db_id"], "フラグ"), "fl%3Ag")
+
+        response = transport.post(
+            f"databases/{seeded['summary_db_id']}/query?filter_properties=ta%3As", json={})
+        self.assertEqual(list(response.json()["results"][0]["properties"]), ["予定"])
+
+    def test_recover_replays_only_unfinished_steps(self):
+        server = self._start_server(seed=6)
+        seeded = server.seed_workload(tasks=6, clients=2, parent_ratio=1.0)
+        journal_path = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+        transport = NotionTransport({}, base_url=server.url)
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=transport, journal_path=journal_path)
+        # 工数の書き込み後、フラグの更新前にプロセスが停止した状態
+        manager.update_schedule_flag = MagicMock(side_effect=RuntimeError("killed"))
+        with self.assertRaises(RuntimeError):
+            manager.process_new_entries()
+        manager.journal.close()
+
+        # 再起動後はフラグの更新のみを再実行する
+        server.reset_stats()
+        restarted = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=transport, journal_path=journal_path)
+        self.assertEqual(len(restarted.journal.unfinished()), 6)
+
+        self.assertEqual(restarted.recover(), 6)
+        self.assertEqual(dict(server.calls), {"PATCH /pages/{id}": 6})
+        self.assertEqual(len(restarted.journal), 0)
+        self.assertEqual(restarted.get_new_schedule_entries(), [])
+
+    def test_parent_updates_are_coalesced_and_skipped_when_up_to_date(self):
+        server = self._start_server(seed=7)
+        seeded = server.seed_workload(tasks=30, clients=20, parent_ratio=1.0)
+        parent_id = seeded["parent_ids"][0]
+        metrics = Metrics()
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url, metrics=metrics))
+
+        stats = manager.process_new_entries()
+
+        # 30件の子タスクに対して、親タスク2件をそれぞれ1回だけ更新
+        self.assertEqual(stats.succeeded, 30)
+        self.assertEqual(metrics.to_dict()["requests"]["patch_parent"]["status_codes"], {"200": 2})
+        children = server.pages[parent_id]["properties"]["子タスク"]["relation"]
+        self.assertGreater(len(children), 1)
+
+        # 既に子タスクに含まれている場合は書き込まない
+        manager._parent_children = {}
+        server.reset_stats()
+        child = server.pages[children[0]["id"]]
+        manager.update_parent_tasks(parent_id, [ScheduleEntity(child["id"], parent_task_id=parent_id)])
+        self.assertEqual(server.calls["PATCH /pages/{id}"], 0)
+
+    def test_parent_is_resolved_from_task_graph(self):
+        server = self._start_server(seed=8)
+        seeded = server.seed_workload(tasks=30, clients=1)
+        task_ids = server._rows[seeded["task_db_id"]]
+        # クエリ結果では切り詰められる30件の子タスクを持つ親タスク（子タスクのrollupは空）
+        parent_id = server.create_page(seeded["task_db_id"], {
+            '名前': [{"plain_text": "Parent"}], 'フラグ': True,
+            '子タスク': [{"id": task_id} for task_id in task_ids[:30]]})
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url))
+
+        manager.refresh_task_graph()
+        self.assertEqual(manager.task_graph.parent(task_ids[29]), parent_id)
+        self.assertEqual(manager.task_graph.subtree_workload(parent_id), 30 * 1.5)
+
+        entries = manager.get_new_schedule_entries()
+        self.assertTrue(all(entry.parent_task_id == "" for entry in entries))
+        manager._resolve_parents(entries)
+        self.assertTrue(all(entry.parent_task_id == parent_id for entry in entries))
+
+        # 別の親タスクに移されたタスクは、グラフが古くてもrollupの親タスクを使う
+        moved = ScheduleEntity(task_ids[0], parent_task_id="new_parent_id")
+        manager._resolve_parents([moved])
+        self.assertEqual(moved.parent_task_id, "new_parent_id")
+
+    def test_multi_tenant_runner_schedules_tenants_fairly(self):
+        server = self._start_server(seed=9)
+        configs = []
+        for name, tasks, api_key in (("large", 50, "key_a"), ("small_1", 3, "key_a"), ("small_2", 3, "key_b")):
+            seeded = server.seed_workload(tasks=tasks, clients=2)
+            configs.append(TenantConfig(name, api_key, seeded["task_db_id"], seeded["summary_db_id"],
+                                        requests_per_second=1000))
+
+        def build_manager(config, transport, metrics):
+            return NotionWorkloadManagement(
+                config.api_key, config.task_db_id, config.summary_db_id, page_size=10,
+                transport=transport, metrics=metrics)
+
+        runner = MultiTenantRunner(configs, build_manager, max_workers=1, max_batches=1,
+                                   interval=0, min_interval=0, base_url=server.url)
+        self.addCleanup(runner.close)
+        large, small_1, small_2 = runner.tenants
+
+        # 大きなテナントは1ページ分で交代し、小さなテナントも最初の一巡で処理される
+        runner.run(max_cycles=3)
+        self.assertEqual([tenant.cycles for tenant in runner.tenants], [1, 1, 1])
+        self.assertEqual(small_1.manager.get_new_schedule_entries(), [])
+        self.assertEqual(small_2.manager.get_new_schedule_entries(), [])
+        self.assertEqual(len(large.manager.get_new_schedule_entries()), 40)
+
+        runner.run(max_cycles=12)
+        self.assertEqual(large.manager.get_new_schedule_entries(), [])
+
+        # 接続プールは共有し、レート制限はAPIキーごと、計測はテナントごと
+        self.assertIs(large.manager.transport.session.get_adapter(server.url), runner.adapter)
+        self.assertEqual(len(runner.rate_limiters), 2)
+        self.assertIs(large.manager.transport.rate_limiter, small_1.manager.transport.rate_limiter)
+        self.assertEqual(large.metrics.to_dict()["cycles"]["succeeded_total"], 50)
+        body = runner.metrics.to_prometheus()
+        self.assertEqual(body.count("# TYPE notion_entries_succeeded_total counter"), 1)
+        self.assertIn('notion_entries_succeeded_total{tenant="small_2"} 3', body)
+
+    def test_webhook_events_are_verified_deduplicated_and_processed(self):
+        server = self._start_server(seed=10)
+        seeded = server.seed_workload(tasks=5, clients=2)
+        task_ids = server._rows[seeded["task_db_id"]]
+        receiver = WebhookReceiver(port=0, secret="secret", database_id=seeded["task_db_id"]).start()
+        self.addCleanup(receiver.stop)
+        session = NotionTransport({}).session
+
+        def notify(page_id, secret="secret", database_id=seeded["task_db_id"]):
+            body = json.dumps({"type": "page.properties_updated",
+                               "entity": {"id": page_id, "type": "page"},
+                               "data": {"parent": {"id": database_id, "type": "database"}}}).encode()
+            return session.post(receiver.url, data=body,
+                                headers={"X-Notion-Signature": sign(secret, body)}).status_code
+
+        # 同じページの通知は1件にまとめ、署名が不正な通知と他のDBのページは受け付けない
+        self.assertEqual([notify(task_ids[0]), notify(task_ids[1]), notify(task_ids[0])], [200, 200, 200])
+        self.assertEqual(notify(task_ids[2], secret="wrong"), 401)
+        notify(task_ids[3], database_id=seeded["summary_db_id"])
+        self.assertEqual(len(receiver.pending), 2)
+        self.assertEqual((receiver.duplicates, receiver.rejected), (1, 1))
+
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url))
+        stats = manager.process_pages(receiver.pending.drain())
+
+        self.assertEqual(stats.succeeded, 2)
+        self.assertEqual(server.calls["GET /pages/{id}"], 2)
+        self.assertEqual(len(manager.get_new_schedule_entries()), 3)
+
+        # 自分がフラグを立てたことによる通知は読み込まない
+        server.reset_stats()
+        notify(task_ids[0])
+        self.assertEqual(manager.process_pages(receiver.pending.drain()).entries, 0)
+        self.assertEqual(sum(server.calls.values()), 0)
+
+    def test_reconcile_reports_and_resumes_backfill(self):
+        server = self._start_server(seed=11)
+        # 予定には各顧問先のタスクではないページが3件ずつあり、30件のタスクはまだ予定に無い
+        seeded = server.seed_workload(tasks=30, clients=2, existing_tasks_per_client=3)
+        task_ids = server._rows[seeded["task_db_id"]]
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), "reconcile_checkpoint.json")
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url))
+
+        # 表示のみでは書き込まない
+        report = manager.reconcile(checkpoint_path=checkpoint_path)
+        self.assertEqual(report.tasks_scanned, 30)
+        self.assertEqual(sum(map(len, report.missing.values())), 30)
+        self.assertEqual(sum(map(len, report.extra.values())), 6)
+        self.assertEqual(len(report.unflagged), 30)
+        self.assertEqual(server.calls["PATCH /pages/{id}"], 0)
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+        # フラグの書き込み途中で中断
+        original = manager.update_schedule_flag
+        flagged = []
+
+        def interrupted(schedule):
+            if len(flagged) == 5:
+                raise RuntimeError("interrupted")
+            flagged.append(schedule.id)
+            return original(schedule)
+
+        manager.update_schedule_flag = interrupted
+        with self.assertRaises(RuntimeError):
+            manager.reconcile(apply=True, checkpoint_path=checkpoint_path)
+        self.assertTrue(os.path.exists(checkpoint_path))
+
+        # 再スキャンせずに残りの書き込みのみ行う（集計ページ2件 + フラグ30件）
+        server.reset_stats()
+        restarted = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url))
+        report = restarted.reconcile(apply=True, checkpoint_path=checkpoint_path)
+        self.assertEqual(dict(server.calls), {"PATCH /pages/{id}": 25})
+        self.assertEqual((report.summaries_patched, report.flags_patched), (2, 30))
+        self.assertFalse(os.path.exists(checkpoint_path))
+        self.assertEqual(restarted.get_new_schedule_entries(), [])
+        linked = {item["id"] for page_id in server._rows[seeded["summary_db_id"]]
+                  for item in server.pages[page_id]["properties"]["予定"]["relation"]}
+        self.assertTrue(set(task_ids) <= linked)
+        self.assertEqual(len(linked), 30 + 6)
+
+    def test_reconcile_updates_parents_and_refuses_stale_checkpoints(self):
+        server = self._start_server(seed=14)
+        seeded = server.seed_workload(tasks=10, clients=2, parent_ratio=1.0)
+        checkpoint_path = os.path.join(tempfile.mkdtemp(), "reconcile_checkpoint.json")
+
+        # 別のデータベースの組の計画からは再開しない
+        stale = ReconcileCheckpoint(checkpoint_path)
+        stale.start(ReconcileReport(), {}, ["other_task"], {}, "other_task_db", seeded["summary_db_id"])
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url))
+        server.reset_stats()
+        self.assertIsNone(manager.reconcile(apply=True, checkpoint_path=checkpoint_path))
+        self.assertEqual(dict(server.calls), {})
+        os.remove(checkpoint_path)
+
+        # 親タスクの子タスクに追加してからフラグを立てる
+        report = manager.reconcile(apply=True, checkpoint_path=checkpoint_path)
+        self.assertEqual((report.flags_patched, report.flags_skipped), (10, 0))
+        children = {item["id"] for parent_id in seeded["parent_ids"]
+                    for item in server.pages[parent_id]["properties"]["子タスク"]["relation"]}
+        self.assertEqual(children, set(server._rows[seeded["task_db_id"]]) - set(seeded["parent_ids"]))
+        self.assertEqual(manager.get_new_schedule_entries(), [])
+
+    def test_workers_process_only_clients_of_their_partitions(self):
+        server = self._start_server(seed=12)
+        seeded = server.seed_workload(tasks=60, clients=16)
+        path = os.path.join(tempfile.mkdtemp(), "leases.db")
+        workers = []
+        written = []
+        for name in ("first", "second"):
+            leases = LeaseStore(path, name, partitions=4)
+            manager = NotionWorkloadManagement(
+                self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+                transport=NotionTransport({}, base_url=server.url), leases=leases)
+            clients = set()
+            original = manager.update_workload_entries
+            manager.update_workload_entries = (
+                lambda client_id, schedules, clients=clients, original=original:
+                (clients.add(client_id), original(client_id, schedules))[1])
+            workers.append(manager)
+            written.append(clients)
+            leases.heartbeat()
+
+        # 1台目は取り分を超えたリースを手放してから、残ったパーティションの顧問先のみを処理する
+        first, second = workers
+        task_clients = {entry.client_id for entry in first.get_new_schedule_entries()}
+        first_stats = first.process_new_entries()
+        remaining = first.get_new_schedule_entries()
+        self.assertEqual(first_stats.entries + len(remaining), 60)
+        self.assertTrue(remaining)
+        self.assertTrue(all(not first.leases.owns(entry.client_id) for entry in remaining))
+
+        second.leases.heartbeat()
+        second_stats = second.process_new_entries()
+        self.assertEqual(second_stats.succeeded, len(remaining))
+        self.assertEqual(second.get_new_schedule_entries(), [])
+
+        # 1つの工数集計ページは1つのワーカーからのみ書き込まれる
+        self.assertFalse(written[0] & written[1])
+        self.assertEqual(written[0] | written[1], task_clients)
+        self.assertTrue({partition_of(client_id, 4) for client_id in written[0]} <= first.leases.owned)
+
+    def test_workers_do_not_write_after_losing_the_lease(self):
+        server = self._start_server(seed=15)
+        seeded = server.seed_workload(tasks=5, clients=1)
+        now = [1000.0]
+        leases = LeaseStore(os.path.join(tempfile.mkdtemp(), "leases.db"), "worker", partitions=1,
+                            ttl=30, clock=lambda: now[0])
+        manager = NotionWorkloadManagement(
+            self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+            transport=NotionTransport({}, base_url=server.url), leases=leases)
+
+        # 集計ページの読み込み中に延長が止まり、リースが切れた状態
+        find_workload_summary = manager._find_workload_summary
+
+        def stalled(client_id):
+            now[0] += 20
+            return find_workload_summary(client_id)
+
+        manager._find_workload_summary = stalled
+        server.reset_stats()
+        stats = manager.process_new_entries()
+
+        # 集計ページもフラグも書き込まず、失敗としても記録しない
+        self.assertEqual((stats.entries, stats.succeeded), (5, 0))
+        self.assertEqual(server.calls["PATCH /pages/{id}"], 0)
+        self.assertEqual(len(manager.failures), 0)
+        self.assertEqual(len(manager.get_new_schedule_entries()), 5)
+
+    def test_workers_serialize_writes_to_a_shared_parent(self):
+        # 16顧問先のタスクが全て同じ親タスクを持つ
+        server = self._start_server(seed=16, latency=0.005)
+        seeded = server.seed_workload(tasks=40, clients=16, parent_ratio=1.0)
+        self.assertEqual(len(seeded["parent_ids"]), 1)
+        path = os.path.join(tempfile.mkdtemp(), "leases.db")
+        workers = []
+        for name in ("first", "second"):
+            leases = LeaseStore(path, name, partitions=4)
+            workers.append(NotionWorkloadManagement(
+                self.api_key, seeded["task_db_id"], seeded["summary_db_id"], page_size=5,
+                transport=NotionTransport({}, base_url=server.url), leases=leases))
+            leases.heartbeat()
+        for manager in workers:
+            manager.leases.heartbeat(rebalance=True)
+        for manager in workers:
+            manager.leases.heartbeat()
+
+        # 2つのワーカーが同時に同じ親タスクへ子タスクを追加しても失われない
+        threads = [threading.Thread(target=manager.process_new_entries) for manager in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(workers[0].get_new_schedule_entries(), [])
+        parent = server.pages[seeded["parent_ids"][0]]
+        children = {item["id"] for item in parent["properties"]["子タスク"]["relation"]}
+        self.assertEqual(children, set(server._rows[seeded["task_db_id"]]) - set(seeded["parent_ids"]))
+
+
+    def test_partitions_are_taken_over_only_at_cycle_start(self):
+        server = self._start_server(seed=17)
+        seeded = server.seed_workload(tasks=0, clients=1)
+        summary_id = server._rows[seeded["summary_db_id"]][0]
+        path = os.path.join(tempfile.mkdtemp(), "leases.db")
+        now = [1000.0]
+        workers = []
+        for name in ("first", "second"):
+            leases = LeaseStore(path, name, partitions=1, ttl=30, clock=lambda: now[0])
+            workers.append(NotionWorkloadManagement(
+                self.api_key, seeded["task_db_id"], seeded["summary_db_id"],
+                transport=NotionTransport({}, base_url=server.url), leases=leases))
+        first, second = workers
+
+        # 2台目は集計ページを読み込んだが、パーティションは1台目が持っている
+        first.leases.heartbeat()
+        second.process_new_entries()
+        server.add_tasks(seeded["task_db_id"], 1, seeded["client_ids"])
+        self.assertEqual(first.process_new_entries().succeeded, 1)
+
+        # 1台目が停止しても、延長のみのheartbeatでは引き継がない
+        now[0] += 31
+        self.assertEqual(second.leases.heartbeat(acquire=False), set())
+
+        # サイクル開始時に引き継ぎ、1台目が書き込んだ予定を残したまま追加する
+        server.add_tasks(seeded["task_db_id"], 1, seeded["client_ids"])
+        self.assertEqual(second.process_new_entries().succeeded, 1)
+        linked = {item["id"] for item in server.pages[summary_id]["properties"]["予定"]["relation"]}
+        self.assertEqual(linked, set(server._rows[seeded["task_db_id"]]))
+
+    def test_workers_serialize_writes_to_a_summary_shared_by_partitions(self):
+        # 別のパーティションの2顧問先が同じ集計ページに紐付いている
+        server = self._start_server(seed=18, latency=0.005)
+        task_db_id = server.create_database(TASK_SCHEMA)
+        summary_db_id = server.create_database(SUMMARY_SCHEMA)
+        candidates = [f"client-{index}" for index in range(8)]
+        client_ids = [candidates[0], next(client_id for client_id in candidates
+                                          if partition_of(client_id, 2) != partition_of(candidates[0], 2))]
+        summary_id = server.create_page(summary_db_id, {
+            '名前': [{"plain_text": "Shared"}],
+            '顧客先DB': [{"id": client_id} for client_id in client_ids],
+            '予定': [],
+        })
+        task_ids = server.add_tasks(task_db_id, 30, client_ids)
+        path = os.path.join(tempfile.mkdtemp(), "leases.db")
+        workers = []
+        for name in ("first", "second"):
+            leases = LeaseStore(path, name, partitions=2)
+            workers.append(NotionWorkloadManagement(
+                self.api_key, task_db_id, summary_db_id, page_size=5,
+                transport=NotionTransport({}, base_url=server.url), leases=leases))
+            leases.heartbeat()
+        for manager in workers:
+            manager.leases.heartbeat(rebalance=True)
+        for manager in workers:
+            manager.leases.heartbeat()
+        self.assertEqual([len(manager.leases.owned) for manager in workers], [1, 1])
+
+        threads = [threading.Thread(target=manager.process_new_entries) for manager in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        linked = {item["id"] for item in server.pages[summary_id]["properties"]["予定"]["relation"]}
+        self.assertEqual(linked, set(task_ids))
+
 
 if __name__ == '__main__':
     unittest.main()